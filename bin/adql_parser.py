@@ -0,0 +1,1000 @@
+"""
+ANTLR side of the ADQL to LSDB translator: the parse-tree listener which
+extracts the query entities, and the parser itself.
+
+Importing queryparser deserializes the ADQL grammar, and the first queries
+are slow while ANTLR fills its prediction caches, so ``adql_to_lsdb`` only
+imports this module when it has a query to parse. The warmed-up caches can be
+saved with ``save_parser_state`` and loaded into a fresh process with
+``load_parser_state``, so that its first query is as fast as the thousandth.
+"""
+
+import hashlib
+import importlib.metadata
+import json
+import os
+import pickle
+import sys
+
+import antlr4
+from antlr4.atn.PredictionMode import PredictionMode
+from antlr4.atn.SemanticContext import SemanticContext
+from antlr4.error.ErrorStrategy import BailErrorStrategy, DefaultErrorStrategy
+from antlr4.error.Errors import ParseCancellationException
+from antlr4.PredictionContext import PredictionContext
+from queryparser.adql.adqltranslator import FormatListener, SyntaxErrorListener
+from queryparser.adql.ADQLLexer import ADQLLexer
+from queryparser.adql.ADQLParser import ADQLParser
+from queryparser.exceptions import QuerySyntaxError
+
+# Aggregates which can be computed per partition and then combined
+AGGREGATE_FUNCTIONS = ("COUNT", "SUM", "MIN", "MAX", "AVG")
+
+# Upper bound on the number of OR-ed terms a WHERE clause may expand to in
+# disjunctive normal form, e.g. (a OR b) AND (c OR d) has four.
+MAX_DNF_TERMS = 256
+
+
+class LSDBFormatListener(FormatListener):
+    """
+    Listens to parsing events from a known subset of ADQL, building up the data in these
+    events into data for parameters to LSDB.  These include:
+
+    - Tables to catalogs -> gaia_dr3.gaia -> "https://lsdb.data/io/hats/gaia_dr3/gaia/"
+    - Columns to columns -> SELECT source_id, ra, dec -> columns=["source_id", "ra", "dec"]
+    - CONTAINS(POINT(...), CIRCLE(...))  -> lsdb.ConeSearch(...)
+      - or, CONTAINS(POINT(...), POLYGON(...)) -> lsdb.PolygonSearch(...)
+    - Basic conditions (e.g. phot_g_mean_mag < 10) -> filters= or cat.query(...)
+      - AND / OR / NOT, BETWEEN and IN -> filters in disjunctive normal form
+      - without CONTAINS, ra/dec ranges -> lsdb.BoxSearch(...)
+        and _healpix_29 ranges -> lsdb.PixelSearch(...)
+    - Limits (e.g. TOP 10) -> q.head(limit)
+    - ORDER BY with TOP -> per-partition nsmallest/nlargest (sort_values().head()
+      for non-numeric keys), then a final merge
+    - COUNT / SUM / MIN / MAX / AVG, with optional GROUP BY -> per-partition
+      partial aggregates, combined after compute(); a bare COUNT(*) is read from
+      the catalog metadata
+    """
+
+    def __init__(self, parser):
+        # The limit is read straight from the TOP clause in enterSet_limit,
+        # so there are no pre-parsed contexts to pass to FormatListener.
+        super().__init__(parser, contexts={}, limit_contexts={})
+        self.entities = {
+            "tables": [],
+            "columns": [],
+            "spatial_search": None,
+            "conditions": [],
+            "limits": None,
+            "order_by": [],
+            "aggregates": [],
+            "group_by": [],
+            # Correlation names of the tables, None where a table has none
+            "table_aliases": [],
+            "join": None,
+        }
+        # Track parsing context
+        self._in_join_condition = False
+        self._in_contains = False
+        self._current_point = None
+        self._current_circle = None
+        self._current_polygon = None
+
+    def enterContains(self, ctx):
+        """Enter a CONTAINS clause - set context flag."""
+        if self._in_join_condition:
+            return  # Positional JOIN conditions are parsed in enterFrom_clause
+        self._in_contains = True
+        self._current_point = None
+        self._current_circle = None
+        self._current_polygon = None
+
+    def exitContains(self, ctx):
+        """Exit CONTAINS clause - validate and store spatial search info."""
+        if not self._in_contains:
+            return
+
+        # Validate that we have both POINT and CIRCLE, or POINT and POLYGON
+        if not self._current_point:
+            raise NotImplementedError("CONTAINS clause must include a POINT")
+        if not self._current_circle and not self._current_polygon:
+            raise NotImplementedError("CONTAINS clause must include a CIRCLE or POLYGON")
+
+        # Store spatial search information
+        if self._current_circle:
+            self.entities["spatial_search"] = {
+                "type": "ConeSearch",
+                "ra": self._current_circle["ra"],
+                "dec": self._current_circle["dec"],
+                "radius": self._current_circle["radius"],
+                "point": self._current_point,
+            }
+        elif self._current_polygon:
+            self.entities["spatial_search"] = {
+                "type": "PolygonSearch",
+                "coordinates": self._current_polygon["coordinates"],
+                "point": self._current_point,
+            }
+
+        # Reset context
+        self._in_contains = False
+        self._current_point = None
+        self._current_circle = None
+        self._current_polygon = None
+
+    def enterPoint(self, ctx):
+        """Parse POINT('ICRS', ra, dec) within CONTAINS."""
+        if not self._in_contains:
+            return  # Ignore points outside CONTAINS
+
+        # Arguments are column references, possibly qualified (e.g. 'a.ra')
+        args = self._geometry_args(ctx)
+
+        if len(args) != 3:
+            raise ValueError(f"POINT function expects 3 arguments, got {len(args)}")
+
+        coord_system = args[0].strip("'\"")
+        if coord_system.upper() != "ICRS":
+            raise NotImplementedError(f"Only 'ICRS' coordinate system is supported, got '{coord_system}'")
+
+        # The coordinate columns, which must be read for the search to be exact
+        self._current_point = {"ra": self._unquote_identifier(args[1]), "dec": self._unquote_identifier(args[2])}
+
+    def enterCircle(self, ctx):
+        """Parse CIRCLE('ICRS', ra, dec, radius) within CONTAINS."""
+        if not self._in_contains:
+            return  # Ignore circles outside CONTAINS
+
+        # Extract arguments from the parsed context
+        args = self._extract_function_args_from_context(ctx)
+        assert args.pop(0).upper() == "CIRCLE"
+
+        if len(args) != 4:
+            raise ValueError(f"CIRCLE function expects 4 arguments, got {len(args)}")
+
+        coord_system = args[0].strip("'\"")
+        if coord_system.upper() != "ICRS":
+            raise NotImplementedError(f"Only 'ICRS' coordinate system is supported, got '{coord_system}'")
+
+        try:
+            ra = float(args[1])
+            dec = float(args[2])
+            radius = float(args[3])
+        except ValueError as e:
+            raise ValueError(f"Invalid values in CIRCLE: {e}")
+
+        self._current_circle = {"ra": ra, "dec": dec, "radius": radius}
+
+    def enterPolygon(self, ctx):
+        """Parse POLYGON('ICRS', x1, y1, x2, y2, ..., xn, yn) within CONTAINS."""
+        if not self._in_contains:
+            return  # Ignore polygons outside CONTAINS
+
+        # Extract arguments from the parsed context
+        args = self._extract_function_args_from_context(ctx)
+        assert args.pop(0).upper() == "POLYGON"
+
+        if len(args) < 4 or len(args) % 2 == 0:
+            raise ValueError(f"POLYGON function expects an odd number of arguments >= 4, got {len(args)}")
+
+        coord_system = args[0].strip("'\"")
+        if coord_system.upper() != "ICRS":
+            raise NotImplementedError(f"Only 'ICRS' coordinate system is supported, got '{coord_system}'")
+
+        try:
+            coordinates = []
+            for i in range(1, len(args), 2):
+                ra = float(args[i])
+                dec = float(args[i + 1])
+                coordinates.append((ra, dec))
+        except ValueError as e:
+            raise ValueError(f"Invalid values in POLYGON: {e}")
+
+        self._current_polygon = {"coordinates": coordinates}
+
+    def _extract_function_args_from_context(self, ctx):
+        """Extract function arguments from ANTLR context by traversing the parse tree."""
+        args = []
+
+        # Walk through the children of the context
+        for child in ctx.children:
+            # Look for terminal nodes that represent the actual values
+            if hasattr(child, "children"):
+                # This is a non-terminal, recurse into it
+                args.extend(self._extract_values_from_node(child))
+            else:
+                # Never mind punctuation like commas or parentheses
+                if (text := str(child)) not in ("(", ")", ","):
+                    args.append(text)
+
+        # Merge unary signs with following numeric tokens (e.g., '-', '10.5' -> '-10.5')
+        args = self._merge_unary_signs(args)
+        return args
+
+    def _geometry_args(self, ctx):
+        """
+        Return the arguments of a POINT or CIRCLE as text, keeping each argument whole.
+
+        Examples:
+        - "POINT('ICRS', a.ra, a.dec)" -> ["'ICRS'", "a.ra", "a.dec"]
+        - "CIRCLE('ICRS', b.ra, b.dec, 0.001)" -> ["'ICRS'", "b.ra", "b.dec", "0.001"]
+        """
+        argument_types = (
+            ADQLParser.Coord_sysContext,
+            ADQLParser.Coordinate1Context,
+            ADQLParser.Coordinate2Context,
+            ADQLParser.RadiusContext,
+        )
+        args = []
+        for child in ctx.children or ():
+            if isinstance(child, argument_types):
+                args.append(child.getText())
+            elif hasattr(child, "children"):
+                args.extend(self._geometry_args(child))
+        return args
+
+    def _extract_values_from_node(self, node):
+        """Recursively extract values from a parse tree node."""
+        values = []
+
+        if hasattr(node, "children"):
+            for child in node.children:
+                values.extend(self._extract_values_from_node(child))
+        else:
+            # Terminal node
+            # Never mind punctuation like commas or parentheses
+            if (text := str(node)) not in ("(", ")", ","):
+                values.append(text)
+
+        return values
+
+    def _merge_unary_signs(self, tokens):
+        """
+        Merge unary '+' or '-' tokens with immediately following numeric tokens,
+        turning ['-', '10.5'] into ['-10.5'] so downstream parsing sees signed numbers.
+        """
+        merged = []
+        i = 0
+        while i < len(tokens):
+            t = tokens[i]
+            if t in ("-", "+") and i + 1 < len(tokens) and self._looks_like_number(tokens[i + 1]):
+                merged.append(t + tokens[i + 1])
+                i += 2
+            else:
+                merged.append(t)
+                i += 1
+        return merged
+
+    def _looks_like_number(self, s: str) -> bool:
+        try:
+            float(s)
+            return True
+        except ValueError:
+            return False
+
+    def _unquote_identifier(self, text: str) -> str:
+        """
+        Strip the quotes of a delimited identifier, e.g. '"_healpix_29"' -> '_healpix_29'.
+        ADQL requires them for names that are not regular identifiers, like those starting with '_'.
+        """
+        if len(text) >= 2 and text.startswith('"') and text.endswith('"'):
+            return text[1:-1].replace('""', '"')
+        return text
+
+    def enterSelect_list(self, ctx):
+        """Parse the SELECT list to extract column names and aggregates."""
+        # Extract column names from the SELECT clause
+        columns = self._extract_select_columns(ctx)
+        self.entities["columns"].extend(columns)
+
+    def _extract_select_columns(self, ctx):
+        """Extract column names from a SELECT list context, storing aggregates separately."""
+        columns = []
+
+        # Walk through the children to find column references
+        for child in ctx.children:
+            if hasattr(child, "children"):
+                set_function = self._find_descendant(child, ADQLParser.Set_function_specificationContext)
+                if set_function is not None:
+                    self.entities["aggregates"].append(self._parse_set_function(set_function, child))
+                    continue
+                # This might be a select_sublist or derived_column
+                column_name = self._extract_column_name(child)
+                if column_name:
+                    columns.append(column_name)
+
+        return columns
+
+    def _find_descendant(self, node, context_type):
+        """Return the first node of context_type in a subtree (depth first), or None."""
+        if isinstance(node, context_type):
+            return node
+        for child in getattr(node, "children", None) or ():
+            found = self._find_descendant(child, context_type)
+            if found is not None:
+                return found
+        return None
+
+    def _parse_set_function(self, ctx, select_sublist):
+        """
+        Parse an aggregate in the SELECT list into a (function, column, alias) tuple.
+
+        Examples:
+        - 'COUNT(*)' -> ('COUNT', '*', None)
+        - 'AVG(phot_g_mean_mag) AS mean_mag' -> ('AVG', 'phot_g_mean_mag', 'mean_mag')
+        """
+        derived_column = self._find_descendant(select_sublist, ADQLParser.Derived_columnContext)
+        value_text = derived_column.children[0].getText()
+        if value_text != ctx.getText():
+            raise NotImplementedError(f"Only bare aggregates are supported in SELECT, got '{value_text}'")
+        as_clause = self._find_descendant(derived_column, ADQLParser.As_clauseContext)
+        alias = self._unquote_identifier(as_clause.children[-1].getText()) if as_clause is not None else None
+
+        if ctx.children[0].getText().upper() == "COUNT" and ctx.children[2].getText() == "*":
+            return ("COUNT", "*", alias)
+
+        general = ctx.children[0]
+        function = general.children[0].getText().upper()
+        if function not in AGGREGATE_FUNCTIONS:
+            raise NotImplementedError(f"Unsupported aggregate function '{function}'")
+        # Children are function, '(', [DISTINCT|ALL], argument, ')'
+        argument = general.children[-2]
+        column_reference = self._find_descendant(argument, ADQLParser.Column_referenceContext)
+        if len(general.children) != 4 or column_reference is None or column_reference.getText() != argument.getText():
+            raise NotImplementedError(f"Only {function}(column) is supported, got '{ctx.getText()}'")
+        return (function, self._unquote_identifier(argument.getText()), alias)
+
+    def enterGroup_by_clause(self, ctx):
+        """Parse GROUP BY into a list of column names."""
+        reference_list = self._find_descendant(ctx, ADQLParser.Grouping_column_reference_listContext)
+        for child in reference_list.children:
+            if isinstance(child, ADQLParser.Grouping_column_referenceContext):
+                self.entities["group_by"].append(self._unquote_identifier(child.getText()))
+
+    def exitSelect_query(self, ctx):
+        """Validate that non-aggregated columns are grouped on."""
+        if not self.entities["aggregates"]:
+            if self.entities["group_by"]:
+                raise NotImplementedError("GROUP BY without aggregates is not supported")
+            return
+        ungrouped = [col for col in self.entities["columns"] if col not in self.entities["group_by"]]
+        if ungrouped:
+            raise NotImplementedError(f"Columns {ungrouped} must either be aggregated or appear in GROUP BY")
+
+    def _extract_column_name(self, node):
+        """
+        Extract a column name from a parse tree node.
+        Handles simple column names and ignores complex expressions.
+        """
+        # For now, only handle simple column references
+        # Get the text and clean it up
+        text = node.getText().strip()
+
+        # Skip if it's a comma or other punctuation
+        if text in [",", "(", ")", "*"]:
+            return None
+
+        # Handle SELECT * case
+        if text == "*":
+            return "*"
+
+        # For simple column names, just return the text
+        # In a more complete implementation, we'd need to handle:
+        # - table.column references
+        # - aliased columns (column AS alias)
+        # - function calls
+        # - expressions
+
+        # Skip SQL keywords that might appear
+        if text.upper() in ["SELECT", "FROM", "WHERE", "TOP", "DISTINCT"]:
+            return None
+
+        return self._unquote_identifier(text)
+
+    def enterSet_limit(self, ctx):
+        """Extract limit from the TOP clause, e.g. TOP 10 -> 10."""
+        # Children are the TOP keyword followed by an unsigned decimal
+        if len(ctx.children) < 2:
+            return
+        limit_text = ctx.children[1].getText()
+        try:
+            limit_value = int(limit_text)
+        except ValueError:
+            raise ValueError(f"Invalid TOP/LIMIT value: {limit_text}")
+        if limit_value <= 0:
+            raise ValueError(f"Invalid TOP/LIMIT value: TOP/LIMIT must be positive, got {limit_value}")
+        self.entities["limits"] = limit_value
+
+    def exitWhere_clause(self, ctx):
+        """Convert the WHERE search condition into filter conditions."""
+        search_condition = next(child for child in ctx.children if isinstance(child, ADQLParser.Search_conditionContext))
+        dnf = self._condition_to_dnf(search_condition)
+        if not dnf:
+            raise NotImplementedError("WHERE clause can never be true")
+        if dnf == [[]]:
+            # Nothing but CONTAINS, which is handled separately
+            return
+        if len(dnf) == 1:
+            # For simple AND conditions, store as single list
+            self.entities["conditions"] = dnf[0]
+        else:
+            # With OR, use full DNF: [[cond1, cond2], [cond3, cond4]]
+            self.entities["conditions"] = dnf
+
+    def _condition_to_dnf(self, node):
+        """
+        Convert a search condition subtree into disjunctive normal form: a list
+        (OR) of lists (AND) of (column, operator, value) tuples, as accepted by
+        pyarrow's ``filters``. [[]] is always true and [] is never true.
+
+        CONTAINS is handled by the spatial search, which is ANDed with the
+        filters, so it is only allowed at the top level of AND-ed conditions.
+        """
+        children = node.children
+        if isinstance(node, ADQLParser.Search_conditionContext):
+            if len(children) == 1:
+                return self._condition_to_dnf(children[0])
+            if self._has_contains(node):
+                raise NotImplementedError("CONTAINS cannot be combined with OR")
+            left, _or, right = children
+            return self._dnf_or(self._condition_to_dnf(left), self._condition_to_dnf(right))
+        if isinstance(node, ADQLParser.Boolean_termContext):
+            if len(children) == 1:
+                return self._condition_to_dnf(children[0])
+            left, _and, right = children
+            return self._dnf_and(self._condition_to_dnf(left), self._condition_to_dnf(right))
+        if isinstance(node, ADQLParser.Boolean_factorContext):
+            if len(children) == 1:
+                return self._condition_to_dnf(children[0])
+            if self._has_contains(node):
+                raise NotImplementedError("NOT CONTAINS is not supported")
+            _not, primary = children
+            return self._dnf_not(self._condition_to_dnf(primary))
+        if isinstance(node, ADQLParser.Boolean_primaryContext):
+            if len(children) == 3:
+                # '(' search_condition ')'
+                return self._condition_to_dnf(children[1])
+            return self._condition_to_dnf(children[0])
+        if isinstance(node, ADQLParser.PredicateContext):
+            return self._predicate_to_dnf(children[0])
+        raise NotImplementedError(f"Unsupported condition '{node.getText()}'")
+
+    def _has_contains(self, node):
+        """Whether a subtree has a CONTAINS predicate."""
+        if isinstance(node, ADQLParser.Contains_predicateContext):
+            return True
+        return any(self._has_contains(child) for child in getattr(node, "children", None) or ())
+
+    def _predicate_to_dnf(self, ctx):
+        """Convert a single predicate (comparison, BETWEEN, IN, CONTAINS) into DNF."""
+        if isinstance(ctx, ADQLParser.Contains_predicateContext):
+            return [[]]
+        if isinstance(ctx, ADQLParser.Comparison_predicateContext):
+            condition = self._parse_comparison(ctx)
+            if condition is None:
+                raise NotImplementedError(f"Unsupported comparison '{ctx.getText()}'")
+            return [[condition]]
+        if isinstance(ctx, ADQLParser.Between_predicateContext):
+            # column [NOT] BETWEEN low AND high
+            texts = [child.getText() for child in ctx.children]
+            negated = texts[1].upper() == "NOT"
+            column, _between, low, _and, high = [text for text in texts if text.upper() != "NOT"]
+            column = self._unquote_identifier(column)
+            low, high = self._parse_value(low), self._parse_value(high)
+            if negated:
+                return [[(column, "<", low)], [(column, ">", high)]]
+            return [[(column, ">=", low), (column, "<=", high)]]
+        if isinstance(ctx, ADQLParser.In_predicateContext):
+            # column [NOT] IN (value, ...)
+            column = self._unquote_identifier(ctx.children[0].getText())
+            negated = ctx.children[1].getText().upper() == "NOT"
+            in_value = ctx.children[-1]
+            value_list = next(
+                (child for child in in_value.children if isinstance(child, ADQLParser.In_value_listContext)), None
+            )
+            if value_list is None:
+                raise NotImplementedError(f"Only literal value lists are supported in IN, got '{in_value.getText()}'")
+            values = [
+                self._parse_value(child.getText())
+                for child in value_list.children
+                if isinstance(child, ADQLParser.Value_expressionContext)
+            ]
+            return [[(column, "not in" if negated else "in", values)]]
+        raise NotImplementedError(f"Unsupported predicate '{ctx.getText()}'")
+
+    def _dnf_or(self, left, right):
+        """OR of two DNFs, dropping duplicate conjunctions."""
+        result = []
+        for conjunction in left + right:
+            if conjunction not in result:
+                result.append(conjunction)
+        return result
+
+    def _dnf_and(self, left, right):
+        """AND of two DNFs, distributing AND over OR."""
+        if len(left) * len(right) > MAX_DNF_TERMS:
+            raise NotImplementedError(f"WHERE clause expands to more than {MAX_DNF_TERMS} OR-ed terms")
+        result = []
+        for left_conjunction in left:
+            for right_conjunction in right:
+                conjunction = left_conjunction + [c for c in right_conjunction if c not in left_conjunction]
+                if conjunction not in result:
+                    result.append(conjunction)
+        return result
+
+    def _dnf_not(self, dnf):
+        """NOT of a DNF, using De Morgan's laws and negated operators."""
+        negated_operators = {
+            "==": "!=",
+            "!=": "==",
+            "<": ">=",
+            ">=": "<",
+            ">": "<=",
+            "<=": ">",
+            "in": "not in",
+            "not in": "in",
+        }
+        result = [[]]
+        for conjunction in dnf:
+            # NOT (a AND b) == (NOT a) OR (NOT b)
+            negated = [[(column, negated_operators[op], value)] for column, op, value in conjunction]
+            result = self._dnf_and(result, negated)
+        return result
+
+    def _parse_comparison(self, ctx):
+        """
+        Parse a comparison context into (column, operator, value) tuple.
+
+        Examples:
+        - 'phot_g_mean_mag < 10' -> ('phot_g_mean_mag', '<', 10)
+        - "phot_variable_flag = 'VARIABLE'" -> ('phot_variable_flag', '==', 'VARIABLE')
+        - 'dec >= -30' -> ('dec', '>=', -30)
+        """
+        # Get all tokens from the comparison
+        tokens = []
+        for child in ctx.children:
+            if hasattr(child, "getText"):
+                text = child.getText().strip()
+                if text:
+                    tokens.append(text)
+
+        # Merge unary signs so we treat ['-', '30'] as ['-30']
+        tokens = self._merge_unary_signs(tokens)
+
+        # Look for basic pattern: column operator value
+        if len(tokens) >= 3:
+            # Find the operator (typically in the middle)
+            sql_operators = ["<", ">", "<=", ">=", "=", "!=", "<>"]
+
+            for i, token in enumerate(tokens):
+                if token in sql_operators:
+                    if i > 0 and i < len(tokens) - 1:
+                        column = self._unquote_identifier(tokens[i - 1])
+                        py_operator = self._translate_operator(token)
+                        value = self._parse_value(tokens[i + 1])
+                        return (column, py_operator, value)
+        return None
+
+    def _translate_operator(self, sql_operator):
+        """Translate SQL operators to Python operators."""
+        operator_map = {"=": "==", "<>": "!=", "!=": "!=", "<": "<", ">": ">", "<=": "<=", ">=": ">="}
+        return operator_map.get(sql_operator, sql_operator)
+
+    def _parse_value(self, value_text):
+        """Parse a value, handling strings, numbers (incl. negative and scientific), etc."""
+        # Remove quotes from string literals
+        if value_text.startswith("'") and value_text.endswith("'"):
+            return value_text[1:-1]  # Remove single quotes
+        if value_text.startswith('"') and value_text.endswith('"'):
+            return value_text[1:-1]  # Remove double quotes
+
+        # Try to parse as number
+        try:
+            # Try integer first
+            if "." not in value_text:
+                return int(value_text)
+            else:
+                return float(value_text)
+        except ValueError:
+            # Return as string if not a number
+            return value_text
+
+    def enterFrom_clause(self, ctx):
+        """
+        Extract table names from the FROM clause.
+
+        Either a single table or an inner JOIN of two tables is supported, where
+        the JOIN condition is a positional match or an equality of two columns:
+        - FROM a JOIN b ON 1 = CONTAINS(POINT('ICRS', a.ra, a.dec), CIRCLE('ICRS', b.ra, b.dec, 0.001))
+        - FROM a JOIN b ON a.id = b.id
+        """
+        references = [child for child in ctx.children if isinstance(child, ADQLParser.Table_referenceContext)]
+        if len(references) != 1:
+            raise NotImplementedError(
+                "Only a single table or a JOIN of two tables is supported in FROM, use JOIN ... ON to join tables"
+            )
+        self._parse_table_reference(references[0])
+        if len(self.entities["tables"]) > 2:
+            raise NotImplementedError("Only JOINs of two tables are supported")
+
+        return super().enterFrom_clause(ctx)
+
+    def _parse_table_reference(self, ctx):
+        """Add the table(s) of a table reference to the entities, parsing the JOIN condition if there is one."""
+        table_name = next((c for c in ctx.children if isinstance(c, ADQLParser.Table_nameContext)), None)
+        if table_name is not None:
+            correlation = self._find_descendant(ctx, ADQLParser.Correlation_nameContext)
+            self.entities["tables"].append(table_name.getText())
+            self.entities["table_aliases"].append(
+                self._unquote_identifier(correlation.getText()) if correlation is not None else None
+            )
+            return
+
+        tables = [c for c in ctx.children if isinstance(c, ADQLParser.Table_referenceContext)]
+        if len(tables) != 2:
+            raise NotImplementedError(f"Unsupported table reference in FROM clause: '{ctx.getText()}'")
+        join_keywords = [
+            c.getText().upper()
+            for c in ctx.children
+            if not isinstance(c, (ADQLParser.Table_referenceContext, ADQLParser.Join_specificationContext))
+        ]
+        if join_keywords not in (["JOIN"], ["INNER", "JOIN"]):
+            raise NotImplementedError(f"Only inner JOINs are supported, got '{' '.join(join_keywords)}'")
+        condition = self._find_descendant(ctx, ADQLParser.Join_conditionContext)
+        if condition is None:
+            raise NotImplementedError("JOIN requires an ON condition")
+
+        for table in tables:
+            self._parse_table_reference(table)
+        self.entities["join"] = self._parse_join_condition(condition)
+
+    def _parse_join_condition(self, ctx):
+        """
+        Parse the ON condition of a JOIN.
+
+        Examples:
+        - "1 = CONTAINS(POINT('ICRS', a.ra, a.dec), CIRCLE('ICRS', b.ra, b.dec, 0.001))" ->
+          {"type": "crossmatch", "point": {"ra": "a.ra", "dec": "a.dec"},
+           "circle": {"ra": "b.ra", "dec": "b.dec"}, "radius": 0.001}
+        - "a.id = b.id" -> {"type": "join", "on": ("a.id", "b.id")}
+        """
+        search_condition = ctx.children[-1]
+        predicate = self._find_descendant(search_condition, ADQLParser.PredicateContext)
+        if predicate is None or predicate.getText() != search_condition.getText():
+            raise NotImplementedError(f"JOIN ... ON supports a single condition, got '{search_condition.getText()}'")
+
+        if self._find_descendant(predicate, ADQLParser.Contains_predicateContext) is not None:
+            point = self._find_descendant(predicate, ADQLParser.PointContext)
+            circle = self._find_descendant(predicate, ADQLParser.CircleContext)
+            if point is None or circle is None:
+                raise NotImplementedError("Positional JOINs must have the form CONTAINS(POINT(...), CIRCLE(...))")
+            point, circle = self._geometry_args(point), self._geometry_args(circle)
+            for coord_system in (point[0], circle[0]):
+                if coord_system.strip("'\"").upper() != "ICRS":
+                    raise NotImplementedError(f"Only 'ICRS' coordinate system is supported, got '{coord_system}'")
+            try:
+                radius = float(circle[3])
+            except ValueError as e:
+                raise ValueError(f"Invalid radius in JOIN condition: {e}")
+            return {
+                "type": "crossmatch",
+                "point": {"ra": self._unquote_identifier(point[1]), "dec": self._unquote_identifier(point[2])},
+                "circle": {"ra": self._unquote_identifier(circle[1]), "dec": self._unquote_identifier(circle[2])},
+                "radius": radius,
+            }
+
+        comparison = self._find_descendant(predicate, ADQLParser.Comparison_predicateContext)
+        if comparison is not None and len(comparison.children) == 3 and comparison.children[1].getText() == "=":
+            left, right = comparison.children[0], comparison.children[2]
+            if all(self._find_descendant(side, ADQLParser.Column_referenceContext) is not None for side in (left, right)):
+                return {
+                    "type": "join",
+                    "on": (self._unquote_identifier(left.getText()), self._unquote_identifier(right.getText())),
+                }
+        raise NotImplementedError(
+            f"JOIN ... ON supports CONTAINS(POINT, CIRCLE) or an equality of two columns, got '{predicate.getText()}'"
+        )
+
+    def enterJoin_condition(self, ctx):
+        self._in_join_condition = True
+
+    def exitJoin_condition(self, ctx):
+        self._in_join_condition = False
+
+    def _extract_sort_tokens(self, ctx):
+        """Extract sort tokens from an ORDER BY clause.
+
+        Parameters
+        ----------
+        ctx : ADQLParser.Order_by_clauseContext
+            The ORDER BY parse subtree.
+
+        Notes
+        -----
+        Expected tree shape, for example query "ORDER BY ra, dec DESC":
+
+            ORDER BY
+            └── Sort_specification_list  (text: "ra,decDESC")
+                ├── Sort_specification   (text: "ra")
+                │   └── Sort_key         (text: "ra")
+                ├── ','                  (comma)
+                └── Sort_specification   (text: "decDESC")
+                    ├── Sort_key         (text: "dec")
+                    └── Ordering_specification (text: "DESC")
+
+        Returns
+        -------
+        list of str
+            List of sort tokens in order, e.g. ['ra', 'dec', 'DESC']
+        """
+        sort_tokens = []
+        for child in ctx.children:
+            if hasattr(child, "children"):
+                # Non-terminal node
+                spec = self._parse_sort_specification(child)
+                sort_tokens.extend(spec)
+            else:
+                # Terminal node
+                text = child.getText().strip()
+                if text and text not in (",", "ORDER", "BY"):
+                    raise NotImplementedError(f"Unexpected terminal node in ORDER BY clause: '{text}'")
+        return sort_tokens
+
+    def _parse_sort_specification(self, node):
+        """Parse individual sort specification from the parse tree node.
+
+        Expects tree structure such as:
+        child: <class 'queryparser.adql.ADQLParser.ADQLParser.Sort_specificationContext'> - ra
+        child: <class 'antlr4.tree.Tree.TerminalNodeImpl'> - ,
+        child: <class 'queryparser.adql.ADQLParser.ADQLParser.Sort_specificationContext'> - decDESC
+
+        Sort_specificationContext nodes are then parsed to extract column and ASC/DESC.
+        """
+        tokens = []
+        for child in node.children:
+            # Only interested in non-terminal nodes
+            if hasattr(child, "children"):
+                for grandchild in child.children:
+                    # Here is where we expect to find column names and ASC/DESC
+                    if hasattr(grandchild, "getText"):
+                        text = grandchild.getText().strip()
+                        if text and text not in (",", "ORDER", "BY"):
+                            tokens.append(text)
+        return tokens
+
+    def enterOrder_by_clause(self, ctx):
+        """Parse ORDER BY clause into a list of (column, asc_bool) tuples."""
+        order_by_list = self._extract_sort_tokens(ctx)
+
+        # Arrange into (column, asc_bool) tuples
+        order_by_tuples = []
+        i = 0
+        while i < len(order_by_list):
+            col = self._unquote_identifier(order_by_list[i])
+            asc = True  # Default to ascending
+            if i + 1 < len(order_by_list):
+                next_token = order_by_list[i + 1].upper()
+                if next_token == "ASC":
+                    asc = True
+                    i += 1  # Skip next token
+                elif next_token == "DESC":
+                    asc = False
+                    i += 1  # Skip next token
+            order_by_tuples.append((col, asc))
+            i += 1
+
+        # Store into entities
+        self.entities["order_by"] = order_by_tuples
+
+    def get_entities(self):
+        return self.entities
+
+
+def parse_adql_tree(adql: str):
+    """
+    Parse an ADQL query into an ANTLR parse tree.
+
+    The query is parsed with SLL prediction first, which ANTLR can answer from
+    its DFA cache, and only if that fails, again with full LL prediction, which
+    is slower and not cached but needed for some inputs. Both give the same
+    tree for valid queries, and the LL pass reports syntax errors.
+
+    Returns:
+        tuple: The parser and the root (``query``) context of the tree
+
+    Raises:
+        QuerySyntaxError: If the query is not valid ADQL
+    """
+    # Normalized the same way as by queryparser's ADQLQueryTranslator
+    query = adql.lstrip("\n").rstrip().rstrip(";") + ";"
+    stream = antlr4.CommonTokenStream(ADQLLexer(antlr4.InputStream(query)))
+    parser = ADQLParser(stream)
+
+    parser._interp.predictionMode = PredictionMode.SLL
+    parser._errHandler = BailErrorStrategy()
+    parser.removeErrorListeners()
+    try:
+        return parser, parser.query()
+    except ParseCancellationException:
+        pass
+
+    stream.seek(0)
+    parser.reset()
+    parser._interp.predictionMode = PredictionMode.LL
+    parser._errHandler = DefaultErrorStrategy()
+    syntax_errors = SyntaxErrorListener()
+    parser.addErrorListener(syntax_errors)
+    tree = parser.query()
+    if syntax_errors.syntax_errors:
+        raise QuerySyntaxError(syntax_errors.syntax_errors)
+    return parser, tree
+
+
+def extract_entities(adql: str) -> dict:
+    """Parse an ADQL query and walk its tree with an LSDBFormatListener."""
+    parser, tree = parse_adql_tree(adql)
+    listener = LSDBFormatListener(parser)
+    antlr4.ParseTreeWalker().walk(listener, tree)
+    return listener.get_entities()
+
+
+# Queries parsed by warm_up(): one per kind of clause the listener supports
+WARM_UP_QUERIES = (
+    """
+    SELECT TOP 10 source_id, ra, dec, phot_g_mean_mag
+    FROM gaia_dr3.gaia
+    WHERE 1 = CONTAINS(POINT('ICRS', ra, dec), CIRCLE('ICRS', 270.0, 23.0, 0.25))
+    AND phot_g_mean_mag < 16
+    ORDER BY phot_g_mean_mag
+    """,
+    """
+    SELECT source_id, ra, dec FROM gaia_dr3.gaia
+    WHERE 1 = CONTAINS(POINT('ICRS', ra, dec), POLYGON('ICRS', 10, -5, 12, -5, 12, -3, 10, -3))
+    """,
+    """
+    SELECT source_id, ra, dec, parallax FROM gaia_dr3.gaia
+    WHERE ra BETWEEN 10 AND 20 AND dec > -5
+    AND (parallax >= 1.5 OR NOT phot_variable_flag = 'VARIABLE')
+    AND "_healpix_29" IN (1, 2, 3)
+    ORDER BY parallax DESC, ra
+    """,
+    """
+    SELECT phot_variable_flag, COUNT(*), AVG(phot_g_mean_mag), MIN(parallax), MAX(parallax), SUM(parallax)
+    FROM gaia_dr3.gaia WHERE phot_g_mean_mag < 12
+    GROUP BY phot_variable_flag
+    """,
+    """
+    SELECT a.source_id, b.source_id FROM gaia_dr3.gaia AS a
+    JOIN gaia_dr3.gaia AS b
+    ON 1 = CONTAINS(POINT('ICRS', a.ra, a.dec), CIRCLE('ICRS', b.ra, b.dec, 0.001))
+    WHERE a.phot_g_mean_mag < 10
+    """,
+    """
+    SELECT a.source_id, b.ra FROM gaia_dr3.gaia AS a
+    JOIN gaia_dr3.gaia AS b ON a.source_id = b.source_id
+    """,
+)
+
+
+def warm_up(queries=WARM_UP_QUERIES):
+    """Parse queries, filling ANTLR's prediction caches."""
+    for query in queries:
+        parse_adql_tree(query)
+
+
+def _parser_state_version() -> dict:
+    """What a saved parser state is only valid for: the runtime and the exact grammar."""
+    grammar = hashlib.sha256()
+    for recognizer in _RECOGNIZERS.values():
+        grammar.update(repr(sys.modules[recognizer.__module__].serializedATN()).encode())
+    return {
+        "antlr4": importlib.metadata.version("antlr4-python3-runtime"),
+        "queryparser": importlib.metadata.version("queryparser-python3"),
+        "grammar": grammar.hexdigest(),
+    }
+
+
+# The recognizers whose DFA caches make up the parser state
+_RECOGNIZERS = {"lexer": ADQLLexer, "parser": ADQLParser}
+
+# A saved parser state starts with this line and a JSON line of _parser_state_version(),
+# both checked before anything is unpickled
+_PARSER_STATE_MAGIC = b"ADQL-PARSER-STATE 1\n"
+
+
+class _ParserStatePickler(pickle.Pickler):
+    """
+    Pickles DFA states without the grammar they point into.
+
+    ATN states are saved by number, and the singletons which ANTLR compares
+    by identity by name, to be swapped for the live objects when loading.
+    """
+
+    def __init__(self, file, atn_owner):
+        super().__init__(file, protocol=pickle.HIGHEST_PROTOCOL)
+        self.atn_owner = atn_owner
+
+    def persistent_id(self, obj):
+        if obj is SemanticContext.NONE:
+            return ("semantic_context_none",)
+        if obj is PredictionContext.EMPTY:
+            return ("prediction_context_empty",)
+        owner = self.atn_owner.get(id(obj))
+        if owner is not None:
+            return ("atn_state", owner, obj.stateNumber)
+        return None
+
+
+class _ParserStateUnpickler(pickle.Unpickler):
+    def find_class(self, module, name):
+        # DFA states only hold ANTLR objects
+        if module != "antlr4" and not module.startswith("antlr4."):
+            raise pickle.UnpicklingError(f"Unexpected class in parser state: {module}.{name}")
+        return super().find_class(module, name)
+
+    def persistent_load(self, pid):
+        if pid[0] == "semantic_context_none":
+            return SemanticContext.NONE
+        if pid[0] == "prediction_context_empty":
+            return PredictionContext.EMPTY
+        if pid[0] == "atn_state":
+            _, owner, state_number = pid
+            return _RECOGNIZERS[owner].atn.states[state_number]
+        raise pickle.UnpicklingError(f"Unknown persistent id: {pid!r}")
+
+
+def save_parser_state(path: str):
+    """
+    Save the lexer's and parser's DFA caches to path.
+
+    Call it after parsing a representative set of queries (e.g. with
+    ``warm_up``); the caches only hold predictions for input seen so far.
+    """
+    atn_owner = {
+        id(state): name for name, recognizer in _RECOGNIZERS.items() for state in recognizer.atn.states
+    }
+    dfas = {
+        name: [(dfa.s0, list(dfa._states)) for dfa in recognizer.decisionsToDFA]
+        for name, recognizer in _RECOGNIZERS.items()
+    }
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as file:
+        file.write(_PARSER_STATE_MAGIC)
+        file.write(json.dumps(_parser_state_version()).encode() + b"\n")
+        _ParserStatePickler(file, atn_owner).dump(dfas)
+    os.replace(tmp_path, path)
+
+
+def load_parser_state(path: str) -> bool:
+    """
+    Load DFA caches saved by ``save_parser_state`` into the lexer and parser.
+
+    The caches are shared by all parsers of the process, so this is best done
+    before the first query. A file which is not a saved state, or a state saved
+    with another ANTLR runtime or grammar version, is ignored.
+
+    The state is a pickle, so only load files you trust, e.g. written by your own
+    deployment and not writable by others: although only ANTLR classes are
+    allowed in it, unpickling a crafted file may still run code.
+
+    Returns:
+        bool: Whether the state was loaded
+    """
+    with open(path, "rb") as file:
+        if file.read(len(_PARSER_STATE_MAGIC)) != _PARSER_STATE_MAGIC:
+            return False
+        try:
+            version = json.loads(file.readline())
+        except ValueError:
+            return False
+        if version != _parser_state_version():
+            return False
+        dfas = _ParserStateUnpickler(file).load()
+    for name, recognizer in _RECOGNIZERS.items():
+        if len(dfas[name]) != len(recognizer.decisionsToDFA):
+            return False
+    for name, recognizer in _RECOGNIZERS.items():
+        for dfa, (s0, states) in zip(recognizer.decisionsToDFA, dfas[name]):
+            dfa.s0 = s0
+            dfa._states = {state: state for state in states}
+    return True
@@ -17,530 +17,1451 @@ return q.head(15)
 """
 
 import argparse
+import hashlib
+import json
+import math
+import os
+import re
 import sys
-from queryparser.adql.adqltranslator import ADQLQueryTranslator, FormatListener, SelectQueryListener
-from antlr4 import ParseTreeWalker
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, field, replace
 
+# Environment variable naming a file saved with --save-parser-state, loaded
+# before the first query is parsed; it is unpickled, so it must be trusted
+PARSER_STATE_ENV = "ADQL_TO_LSDB_PARSER_STATE"
 
-class LSDBFormatListener(FormatListener):
+# The ANTLR parser (adql_parser) is only imported when the first query is
+# parsed, so that e.g. --help, plan execution and cached translations do not
+# pay for loading it.
+_adql_parser_module = None
+_adql_parser_lock = threading.Lock()
+
+
+def _adql_parser():
+    """Import adql_parser, loading the parser state named by PARSER_STATE_ENV on first use."""
+    global _adql_parser_module
+    with _adql_parser_lock:
+        if _adql_parser_module is None:
+            import adql_parser
+
+            state_path = os.environ.get(PARSER_STATE_ENV)
+            if state_path and os.path.exists(state_path):
+                adql_parser.load_parser_state(state_path)
+            _adql_parser_module = adql_parser
+    return _adql_parser_module
+
+
+def __getattr__(name):
+    # The listener and its constants moved to adql_parser; keep them importable from here
+    if name in ("LSDBFormatListener", "AGGREGATE_FUNCTIONS", "MAX_DNF_TERMS"):
+        return getattr(_adql_parser(), name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def parse_adql_entities(adql: str) -> dict:
+    """
+    Parse ADQL query and extract the five entities of interest:
+    - tables: List of table names (simple FROM clauses only)
+    - columns: List of column names
+    - spatial_search: Spatial search parameters (e.g., ConeSearch)
+    - conditions: List of filter conditions
+    - limits: Row limit information
+
+    Returns:
+        dict: Dictionary containing the extracted entities
+
+    Raises:
+        NotImplementedError: If unsupported SQL constructs are found
+    """
+    adql_parser = _adql_parser()
+    try:
+        return adql_parser.extract_entities(adql)
+    except NotImplementedError as e:
+        raise NotImplementedError(f"ADQL parsing failed: {e}")
+    except Exception as e:
+        raise ValueError(f"Failed to parse ADQL query: {e}")
+
+
+@dataclass(frozen=True)
+class QueryCost:
     """
-    Listens to parsing events from a known subset of ADQL, building up the data in these
-    events into data for parameters to LSDB.  These include:
+    Static estimate of what a translated query touches.
 
-    - Tables to catalogs -> gaia_dr3.gaia -> "https://lsdb.data/io/hats/gaia_dr3/gaia/"
-    - Columns to columns -> SELECT source_id, ra, dec -> columns=["source_id", "ra", "dec"]
-    - CONTAINS(POINT(...), CIRCLE(...))  -> lsdb.ConeSearch(...)
-      - or, CONTAINS(POINT(...), POLYGON(...)) -> lsdb.PolygonSearch(...)
-    - Basic conditions (e.g. phot_g_mean_mag < 10) -> filters= or cat.query(...)
-    - Limits (e.g. TOP 10) -> q.head(limit)
+    Rows and bytes are those of the partitions the search filter selects; WHERE
+    filters, which may skip row groups, are not taken into account. For a JOIN,
+    the numbers of both catalogs are added up. A bare COUNT(*) is answered from
+    the catalog metadata, so it touches no partitions.
     """
 
-    def __init__(self, parser, contexts, limit_contexts):
-        super().__init__(parser, contexts, limit_contexts)
-        self.entities = {
-            "tables": [],
-            "columns": [],
-            "spatial_search": None,
-            "conditions": [],
-            "limits": None,
-            "order_by": [],
+    n_partitions: int
+    # Rows in the selected partitions
+    n_rows: int
+    # Rows expected within the search region, assuming uniform density within partitions
+    estimated_rows: int
+    # Compressed bytes per column read
+    column_bytes: dict[str, int]
+
+    @property
+    def total_bytes(self) -> int:
+        return sum(self.column_bytes.values())
+
+    def to_dict(self) -> dict:
+        return {
+            "n_partitions": self.n_partitions,
+            "n_rows": self.n_rows,
+            "estimated_rows": self.estimated_rows,
+            "column_bytes": self.column_bytes,
+            "total_bytes": self.total_bytes,
         }
-        # Track parsing context
-        self._in_contains = False
-        self._current_point = None
-        self._current_circle = None
-        self._current_polygon = None
-        # Track WHERE clause parsing
-        self._in_where = False
-        self._current_conditions = []
-
-    def enterContains(self, ctx):
-        """Enter a CONTAINS clause - set context flag."""
-        self._in_contains = True
-        self._current_point = None
-        self._current_circle = None
-        self._current_polygon = None
-
-    def exitContains(self, ctx):
-        """Exit CONTAINS clause - validate and store spatial search info."""
-        if not self._in_contains:
-            return
 
-        # Validate that we have both POINT and CIRCLE, or POINT and POLYGON
-        if not self._current_point:
-            raise NotImplementedError("CONTAINS clause must include a POINT")
-        if not self._current_circle and not self._current_polygon:
-            raise NotImplementedError("CONTAINS clause must include a CIRCLE or POLYGON")
-
-        # Store spatial search information
-        if self._current_circle:
-            self.entities["spatial_search"] = {
-                "type": "ConeSearch",
-                "ra": self._current_circle["ra"],
-                "dec": self._current_circle["dec"],
-                "radius": self._current_circle["radius"],
-            }
-        elif self._current_polygon:
-            self.entities["spatial_search"] = {
-                "type": "PolygonSearch",
-                "coordinates": self._current_polygon["coordinates"],
-            }
 
-        # Reset context
-        self._in_contains = False
-        self._current_point = None
-        self._current_circle = None
-        self._current_polygon = None
+def estimate_query_cost(query: "str | LSDBQueryPlan", catalog=None) -> QueryCost:
+    """
+    Estimate the partitions, rows and compressed bytes a query will touch.
+
+    Only the catalog's partition info and Parquet metadata (_metadata) are read,
+    no data pages.
+
+    Args:
+        query: ADQL query, or a plan translated from one
+        catalog: the HATS catalog (from read_hats_catalog) to use instead of
+            reading the plan's catalog_url, e.g. when estimating many queries
+
+    Returns:
+        QueryCost: partitions, rows and bytes per column
+    """
+    import hats.pixel_math.healpix_shim as hp
+
+    plan = adql_to_lsdb_plan(query) if isinstance(query, str) else query
+    if plan.is_metadata_count:
+        return QueryCost(n_partitions=0, n_rows=0, estimated_rows=0, column_bytes={})
+    if catalog is None:
+        catalog = read_hats_catalog(plan.catalog_url)
+    stats = partition_parquet_stats(catalog)
+
+    pixels = catalog.get_healpix_pixels()
+    if plan.search_filter is not None:
+        pixels = plan.search_filter.to_lsdb().filter_hc_catalog(catalog).get_healpix_pixels()
+    selected = {pixel: stats.get(pixel, (0, {})) for pixel in pixels}
+    n_rows = sum(rows for rows, _ in selected.values())
+
+    estimated_rows = n_rows
+    if hasattr(plan.search_filter, "area") and selected:
+        partitions_area = sum(hp.order2pixarea(pixel.order) for pixel in selected)
+        estimated_rows = round(n_rows * min(1.0, plan.search_filter.area() / partitions_area))
+
+    cost = QueryCost(
+        n_partitions=len(selected),
+        n_rows=n_rows,
+        estimated_rows=estimated_rows,
+        column_bytes=sum_column_bytes(selected, plan.read_columns or None),
+    )
+    if plan.join is None:
+        return cost
+
+    # For a JOIN, add up what is read from both catalogs
+    right = estimate_query_cost(plan.join.right)
+    left_suffix, right_suffix = plan.join.suffixes
+    return QueryCost(
+        n_partitions=cost.n_partitions + right.n_partitions,
+        n_rows=cost.n_rows + right.n_rows,
+        estimated_rows=cost.estimated_rows + right.estimated_rows,
+        column_bytes={
+            **{f"{col}{left_suffix}": size for col, size in cost.column_bytes.items()},
+            **{f"{col}{right_suffix}": size for col, size in right.column_bytes.items()},
+        },
+    )
 
-    def enterPoint(self, ctx):
-        """Parse POINT('ICRS', ra, dec) within CONTAINS."""
-        if not self._in_contains:
-            return  # Ignore points outside CONTAINS
 
-        # Extract arguments from the parsed context
-        args = self._extract_function_args_from_context(ctx)
-        assert args.pop(0).upper() == "POINT"
+# Tokens of an ADQL query, used to build cache keys. Order matters: string
+# literals and quoted identifiers must win over anything they may contain,
+# and identifiers must win over numbers so "gaia_dr3" stays a single token.
+# As in the ADQL grammar, an exponent is only allowed after a decimal point.
+_ADQL_TOKEN_RE = re.compile(
+    r"""
+    (?P<string>'(?:[^']|'')*')
+    | (?P<quoted>"(?:[^"]|"")*")
+    | (?P<word>[A-Za-z_][A-Za-z0-9_]*)
+    | (?P<number>(?:\d+\.\d*|\.\d+)(?:[eE][+-]?\d+)?|\d+)
+    | (?P<op><=|>=|<>|!=|\|\||\S)
+    """,
+    re.VERBOSE,
+)
+
+# Keywords are case-insensitive in ADQL, identifiers are kept as written
+# because they end up verbatim in the generated code.
+_ADQL_KEYWORDS = frozenset(
+    """
+    ALL AND AS ASC BETWEEN BOX BY CIRCLE CONTAINS DESC DISTINCT EXISTS FROM
+    GROUP HAVING IN INTERSECTS IS JOIN LIKE NOT NULL OFFSET ON OR ORDER POINT
+    POLYGON SELECT TOP WHERE
+    """.split()
+)
 
-        if len(args) != 3:
-            raise ValueError(f"POINT function expects 3 arguments, got {len(args)}")
+# Numeric literals are replaced by these sentinels when a query template is
+# parsed, so they can be traced through the listener back to their slot.
+# The base is moved up for templates whose text already contains a sentinel.
+_SENTINEL_BASE = 900_000_000
+_SENTINEL_STEP = 100_000_000
 
-        coord_system = args[0].strip("'\"")
-        if coord_system.upper() != "ICRS":
-            raise NotImplementedError(f"Only 'ICRS' coordinate system is supported, got '{coord_system}'")
 
-        try:
-            # These should match the RA, DEC columns from SELECT, but
-            # we can ignore this sort of validation for now.
-            pass
-        except ValueError as e:
-            raise ValueError(f"Invalid coordinates in POINT: {e}")
+def _tokenize_adql(adql: str):
+    """Yield (kind, text, start, end) for every token of an ADQL string."""
+    for match in _ADQL_TOKEN_RE.finditer(adql):
+        kind = match.lastgroup
+        yield kind, match.group(kind), match.start(), match.end()
 
-        # Again, these don't matter *yet* and would only matter for query validation.
-        self._current_point = {"ra": "ra", "dec": "dec"}
 
-    def enterCircle(self, ctx):
-        """Parse CIRCLE('ICRS', ra, dec, radius) within CONTAINS."""
-        if not self._in_contains:
-            return  # Ignore circles outside CONTAINS
+def normalize_adql(adql: str, *, parameterize: bool = False):
+    """
+    Normalize an ADQL query for use as a cache key.
 
-        # Extract arguments from the parsed context
-        args = self._extract_function_args_from_context(ctx)
-        assert args.pop(0).upper() == "CIRCLE"
+    Whitespace is collapsed and keywords are upper-cased; string literals and
+    identifiers are left untouched. With ``parameterize=True`` numeric literals
+    (except the TOP value, which is part of the query shape) are replaced by
+    ``?`` and returned separately.
 
-        if len(args) != 4:
-            raise ValueError(f"CIRCLE function expects 4 arguments, got {len(args)}")
+    Returns:
+        tuple: (normalized query, list of (start, end, text) for each literal
+        that was parameterized out)
+    """
+    key_tokens = []
+    literals = []
+    previous = None
+    for kind, text, start, end in _tokenize_adql(adql.strip().rstrip(";")):
+        if kind == "word" and text.upper() in _ADQL_KEYWORDS:
+            text = text.upper()
+        elif kind == "number" and parameterize and previous != "TOP":
+            literals.append((start, end, text))
+            text = "?"
+        key_tokens.append(text)
+        previous = text
+    return " ".join(key_tokens), literals
+
+
+def _sentinel_base(key: str, n_literals: int) -> int:
+    """
+    The smallest sentinel base whose sentinels do not occur in the normalized query.
 
-        coord_system = args[0].strip("'\"")
-        if coord_system.upper() != "ICRS":
-            raise NotImplementedError(f"Only 'ICRS' coordinate system is supported, got '{coord_system}'")
+    Otherwise a quoted string or the TOP value equal to a sentinel, which stays
+    in the query key, would be bound to a literal too.
+    """
+    base = _SENTINEL_BASE
+    while any(str(base + slot) in key for slot in range(n_literals)):
+        base += _SENTINEL_STEP
+    return base
 
-        try:
-            ra = float(args[1])
-            dec = float(args[2])
-            radius = float(args[3])
-        except ValueError as e:
-            raise ValueError(f"Invalid values in CIRCLE: {e}")
 
-        self._current_circle = {"ra": ra, "dec": dec, "radius": radius}
+def _dedupe(items: list) -> list:
+    """Drop repeated items, keeping the first ones in order; items may be unhashable."""
+    result = []
+    for item in items:
+        if item not in result:
+            result.append(item)
+    return result
 
-    def enterPolygon(self, ctx):
-        """Parse POLYGON('ICRS', x1, y1, x2, y2, ..., xn, yn) within CONTAINS."""
-        if not self._in_contains:
-            return  # Ignore polygons outside CONTAINS
 
-        # Extract arguments from the parsed context
-        args = self._extract_function_args_from_context(ctx)
-        assert args.pop(0).upper() == "POLYGON"
+def _normalize_conditions(entities: dict) -> dict:
+    """
+    Drop conditions and OR-ed terms which became duplicates once literals were bound.
 
-        if len(args) < 4 or len(args) % 2 == 0:
-            raise ValueError(f"POLYGON function expects an odd number of arguments >= 4, got {len(args)}")
+    Every sentinel of a template is distinct, so the parser can't drop them as it
+    does for e.g. ``x = 1 OR x = 1``; this makes bound entities equal to parsed ones.
+    """
+    conditions = entities.get("conditions")
+    if not conditions:
+        return entities
+    if is_dnf(conditions):
+        dnf = _dedupe([_dedupe(conjunction) for conjunction in conditions])
+        # A single AND-list is stored as such, see LSDBFormatListener.exitWhere_clause
+        conditions = dnf[0] if len(dnf) == 1 else dnf
+    else:
+        conditions = _dedupe(conditions)
+    return dict(entities, conditions=conditions)
 
-        coord_system = args[0].strip("'\"")
-        if coord_system.upper() != "ICRS":
-            raise NotImplementedError(f"Only 'ICRS' coordinate system is supported, got '{coord_system}'")
 
-        try:
-            coordinates = []
-            for i in range(1, len(args), 2):
-                ra = float(args[i])
-                dec = float(args[i + 1])
-                coordinates.append((ra, dec))
-        except ValueError as e:
-            raise ValueError(f"Invalid values in POLYGON: {e}")
-
-        self._current_polygon = {"coordinates": coordinates}
-
-    def _extract_function_args_from_context(self, ctx):
-        """Extract function arguments from ANTLR context by traversing the parse tree."""
-        args = []
-
-        # Walk through the children of the context
-        for child in ctx.children:
-            # Look for terminal nodes that represent the actual values
-            if hasattr(child, "children"):
-                # This is a non-terminal, recurse into it
-                args.extend(self._extract_values_from_node(child))
-            else:
-                # Never mind punctuation like commas or parentheses
-                if (text := str(child)) not in ("(", ")", ","):
-                    args.append(text)
+def _bind_literals(template, literals, base: int = _SENTINEL_BASE):
+    """
+    Replace sentinels in a parsed template with the query's literal values.
 
-        # Merge unary signs with following numeric tokens (e.g., '-', '10.5' -> '-10.5')
-        args = self._merge_unary_signs(args)
-        return args
+    Always returns fresh containers, so the cached template is never shared.
+    """
 
-    def _extract_values_from_node(self, node):
-        """Recursively extract values from a parse tree node."""
-        values = []
+    def literal_for(value):
+        magnitude = abs(value)
+        if not math.isfinite(magnitude) or magnitude != int(magnitude):
+            return None
+        slot = int(magnitude) - base
+        if 0 <= slot < len(literals):
+            return slot
+        return None
 
-        if hasattr(node, "children"):
-            for child in node.children:
-                values.extend(self._extract_values_from_node(child))
-        else:
-            # Terminal node
-            # Never mind punctuation like commas or parentheses
-            if (text := str(node)) not in ("(", ")", ","):
-                values.append(text)
+    def bind(value):
+        if isinstance(value, dict):
+            return {key: bind(item) for key, item in value.items()}
+        if isinstance(value, list):
+            return [bind(item) for item in value]
+        if isinstance(value, tuple):
+            return tuple(bind(item) for item in value)
+        if isinstance(value, bool):
+            return value
+        if isinstance(value, (int, float)):
+            slot = literal_for(value)
+            if slot is None:
+                return value
+            text = literals[slot][2]
+            sign = -1 if value < 0 else 1
+            if isinstance(value, float):
+                return sign * float(text)
+            # Mirror LSDBFormatListener._parse_value for integer-looking tokens
+            try:
+                return sign * (int(text) if "." not in text else float(text))
+            except ValueError:
+                return f"-{text}" if sign < 0 else text
+        if isinstance(value, str):
+            sign, digits = ("-", value[1:]) if value.startswith("-") else ("", value)
+            if digits.isdigit():
+                slot = literal_for(int(digits))
+                if slot is not None:
+                    return sign + literals[slot][2]
+            return value
+        return value
+
+    return bind(template)
+
+
+class ADQLParseCache:
+    """
+    Bounded LRU cache of parsed ADQL entities.
 
-        return values
+    Queries are keyed on their normalized text (see ``normalize_adql``). With
+    ``parameterize=True`` numeric literals are parsed out of the key, so e.g.
+    ``CIRCLE('ICRS', 10, 20, 1)`` and ``CIRCLE('ICRS', 11, 21, 1)`` share a
+    single parse, and the literal values are bound into the cached template on
+    each lookup. Safe to share between threads.
+
+    Misses are parsed with ``parse`` (default: ``parse_adql_entities``), which
+    may e.g. hand the query to a pool of worker processes.
+    """
 
-    def _merge_unary_signs(self, tokens):
+    def __init__(self, maxsize: int = 256, *, parameterize: bool = True, parse=None):
+        if maxsize <= 0:
+            raise ValueError(f"maxsize must be positive, got {maxsize}")
+        self.maxsize = maxsize
+        self.parameterize = parameterize
+        self.parse = parse or parse_adql_entities
+        self.hits = 0
+        self.misses = 0
+        self._templates = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._templates)
+
+    def stats(self) -> dict:
+        """Return hit/miss counters and current size."""
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self._templates), "maxsize": self.maxsize}
+
+    def clear(self):
+        """Drop all cached templates and reset the counters."""
+        with self._lock:
+            self._templates.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def get_entities(self, adql: str) -> dict:
         """
-        Merge unary '+' or '-' tokens with immediately following numeric tokens,
-        turning ['-', '10.5'] into ['-10.5'] so downstream parsing sees signed numbers.
+        Return the entities for ``adql``, parsing it only on a cache miss.
+
+        Raises the same exceptions as ``parse_adql_entities``; failed parses are
+        not cached.
         """
-        merged = []
-        i = 0
-        while i < len(tokens):
-            t = tokens[i]
-            if t in ("-", "+") and i + 1 < len(tokens) and self._looks_like_number(tokens[i + 1]):
-                merged.append(t + tokens[i + 1])
-                i += 2
+        key, literals = normalize_adql(adql, parameterize=self.parameterize)
+        with self._lock:
+            template = self._templates.get(key)
+            if template is not None:
+                self._templates.move_to_end(key)
+                self.hits += 1
             else:
-                merged.append(t)
-                i += 1
-        return merged
+                self.misses += 1
+        if template is not None:
+            base, entities = template
+            return _normalize_conditions(_bind_literals(entities, literals, base))
 
-    def _looks_like_number(self, s: str) -> bool:
+        base = _sentinel_base(key, len(literals))
         try:
-            float(s)
-            return True
-        except ValueError:
-            return False
+            entities = self.parse(self._template_query(adql, literals, base))
+        except (NotImplementedError, ValueError):
+            # Sentinel values may trip a check the real literals would not
+            # (or vice versa); parse the query as-is and don't cache it.
+            if not literals:
+                raise
+            return self.parse(adql)
 
-    def enterSelect_list(self, ctx):
-        """Parse the SELECT list to extract column names."""
-        # Extract column names from the SELECT clause
-        columns = self._extract_select_columns(ctx)
-        self.entities["columns"].extend(columns)
+        with self._lock:
+            self._templates[key] = (base, entities)
+            self._templates.move_to_end(key)
+            while len(self._templates) > self.maxsize:
+                self._templates.popitem(last=False)
+        return _normalize_conditions(_bind_literals(entities, literals, base))
 
-    def _extract_select_columns(self, ctx):
-        """Extract column names from a SELECT list context."""
-        columns = []
+    @staticmethod
+    def _template_query(adql, literals, base=_SENTINEL_BASE):
+        """Substitute each parameterized literal with its slot sentinel."""
+        adql = adql.strip().rstrip(";")
+        pieces = []
+        position = 0
+        for slot, (start, end, _text) in enumerate(literals):
+            pieces.append(adql[position:start])
+            pieces.append(str(base + slot))
+            position = end
+        pieces.append(adql[position:])
+        return "".join(pieces)
 
-        # Walk through the children to find column references
-        for child in ctx.children:
-            if hasattr(child, "children"):
-                # This might be a select_sublist or derived_column
-                column_name = self._extract_column_name(child)
-                if column_name:
-                    columns.append(column_name)
 
-        return columns
+# Shared by adql_to_lsdb() unless the caller passes its own cache.
+parse_cache = ADQLParseCache()
 
-    def _extract_column_name(self, node):
-        """
-        Extract a column name from a parse tree node.
-        Handles simple column names and ignores complex expressions.
-        """
-        # For now, only handle simple column references
-        # Get the text and clean it up
-        text = node.getText().strip()
 
-        # Skip if it's a comma or other punctuation
-        if text in [",", "(", ")", "*"]:
-            return None
+@dataclass(frozen=True)
+class ConeSearchSpec:
+    """A cone search, mirroring lsdb.ConeSearch."""
 
-        # Handle SELECT * case
-        if text == "*":
-            return "*"
+    ra: float
+    dec: float
+    radius_arcsec: float
 
-        # For simple column names, just return the text
-        # In a more complete implementation, we'd need to handle:
-        # - table.column references
-        # - aliased columns (column AS alias)
-        # - function calls
-        # - expressions
+    def to_lsdb(self):
+        import lsdb
 
-        # Skip SQL keywords that might appear
-        if text.upper() in ["SELECT", "FROM", "WHERE", "TOP", "DISTINCT"]:
-            return None
+        return lsdb.ConeSearch(ra=self.ra, dec=self.dec, radius_arcsec=self.radius_arcsec)
 
-        return text
-
-    def enterSet_limit(self, ctx):
-        """Extract limit from SET LIMIT clause using pre-parsed limit_contexts."""
-        # The SelectQueryListener has already extracted the limit information
-        # limit_contexts is a dictionary where values contain the limit info
-        if self.limit_contexts:
-            for limit_text in self.limit_contexts.values():
-                # Extract number specifically from LIMIT/TOP clause patterns
-                import re
-
-                # Match "LIMIT n" or "TOP n" patterns specifically
-                match = re.search(r"(?:LIMIT|TOP)\s+(\d+)", limit_text, re.IGNORECASE)
-                if match:
-                    try:
-                        limit_value = int(match.group(1))
-                        if limit_value <= 0:
-                            raise ValueError(f"TOP/LIMIT must be positive, got {limit_value}")
-                        self.entities["limits"] = limit_value
-                        return
-                    except ValueError as e:
-                        raise ValueError(f"Invalid TOP/LIMIT value: {e}")
-
-    def enterWhere_clause(self, ctx):
-        """Enter WHERE clause - start parsing conditions."""
-        self._in_where = True
-        self._current_conditions = []
-
-    def exitWhere_clause(self, ctx):
-        """Exit WHERE clause - finalize condition parsing."""
-        if self._in_where:
-            # Store conditions in simple format for AND-only cases
-            if self._current_conditions:
-                # For simple AND conditions, store as single list
-                # When we add OR support, we'll use full DNF: [[cond1, cond2], [cond3, cond4]]
-                self.entities["conditions"] = self._current_conditions
-
-            # Reset context
-            self._in_where = False
-            self._current_conditions = []
-
-    def enterComparison_predicate(self, ctx):
-        """Parse comparison predicates like 'column < value'."""
-        if not self._in_where:
-            return  # Only process comparisons within WHERE clause
-
-        # Skip CONTAINS comparisons - they're handled separately
-        comparison_text = ctx.getText().upper()
-        if "CONTAINS" in comparison_text:
-            return
+    def to_code(self) -> str:
+        return f"lsdb.ConeSearch(ra={self.ra}, dec={self.dec}, radius_arcsec={self.radius_arcsec})"
 
-        # Extract the comparison components
-        try:
-            condition = self._parse_comparison(ctx)
-            if condition:
-                self._current_conditions.append(condition)
-        except Exception as e:
-            print(f"Warning: Could not parse comparison '{ctx.getText()}': {e}")
+    def area(self) -> float:
+        """Area of the cone in steradians."""
+        return 2 * math.pi * (1 - math.cos(math.radians(self.radius_arcsec / 3600)))
 
-    def _parse_comparison(self, ctx):
-        """
-        Parse a comparison context into (column, operator, value) tuple.
 
-        Examples:
-        - 'phot_g_mean_mag < 10' -> ('phot_g_mean_mag', '<', 10)
-        - "phot_variable_flag = 'VARIABLE'" -> ('phot_variable_flag', '==', 'VARIABLE')
-        - 'dec >= -30' -> ('dec', '>=', -30)
-        """
-        # Get all tokens from the comparison
-        tokens = []
-        for child in ctx.children:
-            if hasattr(child, "getText"):
-                text = child.getText().strip()
-                if text:
-                    tokens.append(text)
-
-        # Merge unary signs so we treat ['-', '30'] as ['-30']
-        tokens = self._merge_unary_signs(tokens)
-
-        # Look for basic pattern: column operator value
-        if len(tokens) >= 3:
-            # Find the operator (typically in the middle)
-            sql_operators = ["<", ">", "<=", ">=", "=", "!=", "<>"]
-
-            for i, token in enumerate(tokens):
-                if token in sql_operators:
-                    if i > 0 and i < len(tokens) - 1:
-                        column = tokens[i - 1]
-                        py_operator = self._translate_operator(token)
-                        value = self._parse_value(tokens[i + 1])
-                        return (column, py_operator, value)
-        return None
+@dataclass(frozen=True)
+class PolygonSearchSpec:
+    """A polygon search, mirroring lsdb.PolygonSearch; vertices are (ra, dec) pairs."""
 
-    def _translate_operator(self, sql_operator):
-        """Translate SQL operators to Python operators."""
-        operator_map = {"=": "==", "<>": "!=", "!=": "!=", "<": "<", ">": ">", "<=": "<=", ">=": ">="}
-        return operator_map.get(sql_operator, sql_operator)
+    vertices: tuple[tuple[float, float], ...]
 
-    def _parse_value(self, value_text):
-        """Parse a value, handling strings, numbers (incl. negative and scientific), etc."""
-        # Remove quotes from string literals
-        if value_text.startswith("'") and value_text.endswith("'"):
-            return value_text[1:-1]  # Remove single quotes
-        if value_text.startswith('"') and value_text.endswith('"'):
-            return value_text[1:-1]  # Remove double quotes
+    def to_lsdb(self):
+        import lsdb
 
-        # Try to parse as number
-        try:
-            # Try integer first
-            if "." not in value_text:
-                return int(value_text)
-            else:
-                return float(value_text)
-        except ValueError:
-            # Return as string if not a number
-            return value_text
-
-    def enterFrom_clause(self, ctx):
-        """Extract table names from the FROM clause."""
-        # Check for unsupported constructs first
-        from_text = ctx.getText().upper()
-        unsupported_keywords = ["JOIN", "INNER", "LEFT", "RIGHT", "OUTER", "CROSS", "UNION"]
-
-        for keyword in unsupported_keywords:
-            if keyword in from_text:
-                raise NotImplementedError(
-                    f"Unsupported SQL construct '{keyword}' found in FROM clause. Only simple FROM table_name is supported."
-                )
+        return lsdb.PolygonSearch(list(self.vertices))
 
-        # Extract table name from simple FROM clause
-        # Look for the table name after FROM keyword
-        children_text = [child.getText() for child in ctx.children if hasattr(child, "getText")]
-
-        # Find the table name (should be after FROM and before any other keywords)
-        for i, text in enumerate(children_text):
-            if text.upper() == "FROM" and i + 1 < len(children_text):
-                table_name = children_text[i + 1]
-                # Clean up any trailing commas or whitespace
-                table_name = table_name.strip(",").strip()
-                if table_name and table_name.upper() not in ["WHERE", "ORDER", "GROUP", "HAVING"]:
-                    self.entities["tables"].append(table_name)
-                    break
-
-        return super().enterFrom_clause(ctx)
-
-    def _extract_sort_tokens(self, ctx):
-        """Extract sort tokens from an ORDER BY clause.
-
-        Parameters
-        ----------
-        ctx : ADQLParser.Order_by_clauseContext
-            The ORDER BY parse subtree.
-
-        Notes
-        -----
-        Expected tree shape, for example query "ORDER BY ra, dec DESC":
-
-            ORDER BY
-            └── Sort_specification_list  (text: "ra,decDESC")
-                ├── Sort_specification   (text: "ra")
-                │   └── Sort_key         (text: "ra")
-                ├── ','                  (comma)
-                └── Sort_specification   (text: "decDESC")
-                    ├── Sort_key         (text: "dec")
-                    └── Ordering_specification (text: "DESC")
-
-        Returns
-        -------
-        list of str
-            List of sort tokens in order, e.g. ['ra', 'dec', 'DESC']
-        """
-        sort_tokens = []
-        for child in ctx.children:
-            if hasattr(child, "children"):
-                # Non-terminal node
-                spec = self._parse_sort_specification(child)
-                sort_tokens.extend(spec)
-            else:
-                # Terminal node
-                text = child.getText().strip()
-                if text and text not in (",", "ORDER", "BY"):
-                    raise NotImplementedError(f"Unexpected terminal node in ORDER BY clause: '{text}'")
-        return sort_tokens
+    def to_code(self) -> str:
+        coord_list = ", ".join(f"({ra}, {dec})" for ra, dec in self.vertices)
+        return f"lsdb.PolygonSearch([{coord_list}])"
 
-    def _parse_sort_specification(self, node):
-        """Parse individual sort specification from the parse tree node.
 
-        Expects tree structure such as:
-        child: <class 'queryparser.adql.ADQLParser.ADQLParser.Sort_specificationContext'> - ra
-        child: <class 'antlr4.tree.Tree.TerminalNodeImpl'> - ,
-        child: <class 'queryparser.adql.ADQLParser.ADQLParser.Sort_specificationContext'> - decDESC
+@dataclass(frozen=True)
+class BoxSearchSpec:
+    """A box search, mirroring lsdb.BoxSearch; ranges are in degrees."""
 
-        Sort_specificationContext nodes are then parsed to extract column and ASC/DESC.
-        """
-        tokens = []
-        for child in node.children:
-            # Only interested in non-terminal nodes
-            if hasattr(child, "children"):
-                for grandchild in child.children:
-                    # Here is where we expect to find column names and ASC/DESC
-                    if hasattr(grandchild, "getText"):
-                        text = grandchild.getText().strip()
-                        if text and text not in (",", "ORDER", "BY"):
-                            tokens.append(text)
-        return tokens
-
-    def enterOrder_by_clause(self, ctx):
-        """Parse ORDER BY clause into a list of (column, asc_bool) tuples."""
-        order_by_list = self._extract_sort_tokens(ctx)
-
-        # Arrange into (column, asc_bool) tuples
-        order_by_tuples = []
-        i = 0
-        while i < len(order_by_list):
-            col = order_by_list[i]
-            asc = True  # Default to ascending
-            if i + 1 < len(order_by_list):
-                next_token = order_by_list[i + 1].upper()
-                if next_token == "ASC":
-                    asc = True
-                    i += 1  # Skip next token
-                elif next_token == "DESC":
-                    asc = False
-                    i += 1  # Skip next token
-            order_by_tuples.append((col, asc))
-            i += 1
-
-        # Store into entities
-        self.entities["order_by"] = order_by_tuples
-
-    def get_entities(self):
-        return self.entities
+    ra: tuple[float, float]
+    dec: tuple[float, float]
 
+    def to_lsdb(self):
+        import lsdb
 
-def parse_adql_entities(adql: str) -> dict:
+        return lsdb.BoxSearch(ra=self.ra, dec=self.dec)
+
+    def to_code(self) -> str:
+        return f"lsdb.BoxSearch(ra={self.ra}, dec={self.dec})"
+
+    def area(self) -> float:
+        """Area of the box in steradians."""
+        ra_width = (self.ra[1] - self.ra[0]) % 360 or 360
+        return math.radians(ra_width) * (math.sin(math.radians(self.dec[1])) - math.sin(math.radians(self.dec[0])))
+
+
+@dataclass(frozen=True)
+class PixelSearchSpec:
+    """A search for partitions overlapping HEALPix pixels, mirroring lsdb.PixelSearch."""
+
+    pixels: tuple[tuple[int, int], ...]
+
+    def to_lsdb(self):
+        import lsdb
+
+        return lsdb.PixelSearch(list(self.pixels))
+
+    def to_code(self) -> str:
+        return f"lsdb.PixelSearch({list(self.pixels)})"
+
+
+# Order 29 is the order of the _healpix_29 spatial index column; ranges of it
+# are only used to select partitions, so they are coarsened to this order.
+HEALPIX_29_ORDER = 29
+HEALPIX_29_COLUMN = "_healpix_29"
+PIXEL_SEARCH_MAX_ORDER = 12
+
+
+def _column_bounds(conditions, column: str):
     """
-    Parse ADQL query and extract the five entities of interest:
-    - tables: List of table names (simple FROM clauses only)
-    - columns: List of column names
-    - spatial_search: Spatial search parameters (e.g., ConeSearch)
-    - conditions: List of filter conditions
-    - limits: Row limit information
+    Collect lower and upper bounds on a column from an AND-list of conditions.
 
     Returns:
-        dict: Dictionary containing the extracted entities
+        tuple: ((lower, lower_inclusive), (upper, upper_inclusive)), where a
+        missing bound is None
+    """
+    lower = upper = None
+    for col, op, value in conditions:
+        if col.lower() != column or isinstance(value, str):
+            continue
+        if op in (">", ">=", "=="):
+            if lower is None or value > lower[0] or (value == lower[0] and op == ">"):
+                lower = (value, op != ">")
+        if op in ("<", "<=", "=="):
+            if upper is None or value < upper[0] or (value == upper[0] and op == "<"):
+                upper = (value, op != "<")
+    return lower, upper
+
+
+def healpix_29_range_to_pixels(low: int, high: int, max_order: int = PIXEL_SEARCH_MAX_ORDER):
+    """
+    Cover the inclusive range [low, high] of order-29 HEALPix indices with as
+    few pixels of order <= max_order as possible.
 
-    Raises:
-        NotImplementedError: If unsupported SQL constructs are found
+    The cover may be larger than the range, since indices are first coarsened
+    to max_order.
+
+    Returns:
+        list: (order, pixel) tuples
+    """
+    shift = 2 * (HEALPIX_29_ORDER - max_order)
+    low, high = low >> shift, high >> shift
+    pixels = []
+    while low <= high:
+        # Grow the cell while it stays aligned and within the range
+        k = 0
+        while k < max_order and low % (4 ** (k + 1)) == 0 and low + 4 ** (k + 1) - 1 <= high:
+            k += 1
+        pixels.append((max_order - k, low >> (2 * k)))
+        low += 4**k
+    return pixels
+
+
+def search_from_conditions(conditions) -> BoxSearchSpec | PixelSearchSpec | None:
     """
+    Recognize spatial predicates in an AND-list of conditions.
+
+    A bounded ``ra`` range (with an optional ``dec`` range) becomes a box search,
+    and a range of ``_healpix_29`` becomes a pixel search, so that partitions
+    outside of them are skipped before any file is read. The conditions are kept
+    as filters too: the search only needs to select a superset of the rows.
+    """
+    (ra_low, ra_high) = _column_bounds(conditions, "ra")
+    if ra_low is not None and ra_high is not None and 0 <= ra_low[0] < ra_high[0] <= 360:
+        dec_low, dec_high = _column_bounds(conditions, "dec")
+        dec = (
+            max(float(dec_low[0]), -90.0) if dec_low is not None else -90.0,
+            min(float(dec_high[0]), 90.0) if dec_high is not None else 90.0,
+        )
+        if dec[0] < dec[1]:
+            return BoxSearchSpec(ra=(float(ra_low[0]), float(ra_high[0])), dec=dec)
+
+    hp_low, hp_high = _column_bounds(conditions, "_healpix_29")
+    if hp_low is not None or hp_high is not None:
+        low = 0 if hp_low is None else int(hp_low[0]) + (not hp_low[1])
+        high = 12 * 4**HEALPIX_29_ORDER - 1 if hp_high is None else int(hp_high[0]) - (not hp_high[1])
+        if 0 <= low <= high:
+            return PixelSearchSpec(pixels=tuple(healpix_29_range_to_pixels(low, high)))
+
+    return None
+
+
+def read_hats_catalog(catalog_url: str):
+    """Read the properties and partition info of a HATS catalog, resolving a collection to its main catalog."""
+    import hats
+    from hats.catalog.catalog_collection import CatalogCollection
+
+    catalog = hats.read_hats(catalog_url)
+    if isinstance(catalog, CatalogCollection):
+        catalog = catalog.main_catalog
+    return catalog
+
+
+def read_catalog_properties(catalog_url: str):
+    """
+    Read the hats.properties of a catalog, or of the main catalog of a collection.
+
+    Unlike read_hats_catalog, the partition info is not read.
+    """
+    from hats.catalog.dataset.collection_properties import CollectionProperties
+    from hats.catalog.dataset.table_properties import TableProperties
+    from hats.io.file_io import get_upath
+
     try:
-        translator = ADQLQueryTranslator(adql)
-        walker = ParseTreeWalker()
-        select_query_listener = SelectQueryListener()
-        walker.walk(select_query_listener, translator.tree)
+        return TableProperties.read_from_dir(catalog_url)
+    except FileNotFoundError:
+        collection = CollectionProperties.read_from_dir(catalog_url)
+        return TableProperties.read_from_dir(get_upath(catalog_url) / collection.hats_primary_table_url)
+
+
+def partition_parquet_stats(catalog) -> dict:
+    """
+    Rows and compressed bytes per leaf column of every partition of a HATS catalog.
+
+    Everything comes from the row groups listed in the catalog's _metadata file,
+    so no data pages are read.
+
+    Returns:
+        dict: HealpixPixel -> (number of rows, {column path: compressed bytes})
+    """
+    from hats.io import file_io, paths
+
+    metadata = file_io.read_parquet_metadata(paths.get_parquet_metadata_pointer(catalog.catalog_base_dir))
+    stats = {}
+    for i in range(metadata.num_row_groups):
+        row_group = metadata.row_group(i)
+        pixel = paths.get_healpix_from_path(row_group.column(0).file_path)
+        rows, column_bytes = stats.get(pixel, (0, {}))
+        for j in range(row_group.num_columns):
+            chunk = row_group.column(j)
+            column_bytes[chunk.path_in_schema] = column_bytes.get(chunk.path_in_schema, 0) + chunk.total_compressed_size
+        stats[pixel] = (rows + row_group.num_rows, column_bytes)
+    return stats
+
+
+def _column_path_matches(path: str, column: str) -> bool:
+    """
+    Whether a Parquet leaf column path belongs to a column name.
+
+    Nested columns are stored as several leaf columns, e.g. "lc.list.element.mag"
+    for "lc.mag", and "lc" matches all of them.
+    """
+    top, _, sub = column.partition(".")
+    parts = path.split(".")
+    return parts[0] == top and (not sub or parts[-1] == sub)
+
+
+def sum_column_bytes(stats, columns=None) -> dict[str, int]:
+    """
+    Sum the compressed bytes of partition_parquet_stats per column.
+
+    Sizes are reported for the given columns, or for every top-level column if
+    columns is None.
+    """
+    leaf_bytes = {}
+    for _, column_bytes in stats.values():
+        for path, size in column_bytes.items():
+            leaf_bytes[path] = leaf_bytes.get(path, 0) + size
+    if columns is None:
+        columns = dict.fromkeys(path.split(".")[0] for path in leaf_bytes)
+    return {
+        col: sum(size for path, size in leaf_bytes.items() if _column_path_matches(path, col)) for col in columns
+    }
+
+
+def parquet_column_bytes(catalog_url: str) -> dict[str, int]:
+    """Compressed bytes per top-level column of a HATS catalog, from its Parquet metadata only."""
+    return sum_column_bytes(partition_parquet_stats(read_hats_catalog(catalog_url)))
+
+
+def filter_columns(filters) -> list:
+    """Names of the columns used by the filters, in order of first use."""
+    conjunctions = filters if is_dnf(filters) else [filters]
+    return list(dict.fromkeys(col for conjunction in conjunctions for col, _, _ in conjunction))
+
+
+def is_dnf(conditions) -> bool:
+    """Whether conditions are OR-ed AND-lists rather than a single AND-list."""
+    return bool(conditions) and not isinstance(conditions[0][0], str)
 
-        my_listener = LSDBFormatListener(
-            translator.parser, contexts={}, limit_contexts=select_query_listener.limit_contexts
+
+def _freeze_condition(condition) -> tuple:
+    """Make a (column, operator, value) condition hashable: IN value lists become tuples."""
+    column, op, value = condition
+    if isinstance(value, list):
+        value = tuple(value)
+    return (column, op, value)
+
+
+def _thaw_condition(condition) -> tuple:
+    """Reverse of _freeze_condition."""
+    column, op, value = condition
+    if isinstance(value, tuple):
+        value = list(value)
+    return (column, op, value)
+
+
+def catalog_url_for_table(table: str) -> str:
+    """Convert a table name like 'gaia_dr3.gaia' to the URL of its HATS catalog."""
+    if "." in table:
+        parts = table.split(".")
+        return f"https://data.lsdb.io/hats/{parts[0]}/{parts[1]}/"
+    return f"https://data.lsdb.io/hats/{table}/"
+
+
+# A positional JOIN returns every pair within the radius, while the crossmatch
+# keeps at most this many neighbors for each row of the left catalog.
+CROSSMATCH_MAX_NEIGHBORS = 100
+
+
+@dataclass(frozen=True)
+class JoinSpec:
+    """
+    A JOIN of a plan's catalog (left) with a second catalog (right).
+
+    A positional JOIN becomes Catalog.crossmatch and an equality of two columns
+    Catalog.join, so the join runs on aligned partitions (with the margin of the
+    right catalog) rather than as a pandas merge. Result columns get the suffix
+    of their table, e.g. "source_id_a" for a.source_id.
+    """
+
+    # The right catalog, with its own columns, search filter and filters
+    right: "LSDBQueryPlan"
+    suffixes: tuple[str, str]
+    radius_arcsec: float | None = None
+    left_on: str | None = None
+    right_on: str | None = None
+
+    def apply(self, left, right):
+        """Join two opened catalogs."""
+        if self.radius_arcsec is not None:
+            return left.crossmatch(
+                right,
+                radius_arcsec=self.radius_arcsec,
+                n_neighbors=CROSSMATCH_MAX_NEIGHBORS,
+                suffixes=self.suffixes,
+                suffix_method="all_columns",
+            )
+        return left.join(
+            right, left_on=self.left_on, right_on=self.right_on, suffixes=self.suffixes, suffix_method="all_columns"
         )
-        walker.walk(my_listener, translator.tree)
 
-        return my_listener.get_entities()
-    except NotImplementedError as e:
-        raise NotImplementedError(f"ADQL parsing failed: {e}")
-    except Exception as e:
-        raise ValueError(f"Failed to parse ADQL query: {e}")
+    def to_code(self, left: str, right: str) -> str:
+        """Render apply for the catalogs named left and right."""
+        if self.radius_arcsec is not None:
+            return (
+                f"{left}.crossmatch(\n"
+                f"    {right},\n"
+                f"    radius_arcsec={self.radius_arcsec},\n"
+                f"    n_neighbors={CROSSMATCH_MAX_NEIGHBORS},\n"
+                f"    suffixes={self.suffixes},\n"
+                f"    suffix_method='all_columns',\n"
+                f"    )"
+            )
+        return (
+            f"{left}.join(\n"
+            f"    {right},\n"
+            f"    left_on={self.left_on!r},\n"
+            f"    right_on={self.right_on!r},\n"
+            f"    suffixes={self.suffixes},\n"
+            f"    suffix_method='all_columns',\n"
+            f"    )"
+        )
+
+
+@dataclass(frozen=True)
+class LSDBQueryPlan:
+    """
+    Executable plan of a translated ADQL query.
+
+    The plan holds everything needed to run the query against ``lsdb.open_catalog``:
+    it can be executed directly (no generated code to ``exec``), inspected before
+    running, rendered as Python source with ``to_code``, and - being immutable and
+    hashable - used as a cache key.
+    """
+
+    catalog_url: str
+    # The SELECT list; empty for SELECT *
+    columns: tuple[str, ...] = ()
+    # Columns read from the catalog: the SELECT list plus the columns the filters,
+    # ORDER BY and spatial search need, which are dropped again after filtering
+    read_columns: tuple[str, ...] = ()
+    search_filter: ConeSearchSpec | PolygonSearchSpec | BoxSearchSpec | PixelSearchSpec | None = None
+    # Either an AND-list of (column, operator, value) or, with OR, a DNF tuple of such AND-lists
+    filters: tuple[tuple, ...] = ()
+    limit: int | None = None
+    order_by: tuple[tuple[str, bool], ...] = ()
+    # (function, column or "*", alias) tuples, e.g. ("AVG", "phot_g_mean_mag", None)
+    aggregates: tuple[tuple[str, str, str | None], ...] = ()
+    group_by: tuple[str, ...] = ()
+    # With a JOIN, columns, order_by and limit apply to the joined catalog, and
+    # read_columns, search_filter and filters to the left one
+    join: JoinSpec | None = None
+    # Compressed bytes of read_columns in the whole catalog, see with_projected_bytes
+    projected_bytes: int | None = field(default=None, compare=False)
+
+    @classmethod
+    def from_entities(cls, entities: dict) -> "LSDBQueryPlan":
+        """Build a plan from the entities returned by parse_adql_entities."""
+        if entities.get("join"):
+            return cls._from_join_entities(entities)
+        assert entities["tables"]
+        catalog_url = catalog_url_for_table(entities["tables"][0])
+
+        search_filter = None
+        spatial = entities.get("spatial_search")
+        if spatial and spatial["type"] == "ConeSearch":
+            search_filter = ConeSearchSpec(ra=spatial["ra"], dec=spatial["dec"], radius_arcsec=spatial["radius"] * 3600)
+        elif spatial and spatial["type"] == "PolygonSearch":
+            search_filter = PolygonSearchSpec(vertices=tuple(tuple(vertex) for vertex in spatial["coordinates"]))
+        elif entities.get("conditions") and not is_dnf(entities["conditions"]):
+            search_filter = search_from_conditions(entities["conditions"])
+
+        conditions = entities.get("conditions") or ()
+        if is_dnf(conditions):
+            filters = tuple(tuple(_freeze_condition(c) for c in conjunction) for conjunction in conditions)
+        else:
+            filters = tuple(_freeze_condition(c) for c in conditions)
+
+        columns = tuple(entities["columns"])
+        order_by = tuple(tuple(item) for item in entities.get("order_by") or ())
+        aggregates = tuple(tuple(aggregate) for aggregate in entities.get("aggregates") or ())
+        group_by = tuple(entities.get("group_by") or ())
+        point = (spatial or {}).get("point")
+        coordinate_columns = [point["ra"], point["dec"]] if point else []
+        if aggregates:
+            # Only read what the aggregates, groups and filters need
+            columns = group_by
+            needed = list(group_by) + [col for _, col, _ in aggregates if col != "*"] + filter_columns(filters)
+            read_columns = tuple(dict.fromkeys(needed)) or (HEALPIX_29_COLUMN,)
+        elif columns:
+            needed = list(columns) + filter_columns(filters) + [col for col, _ in order_by] + coordinate_columns
+            read_columns = tuple(dict.fromkeys(needed))
+        else:
+            read_columns = ()
+
+        return cls(
+            catalog_url=catalog_url,
+            columns=columns,
+            read_columns=read_columns,
+            search_filter=search_filter,
+            filters=filters,
+            limit=entities.get("limits"),
+            order_by=order_by,
+            aggregates=aggregates,
+            group_by=group_by,
+        )
+
+    @classmethod
+    def _from_join_entities(cls, entities: dict) -> "LSDBQueryPlan":
+        """
+        Build the plan of a JOIN, splitting columns and conditions between the two tables.
+
+        Every column must be qualified with its table's alias (or name), e.g. a.ra.
+        """
+        tables = entities["tables"]
+        names = [alias or table.split(".")[-1] for table, alias in zip(tables, entities["table_aliases"])]
+        if names[0] == names[1]:
+            raise NotImplementedError("Tables in a JOIN need distinct aliases")
+        if entities.get("aggregates") or entities.get("group_by"):
+            raise NotImplementedError("Aggregates over a JOIN are not supported")
+        conditions = entities.get("conditions") or []
+        if is_dnf(conditions):
+            raise NotImplementedError("Only AND-ed conditions are supported with a JOIN")
+
+        def split(name):
+            qualifier, dot, column = name.partition(".")
+            if not dot or qualifier not in names:
+                raise NotImplementedError(f"Column '{name}' must be qualified with one of the table aliases {names}")
+            return names.index(qualifier), column
+
+        def output_name(name):
+            side, column = split(name)
+            return f"{column}_{names[side]}"
+
+        sides = [{"tables": [table], "columns": [], "conditions": []} for table in tables]
+        for name in entities["columns"]:
+            side, column = split(name)
+            sides[side]["columns"].append(column)
+        for name, op, value in conditions:
+            side, column = split(name)
+            sides[side]["conditions"].append((column, op, value))
+        spatial = entities.get("spatial_search")
+        if spatial:
+            side, ra = split(spatial["point"]["ra"])
+            sides[side]["spatial_search"] = dict(spatial, point={"ra": ra, "dec": split(spatial["point"]["dec"])[1]})
+
+        join = entities["join"]
+        if join["type"] == "crossmatch":
+            (point_side, point_ra), (_, point_dec) = split(join["point"]["ra"]), split(join["point"]["dec"])
+            (circle_side, circle_ra), (_, circle_dec) = split(join["circle"]["ra"]), split(join["circle"]["dec"])
+            if point_side == circle_side:
+                raise NotImplementedError("A positional JOIN must match the POINT of one table to the CIRCLE of the other")
+            keys = {point_side: [point_ra, point_dec], circle_side: [circle_ra, circle_dec]}
+        else:
+            (left_side, left_on), (right_side, right_on) = split(join["on"][0]), split(join["on"][1])
+            if left_side == right_side:
+                raise NotImplementedError("A JOIN condition must compare columns of the two tables")
+            if left_side == 1:
+                left_on, right_on = right_on, left_on
+            keys = {0: [left_on], 1: [right_on]}
+        if entities["columns"]:
+            # The join keys and ORDER BY columns are read too, but not returned
+            for name, _ in entities.get("order_by") or ():
+                side, column = split(name)
+                keys[side] = keys[side] + [column]
+            for side, columns in keys.items():
+                sides[side]["columns"] = list(dict.fromkeys(sides[side]["columns"] + columns))
+
+        left, right = (cls.from_entities(side) for side in sides)
+        return replace(
+            left,
+            columns=tuple(output_name(name) for name in entities["columns"]),
+            limit=entities.get("limits"),
+            order_by=tuple((output_name(name), asc) for name, asc in entities.get("order_by") or ()),
+            join=JoinSpec(
+                right=right,
+                suffixes=(f"_{names[0]}", f"_{names[1]}"),
+                radius_arcsec=join["radius"] * 3600 if join["type"] == "crossmatch" else None,
+                left_on=keys[0][0] if join["type"] == "join" else None,
+                right_on=keys[1][0] if join["type"] == "join" else None,
+            ),
+        )
+
+    @property
+    def needs_projection(self) -> bool:
+        """
+        Whether the result has columns beyond the SELECT list, to drop after filtering.
+
+        Besides read_columns, lsdb always adds the catalog's coordinate columns
+        (usually "ra" and "dec") to what it reads.
+        """
+        if self.aggregates or not self.columns:
+            return False
+        if self.join is not None:
+            # Columns of the joined catalog are suffixed, and the crossmatch adds _dist_arcsec
+            return True
+        return self.read_columns != self.columns or not {"ra", "dec"} <= set(self.columns)
+
+    def with_projected_bytes(self) -> "LSDBQueryPlan":
+        """
+        Return a copy of the plan with projected_bytes filled in.
+
+        The estimate is the compressed size of read_columns summed over all row
+        groups in the catalog's _metadata file, so only Parquet footers are read.
+        Partitions skipped by the search filter are not taken into account.
+        """
+        stats = partition_parquet_stats(read_hats_catalog(self.catalog_url))
+        projected_bytes = sum(sum_column_bytes(stats, self.read_columns or None).values())
+        if self.join is not None:
+            projected_bytes += self.join.right.with_projected_bytes().projected_bytes
+        return replace(self, projected_bytes=projected_bytes)
+
+    @property
+    def is_metadata_count(self) -> bool:
+        """Whether the query is a bare COUNT(*), which the catalog metadata answers."""
+        return (
+            len(self.aggregates) == 1
+            and self.aggregates[0][:2] == ("COUNT", "*")
+            and not (self.group_by or self.filters or self.search_filter)
+        )
+
+    def _partial_aggregates(self) -> dict:
+        """
+        Per-partition partial aggregates as {name: (column, function)}.
+
+        COUNT(*) is (None, "size"), and AVG is split into a sum and a count.
+        """
+        partials = {}
+        for function, col, _ in self.aggregates:
+            if col == "*":
+                partials["count_star"] = (None, "size")
+            elif function == "AVG":
+                partials[f"sum_{col}"] = (col, "sum")
+                partials[f"count_{col}"] = (col, "count")
+            else:
+                partials[f"{function.lower()}_{col}"] = (col, function.lower())
+        return partials
+
+    def _aggregate_outputs(self) -> list:
+        """Final aggregates as (output name, partial name, partial name of the divisor or None)."""
+        outputs = []
+        for function, col, alias in self.aggregates:
+            if col == "*":
+                outputs.append((alias or "count", "count_star", None))
+            elif function == "AVG":
+                outputs.append((alias or f"avg_{col}", f"sum_{col}", f"count_{col}"))
+            else:
+                outputs.append((alias or f"{function.lower()}_{col}", f"{function.lower()}_{col}", None))
+        return outputs
+
+    def aggregate_partition(self, df):
+        """Compute the partial aggregates of a single partition."""
+        import pandas as pd
+
+        partials = self._partial_aggregates()
+        if self.group_by:
+            named = {name: (col or self.group_by[0], function) for name, (col, function) in partials.items()}
+            return df.groupby(list(self.group_by), dropna=False).agg(**named).reset_index()
+        columns = {}
+        for name, (col, function) in partials.items():
+            if col is None:
+                columns[name] = [len(df)]
+            elif function == "count":
+                columns[name] = [df[col].count()]
+            else:
+                # Keep the column dtype, so that empty partitions still match the meta
+                columns[name] = pd.Series([df[col].agg(function)], dtype=df[col].dtype)
+        return pd.DataFrame(columns)
+
+    def combine_partials(self, partials):
+        """Combine the partial aggregates of all partitions into the final result."""
+        import pandas as pd
+
+        # Counts and sums add up, minima and maxima are taken again
+        combine = {name: "sum" if function in ("size", "count", "sum") else function
+                   for name, (_, function) in self._partial_aggregates().items()}
+        if self.group_by:
+            named = {name: (name, function) for name, function in combine.items()}
+            combined = partials.groupby(list(self.group_by), dropna=False).agg(**named).reset_index()
+            result = {col: combined[col] for col in self.group_by}
+        else:
+            combined = pd.DataFrame({name: [partials[name].agg(function)] for name, function in combine.items()})
+            result = {}
+        for output, name, divisor in self._aggregate_outputs():
+            result[output] = combined[name] / combined[divisor] if divisor else combined[name]
+        return pd.DataFrame(result)
+
+    def _execute_aggregates(self, cat):
+        """Run an aggregate query on an opened catalog."""
+        import pandas as pd
+
+        if self.is_metadata_count:
+            (output, _, _), = self._aggregate_outputs()
+            return pd.DataFrame({output: [cat.hc_structure.catalog_info.total_rows]})
+        result = self.combine_partials(cat.map_partitions(self.aggregate_partition).compute())
+        if self.order_by:
+            result = result.sort_values(
+                by=[col for col, _ in self.order_by], ascending=[asc for _, asc in self.order_by]
+            )
+        if self.limit:
+            result = result.head(self.limit)
+        return result
+
+    def _aggregates_code(self) -> str:
+        """Render _execute_aggregates as code, following the open_catalog call."""
+        outputs = self._aggregate_outputs()
+        if self.is_metadata_count:
+            (output, _, _), = outputs
+            code = "# Answered from the catalog metadata (hats.properties), without reading any data\n"
+            code += f"result = pd.DataFrame({{{output!r}: [cat.hc_structure.catalog_info.total_rows]}})\n"
+            return code
+
+        partials = self._partial_aggregates()
+        combine = {name: "sum" if function in ("size", "count", "sum") else function
+                   for name, (_, function) in partials.items()}
+        group_by = list(self.group_by)
+        code = "# Aggregate every partition, then combine the partial aggregates\n"
+        if group_by:
+            named = ", ".join(f"{name}=({col or group_by[0]!r}, {function!r})" for name, (col, function) in partials.items())
+            code += f"partials = cat.map_partitions(lambda df: df.groupby({group_by}, dropna=False).agg({named}).reset_index()).compute()\n"
+            named = ", ".join(f"{name}=({name!r}, {function!r})" for name, function in combine.items())
+            code += f"combined = partials.groupby({group_by}, dropna=False).agg({named}).reset_index()\n"
+            items = [f"{col!r}: combined[{col!r}]" for col in group_by]
+        else:
+            columns = ", ".join(
+                f"{name!r}: [len(df)]" if col is None
+                else f"{name!r}: [df[{col!r}].count()]" if function == "count"
+                else f"{name!r}: pd.Series([df[{col!r}].agg({function!r})], dtype=df[{col!r}].dtype)"
+                for name, (col, function) in partials.items()
+            )
+            code += f"partials = cat.map_partitions(lambda df: pd.DataFrame({{{columns}}})).compute()\n"
+            columns = ", ".join(f"{name!r}: [partials[{name!r}].agg({function!r})]" for name, function in combine.items())
+            code += f"combined = pd.DataFrame({{{columns}}})\n"
+            items = []
+        for output, name, divisor in outputs:
+            if divisor:
+                items.append(f"{output!r}: combined[{name!r}] / combined[{divisor!r}]")
+            else:
+                items.append(f"{output!r}: combined[{name!r}]")
+        code += f"result = pd.DataFrame({{{', '.join(items)}}})\n"
+        if self.order_by:
+            cols = [col for col, _ in self.order_by]
+            ascending = [asc for _, asc in self.order_by]
+            code += f"result = result.sort_values(by={cols}, ascending={ascending})\n"
+        if self.limit:
+            code += f"result = result.head({self.limit})\n"
+        return code
+
+    def open_catalog_kwargs(self) -> dict:
+        """Keyword arguments for lsdb.open_catalog, other than the catalog URL."""
+        kwargs = {}
+        if self.read_columns:
+            kwargs["columns"] = list(self.read_columns)
+        if self.search_filter is not None:
+            kwargs["search_filter"] = self.search_filter.to_lsdb()
+        if self.filters:
+            kwargs["filters"] = self.filters_argument()
+        return kwargs
+
+    def filters_argument(self) -> list:
+        """The filters as lists, in the form lsdb.open_catalog (and pyarrow) expect."""
+        if is_dnf(self.filters):
+            return [[_thaw_condition(c) for c in conjunction] for conjunction in self.filters]
+        return [_thaw_condition(c) for c in self.filters]
+
+    def execute(self, *, project: bool = True):
+        """
+        Run the plan with LSDB and return the resulting data frame.
+
+        With ``project=False`` the columns only needed for filtering and sorting
+        are kept in the result (see ``project``).
+        """
+        import lsdb
+
+        if self.is_metadata_count:
+            # Only hats.properties and the partition info are read
+            cat = lsdb.open_catalog(self.catalog_url)
+        else:
+            cat = lsdb.open_catalog(self.catalog_url, **self.open_catalog_kwargs())
+        if self.join is not None:
+            right = lsdb.open_catalog(self.join.right.catalog_url, **self.join.right.open_catalog_kwargs())
+            cat = self.join.apply(cat, right)
+        if self.aggregates:
+            return self._execute_aggregates(cat)
+        if self.limit and self.order_by:
+            # Each partition is reduced to its own top rows, so at most
+            # limit * n_partitions rows are ever held in memory.
+            result = self.top_k(cat.map_partitions(self.top_k).compute())
+        elif self.limit:
+            result = cat.head(self.limit)
+        else:
+            result = cat.compute()
+            if self.order_by:
+                result = result.sort_values(
+                    by=[col for col, _ in self.order_by], ascending=[asc for _, asc in self.order_by]
+                )
+        return self.project(result) if project else result
+
+    def project(self, df):
+        """Drop the columns of ``df`` which are not in the SELECT list."""
+        if self.needs_projection:
+            return df[list(self.columns)]
+        return df
+
+    def finish(self, df):
+        """Apply ORDER BY, TOP and the SELECT list to an in-memory data frame with all read columns."""
+        if self.limit and self.order_by:
+            df = self.top_k(df)
+        elif self.limit:
+            df = df.head(self.limit)
+        elif self.order_by:
+            df = df.sort_values(by=[col for col, _ in self.order_by], ascending=[asc for _, asc in self.order_by])
+        return self.project(df)
+
+    def top_k(self, df):
+        """Return the first ``limit`` rows of ``df`` in ORDER BY order."""
+        import pandas as pd
+
+        by = [col for col, _ in self.order_by]
+        ascending = {asc for _, asc in self.order_by}
+        # nsmallest/nlargest only take numeric keys
+        if all(pd.api.types.is_numeric_dtype(df[col]) for col in by):
+            if ascending == {True}:
+                return df.nsmallest(self.limit, by)
+            if ascending == {False}:
+                return df.nlargest(self.limit, by)
+        # nsmallest/nlargest can't mix directions
+        return df.sort_values(by=by, ascending=[asc for _, asc in self.order_by]).head(self.limit)
+
+    @property
+    def _top_k_uses_pandas(self) -> bool:
+        """Whether the rendered top_k checks dtypes with pandas: only for nsmallest/nlargest, with one direction."""
+        directions = {asc for _, asc in self.order_by}
+        return bool(self.limit) and len(directions) == 1
+
+    def _top_k_code(self) -> str:
+        """Render a top_k function following the same rules as ``top_k``."""
+        by = [col for col, _ in self.order_by]
+        ascending = [asc for _, asc in self.order_by]
+        code = "def top_k(df):\n"
+        if self._top_k_uses_pandas:
+            method = "nsmallest" if all(ascending) else "nlargest"
+            code += "    # nsmallest/nlargest only take numeric keys\n"
+            code += f"    if all(pd.api.types.is_numeric_dtype(df[col]) for col in {by}):\n"
+            code += f"        return df.{method}({self.limit}, {by})\n"
+        code += f"    return df.sort_values(by={by}, ascending={ascending}).head({self.limit})\n\n"
+        return code
+
+    def _open_catalog_code(self, name: str) -> str:
+        """Render the open_catalog call, assigning the catalog to the variable name."""
+        code = f"{name} = lsdb.open_catalog(\n"
+        code += f"    '{self.catalog_url}',\n"
+        if self.read_columns:
+            code += "    columns=[\n"
+            code += "        " + ", ".join(f'"{col}"' for col in self.read_columns) + "\n"
+            code += "    ],\n"
+
+        # Handle spatial search if present
+        if self.search_filter is not None:
+            code += f"    search_filter={self.search_filter.to_code()},\n"
+
+        # Apply conditions if present
+        if self.filters:
+            code += f"    filters={self.filters_argument()},\n"
+
+        # Conclude open_catalog call
+        code += "    )\n\n"
+        return code
+
+    def to_code(self) -> str:
+        """Render the plan as Python source using LSDB calls."""
+        code = "import lsdb\n"
+        if self.aggregates or self._top_k_uses_pandas:
+            code += "import pandas as pd\n"
+        code += "\n"
+        if self.projected_bytes is not None:
+            code += f"# Projected read: {self.projected_bytes} compressed bytes\n"
+
+        if self.is_metadata_count:
+            code += f"cat = lsdb.open_catalog('{self.catalog_url}')\n\n"
+            return code + self._aggregates_code()
+
+        code += self._open_catalog_code("cat")
+        if self.join is not None:
+            code += self.join.right._open_catalog_code("right")
+            code += f"cat = {self.join.to_code('cat', 'right')}\n\n"
+
+        if self.aggregates:
+            return code + self._aggregates_code()
+
+        # With both TOP and ORDER BY, reduce every partition to its top rows
+        # and merge those, instead of sorting the whole catalog.
+        if self.limit and self.order_by:
+            code += self._top_k_code()
+            code += "result = top_k(cat.map_partitions(top_k).compute())\n"
+        elif self.limit:
+            # Handle limit if present
+            code += f"result = cat.head({self.limit})\n"
+        else:
+            code += "result = cat.compute()\n"
+
+            # Apply ORDER BY using pandas if requested
+            if self.order_by:
+                cols = ", ".join(repr(col) for col, _ in self.order_by)
+                asc_list = ", ".join("True" if asc else "False" for _, asc in self.order_by)
+                # Use sort_values and reassign to result
+                code += f"result = result.sort_values(by=[{cols}], ascending=[{asc_list}])\n"
+
+        # Drop the columns only needed for filtering and sorting
+        if self.needs_projection:
+            code += f"result = result[{list(self.columns)}]\n"
+
+        return code
+
+
+def _angular_distance(ra1, dec1, ra2, dec2):
+    """Great-circle distance in degrees (haversine); works on scalars and numpy arrays."""
+    import numpy as np
+
+    ra1, dec1, ra2, dec2 = (np.radians(np.asarray(x, dtype=float)) for x in (ra1, dec1, ra2, dec2))
+    a = np.sin((dec2 - dec1) / 2) ** 2 + np.cos(dec1) * np.cos(dec2) * np.sin((ra2 - ra1) / 2) ** 2
+    return np.degrees(2 * np.arcsin(np.sqrt(np.clip(a, 0, 1))))
+
+
+class PlanResultCache:
+    """
+    Byte-bounded on-disk LRU cache of query results, keyed on LSDBQueryPlan.
+
+    Results are stored as Parquet files in ``directory``, with an index.json
+    holding their size, last use and the hats_creation_date of each catalog
+    they read: once a catalog is re-imported the cached results which read it
+    are dropped instead of returned. The least recently used results are
+    evicted to keep the files within ``max_bytes``.
+
+    Besides identical plans, a cone search is answered from the cached result
+    of a larger cone covering it, with the same catalog and filters, by
+    selecting the rows within the smaller cone. Safe to share between threads
+    of one process.
+    """
+
+    INDEX_FILE = "index.json"
+
+    def __init__(self, directory, max_bytes: int = 1 << 30):
+        if max_bytes <= 0:
+            raise ValueError(f"max_bytes must be positive, got {max_bytes}")
+        self.directory = os.fspath(directory)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.cone_hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(self.directory, exist_ok=True)
+        self._index = self._read_index()
+        self._clock = max((entry["last_used"] for entry in self._index.values()), default=0)
+        # max_bytes may be smaller than when the results were cached
+        self._evict()
+        self._write_index()
+
+    @staticmethod
+    def plan_key(plan: LSDBQueryPlan) -> str:
+        """A key for the plan that is stable across processes, unlike hash()."""
+        return hashlib.sha256(repr(replace(plan, projected_bytes=None)).encode()).hexdigest()
+
+    @staticmethod
+    def _cover_key(plan: LSDBQueryPlan) -> str:
+        """Plans with the same cover key differ at most in their search, columns, ORDER BY and TOP."""
+        return hashlib.sha256(repr((plan.catalog_url, plan.filters)).encode()).hexdigest()
+
+    @staticmethod
+    def _can_cover(plan: LSDBQueryPlan) -> bool:
+        """Whether the (unprojected) result of plan holds every row of its cone."""
+        return isinstance(plan.search_filter, ConeSearchSpec) and not (plan.limit or plan.aggregates or plan.join)
+
+    def __len__(self):
+        return len(self._index)
+
+    def stats(self) -> dict:
+        """Return hit/miss counters and current size."""
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "cone_hits": self.cone_hits,
+                "misses": self.misses,
+                "entries": len(self._index),
+                "bytes": sum(entry["nbytes"] for entry in self._index.values()),
+                "max_bytes": self.max_bytes,
+            }
+
+    def clear(self):
+        """Delete all cached results and reset the counters."""
+        with self._lock:
+            for key in list(self._index):
+                self._remove(key)
+            self._write_index()
+            self.hits = self.cone_hits = self.misses = 0
+
+    def execute(self, plan: LSDBQueryPlan):
+        """Return the result of plan, from the cache if possible, else by running it and caching the result."""
+        import pandas as pd
+
+        properties = read_catalog_properties(plan.catalog_url)
+        versions = {plan.catalog_url: properties.hats_creation_date}
+        if plan.join is not None:
+            right_url = plan.join.right.catalog_url
+            versions[right_url] = read_catalog_properties(right_url).hats_creation_date
+        key = self.plan_key(plan)
+
+        with self._lock:
+            self._drop_stale(versions)
+            entry = self._index.get(key)
+            cover = None if entry is not None else self._find_cover(plan)
+            if entry is not None:
+                self.hits += 1
+                self._touch(key)
+            elif cover is not None:
+                self.cone_hits += 1
+                self._touch(cover)
+            else:
+                self.misses += 1
+
+        if entry is not None:
+            return plan.project(pd.read_parquet(self._path(key), dtype_backend="pyarrow"))
+        if cover is not None:
+            df = pd.read_parquet(self._path(cover), dtype_backend="pyarrow")
+            cone = plan.search_filter
+            distance = _angular_distance(df[properties.ra_column], df[properties.dec_column], cone.ra, cone.dec)
+            return plan.finish(df[distance <= cone.radius_arcsec / 3600])
+
+        result = plan.execute(project=False)
+        self._store(key, plan, versions, result)
+        return plan.project(result)
+
+    def _find_cover(self, plan: LSDBQueryPlan) -> str | None:
+        """Key of a cached result of a cone covering the cone of plan, or None."""
+        if not isinstance(plan.search_filter, ConeSearchSpec) or plan.aggregates or plan.join:
+            return None
+        cone = plan.search_filter
+        cover_key = self._cover_key(plan)
+        for key, entry in self._index.items():
+            if entry.get("cover_key") != cover_key:
+                continue
+            if entry["read_columns"] and not set(plan.read_columns or ["*"]) <= set(entry["read_columns"]):
+                continue
+            ra, dec, radius_arcsec = entry["cone"]
+            if _angular_distance(ra, dec, cone.ra, cone.dec) + cone.radius_arcsec / 3600 <= radius_arcsec / 3600:
+                return key
+        return None
+
+    def _store(self, key: str, plan: LSDBQueryPlan, versions: dict[str, str], result):
+        import pandas as pd
+
+        path = self._path(key)
+        # Write next to the final file, so readers never see a partial one
+        pd.DataFrame(result).to_parquet(f"{path}.tmp")
+        os.replace(f"{path}.tmp", path)
+        entry = {"versions": versions, "nbytes": os.path.getsize(path)}
+        if self._can_cover(plan):
+            cone = plan.search_filter
+            entry.update(
+                cover_key=self._cover_key(plan),
+                read_columns=list(plan.read_columns),
+                cone=[cone.ra, cone.dec, cone.radius_arcsec],
+            )
+        with self._lock:
+            self._index[key] = entry
+            self._touch(key)
+            self._evict()
+            self._write_index()
+
+    def _evict(self):
+        """Remove least recently used results until the cache fits in max_bytes."""
+        total = sum(entry["nbytes"] for entry in self._index.values())
+        for key in sorted(self._index, key=lambda k: self._index[k]["last_used"]):
+            if total <= self.max_bytes:
+                break
+            total -= self._index[key]["nbytes"]
+            self._remove(key)
+
+    def _drop_stale(self, versions: dict[str, str]):
+        """Remove results which read another version of any catalog URL of versions."""
+        stale = [
+            key for key, entry in self._index.items()
+            if any(entry["versions"].get(url, version) != version for url, version in versions.items())
+        ]
+        for key in stale:
+            self._remove(key)
+        if stale:
+            self._write_index()
+
+    def _touch(self, key: str):
+        self._clock += 1
+        self._index[key]["last_used"] = self._clock
+
+    def _remove(self, key: str):
+        del self._index[key]
+        self._delete_file(key)
+
+    def _delete_file(self, key: str):
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.parquet")
+
+    def _read_index(self) -> dict:
+        try:
+            with open(os.path.join(self.directory, self.INDEX_FILE)) as f:
+                index = json.load(f)
+        except FileNotFoundError:
+            return {}
+        # Entries of older caches, with a single version for all catalogs, can't be checked
+        for key in [key for key, entry in index.items() if "versions" not in entry]:
+            del index[key]
+            self._delete_file(key)
+        # Forget entries whose file is gone
+        return {key: entry for key, entry in index.items() if os.path.exists(self._path(key))}
+
+    def _write_index(self):
+        path = os.path.join(self.directory, self.INDEX_FILE)
+        with open(f"{path}.tmp", "w") as f:
+            json.dump(self._index, f)
+        os.replace(f"{path}.tmp", path)
 
 
 def format_lsdb_code(entities: dict) -> str:
@@ -554,73 +1475,134 @@ def format_lsdb_code(entities: dict) -> str:
     Returns:
         str: Python code string using LSDB calls
     """
-    code = "import lsdb\n\n"
+    return LSDBQueryPlan.from_entities(entities).to_code()
 
-    code += "cat = lsdb.open_catalog(\n"
 
-    # Convert table names to catalog URLs (basic mapping for now)
-    assert entities["tables"]
-    # For now, use the first table and convert to URL format
-    table = entities["tables"][0]
-    # Convert table name like 'gaiadr3.gaia' to URL format
-    if "." in table:
-        parts = table.split(".")
-        catalog_url = f"https://data.lsdb.io/hats/{parts[0]}/{parts[1]}/"
-    else:
-        catalog_url = f"https://data.lsdb.io/hats/{table}/"
-    code += f"    '{catalog_url}',\n"
-    if entities["columns"]:
-        code += "    columns=[\n"
-        code += "        " + ", ".join(f'"{col}"' for col in entities["columns"]) + "\n"
-        code += "    ],\n"
-
-    # Handle spatial search if present
-    if entities.get("spatial_search"):
-        spatial = entities["spatial_search"]
-        if spatial["type"] == "ConeSearch":
-            ra = spatial["ra"]
-            dec = spatial["dec"]
-            radius = spatial["radius"]
-            code += f"    search_filter=lsdb.ConeSearch(ra={ra}, dec={dec}, radius_arcsec={radius * 3600}),\n"
-        elif spatial["type"] == "PolygonSearch":
-            coords = spatial["coordinates"]
-            coord_list = ", ".join(f"({ra}, {dec})" for ra, dec in coords)
-            code += f"    search_filter=lsdb.PolygonSearch([{coord_list}]),\n"
-
-    # Apply conditions if present
-    if entities.get("conditions"):
-        conditions = entities["conditions"]
-        code += f"    filters={conditions},\n"
-
-    # Conclude open_catalog call
-    code += "    )\n\n"
-
-    # Handle limit if present
-    if entities.get("limits"):
-        limit_value = entities["limits"]
-        code += f"result = cat.head({limit_value})\n"
+def adql_to_lsdb_plan(
+    adql: str, cache: ADQLParseCache | None = parse_cache, *, estimate_bytes: bool = False
+) -> LSDBQueryPlan:
+    """
+    Convert ADQL query to an executable LSDBQueryPlan.
+
+    Parsed entities are looked up in ``cache`` first; pass ``cache=None`` to always
+    parse the query from scratch. With ``estimate_bytes``, the catalog's Parquet
+    metadata is read to fill in the plan's projected_bytes.
+    """
+    if cache is None:
+        entities = parse_adql_entities(adql)
     else:
-        code += "result = cat.compute()\n"
+        entities = cache.get_entities(adql)
+    plan = LSDBQueryPlan.from_entities(entities)
+    if estimate_bytes:
+        plan = plan.with_projected_bytes()
+    return plan
 
-    # Apply ORDER BY using pandas if requested
-    order_by = entities.get("order_by") or []
-    if order_by:
-        cols = ", ".join(repr(col) for col, _ in order_by)
-        asc_list = ", ".join("True" if asc else "False" for _, asc in order_by)
-        # Use sort_values and reassign to result
-        code += f"result = result.sort_values(by=[{cols}], ascending=[{asc_list}])\n"
 
-    return code
+def adql_to_lsdb(adql: str, cache: ADQLParseCache | None = parse_cache) -> str:
+    """
+    Convert ADQL query to Python code that uses LSDB calls.
 
+    This function combines parsing and formatting: the query is translated to an
+    LSDBQueryPlan which is then rendered as code.
+    """
+    return adql_to_lsdb_plan(adql, cache=cache).to_code()
 
-def adql_to_lsdb(adql: str) -> str:
+
+def _warm_up_worker():
     """
-    Convert ADQL query to Python code that uses LSDB calls.
+    Pool initializer: pay the parser warm-up once per worker process.
+
+    Workers load the saved parser state named by PARSER_STATE_ENV, if any, and
+    fill the ANTLR DFA caches further by parsing a few representative queries.
+    """
+    _adql_parser().warm_up()
+
+
+def _translate_batch_line(item):
+    """
+    Translate one line of batch input into a JSON-serializable result.
+
+    A line is either a bare ADQL query or a JSON object with a "query" key and
+    an optional "id", which is echoed back in the result.
+    """
+    line_number, line = item
+    result = {"line": line_number}
+    try:
+        if line.lstrip().startswith("{"):
+            record = json.loads(line)
+            if "id" in record:
+                result["id"] = record["id"]
+            if "query" not in record:
+                raise ValueError('JSON input line has no "query" key')
+            query = record["query"]
+        else:
+            query = line
+        result["code"] = adql_to_lsdb(query)
+    except Exception as e:
+        # Keep going: one bad query must not stop a batch of many thousands
+        result["error"] = {"type": type(e).__name__, "message": str(e)}
+    return result
+
 
-    This function combines parsing and formatting by calling the two separate functions.
+def save_parser_state(lines, path: str) -> int:
     """
-    entities = parse_adql_entities(adql)
-    return format_lsdb_code(entities)
+    Warm up the parser on the built-in queries and on lines, then save its state to path.
+
+    Lines are read like in run_batch; queries which fail to parse are skipped,
+    but still teach the parser something.
+
+    Returns:
+        int: Number of queries from lines which were parsed
+    """
+    adql_parser = _adql_parser()
+    adql_parser.warm_up()
+    n_parsed = 0
+    for line in lines:
+        if not line.strip():
+            continue
+        try:
+            query = json.loads(line)["query"] if line.lstrip().startswith("{") else line
+            adql_parser.parse_adql_tree(query)
+            n_parsed += 1
+        except Exception:
+            pass
+    adql_parser.save_parser_state(path)
+    return n_parsed
+
+
+def run_batch(lines, output, *, workers: int | None = None, chunksize: int = 64):
+    """
+    Translate newline- or JSONL-delimited queries, writing one JSON result per
+    line to output, in input order.
+
+    Args:
+        lines: Text stream with one query (or JSON object) per line; blank lines are skipped
+        output: Text stream for the JSONL results
+        workers: Number of worker processes (default: number of CPUs); 1 translates in-process
+        chunksize: Number of lines sent to a worker at once
+
+    Returns:
+        int: Number of queries which failed to translate
+    """
+    items = ((i, line) for i, line in enumerate(lines, start=1) if line.strip())
+    n_errors = 0
+
+    def write(results):
+        nonlocal n_errors
+        for result in results:
+            n_errors += "error" in result
+            output.write(json.dumps(result) + "\n")
+            output.flush()
+
+    if workers == 1:
+        _warm_up_worker()
+        write(map(_translate_batch_line, items))
+    else:
+        from multiprocessing import Pool
+
+        with Pool(processes=workers, initializer=_warm_up_worker) as pool:
+            write(pool.imap(_translate_batch_line, items, chunksize=chunksize))
+    return n_errors
 
 
 def main():
@@ -632,17 +1614,72 @@ def main():
         default=sys.stdin,
         help="Input file containing ADQL query (default: stdin)",
     )
+    parser.add_argument(
+        "--batch",
+        action="store_true",
+        help="Translate one query per line (plain ADQL or JSON objects with a \"query\" key) and "
+        "stream JSONL results to stdout",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="Number of worker processes for --batch (default: number of CPUs)",
+    )
+    parser.add_argument(
+        "--chunksize",
+        type=int,
+        default=64,
+        help="Number of queries sent to a worker at once in --batch mode (default: 64)",
+    )
+
+    parser.add_argument(
+        "--estimate-bytes",
+        action="store_true",
+        help="Read the catalog's Parquet metadata and note the projected bytes to read in the output",
+    )
+
+    parser.add_argument(
+        "--cost",
+        action="store_true",
+        help="Print the estimated partitions, rows and bytes the query touches as JSON, instead of code",
+    )
+
+    parser.add_argument(
+        "--save-parser-state",
+        metavar="PATH",
+        help="Parse built-in warm-up queries and the input queries (one per line, as for --batch), "
+        f"then save the warmed-up parser state to PATH, to be loaded by setting {PARSER_STATE_ENV}=PATH",
+    )
 
     args = parser.parse_args()
 
+    if args.save_parser_state:
+        n_parsed = save_parser_state(args.input, args.save_parser_state)
+        print(f"Saved parser state after {n_parsed} input queries to {args.save_parser_state}", file=sys.stderr)
+        return
+
+    if args.batch:
+        try:
+            n_errors = run_batch(args.input, sys.stdout, workers=args.workers, chunksize=args.chunksize)
+        except KeyboardInterrupt:
+            print("\nOperation cancelled.", file=sys.stderr)
+            raise SystemExit(1)
+        if n_errors:
+            print(f"{n_errors} queries failed to translate", file=sys.stderr)
+        return
+
     try:
         adql_query = args.input.read()
-        result = adql_to_lsdb(adql_query)
+        if args.cost:
+            print(json.dumps(estimate_query_cost(adql_query).to_dict(), indent=2))
+            return
+        result = adql_to_lsdb_plan(adql_query, estimate_bytes=args.estimate_bytes).to_code()
         print(result)
     except NotImplementedError as e:
         print(f"Error: {e}", file=sys.stderr)
         raise SystemExit(1)
-    except ValueError as e:
+    except (ValueError, OSError) as e:
         print(f"Error: {e}", file=sys.stderr)
         raise SystemExit(1)
     except KeyboardInterrupt:
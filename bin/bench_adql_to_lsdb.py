@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+
+"""
+Micro-benchmarks for adql_to_lsdb.py.
+
+Parse latency is measured over a corpus of realistic ADQL queries: the sample*.adql
+files next to this script plus a few typical TAP queries. Each query is processed as
+parse_adql_entities() does ("after"): parsed by adql_parser.parse_adql_tree(), with SLL
+prediction first, and walked once by LSDBFormatListener; and as it used to ("before"):
+parsed by queryparser's ADQLQueryTranslator, with full LL prediction, and walked twice,
+by SelectQueryListener and then LSDBFormatListener.
+
+With --startup, the start-up costs are measured in fresh interpreters instead:
+``adql_to_lsdb.py --help``, importing adql_to_lsdb, and the latency of the first
+and second query, with and without a parser state saved by --save-parser-state.
+"""
+
+import argparse
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from antlr4 import ParseTreeWalker
+from queryparser.adql.adqltranslator import ADQLQueryTranslator, SelectQueryListener
+
+from adql_parser import LSDBFormatListener, parse_adql_tree
+from adql_to_lsdb import PARSER_STATE_ENV, parse_adql_entities
+
+SCRIPT_DIR = Path(__file__).resolve().parent
+
+# Run in a fresh interpreter: prints the import time of adql_to_lsdb and the
+# latencies of parsing the query given as argument twice, in seconds, as JSON.
+_STARTUP_PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import adql_to_lsdb
+imported = time.perf_counter()
+adql_to_lsdb.parse_adql_entities(sys.argv[1])
+first = time.perf_counter()
+adql_to_lsdb.parse_adql_entities(sys.argv[1])
+second = time.perf_counter()
+print(json.dumps({"import": imported - start, "first_query": first - imported, "second_query": second - first}))
+"""
+
+CORPUS = [
+    """SELECT TOP 100 source_id, ra, dec, parallax, pmra, pmdec
+    FROM gaia_dr3.gaia
+    WHERE 1 = CONTAINS(POINT('ICRS', ra, dec), CIRCLE('ICRS', 56.75, 24.12, 1.5))
+    AND parallax > 5""",
+    """SELECT TOP 1000 source_id, ra, dec, phot_g_mean_mag, bp_rp
+    FROM gaia_dr3.gaia
+    WHERE 1 = CONTAINS(POINT('ICRS', ra, dec), CIRCLE('ICRS', 266.4168, -29.0078, 0.05))
+    AND phot_g_mean_mag < 18
+    AND ruwe < 1.4
+    ORDER BY phot_g_mean_mag""",
+    """SELECT objectid, objra, objdec, nepochs
+    FROM ztf_dr22
+    WHERE CONTAINS(POINT('ICRS', ra, dec), POLYGON('ICRS', 10.0, 40.0, 11.5, 40.0, 11.5, 42.0, 10.0, 42.0)) = 1
+    AND nepochs >= 20""",
+    """SELECT TOP 50 source_id, ra, dec, phot_variable_flag
+    FROM gaia_dr3.gaia
+    WHERE phot_variable_flag = 'VARIABLE'
+    AND dec < -60
+    ORDER BY ra, dec DESC""",
+]
+
+
+def load_corpus(directory: Path) -> list[str]:
+    """Return the built-in queries plus every sample*.adql file in directory."""
+    queries = list(CORPUS)
+    for path in sorted(directory.glob("sample*.adql")):
+        queries.append(path.read_text())
+    return queries
+
+
+class TwoPassFormatListener(LSDBFormatListener):
+    """LSDBFormatListener as it was before the single-pass walk, reading the limit from limit_contexts."""
+
+    def __init__(self, parser, limit_contexts):
+        super().__init__(parser)
+        self.limit_contexts = limit_contexts
+
+    def enterSet_limit(self, ctx):
+        for limit_text in self.limit_contexts.values():
+            match = re.search(r"(?:LIMIT|TOP)\s+(\d+)", limit_text, re.IGNORECASE)
+            if match:
+                limit_value = int(match.group(1))
+                if limit_value <= 0:
+                    raise ValueError(f"Invalid TOP/LIMIT value: TOP/LIMIT must be positive, got {limit_value}")
+                self.entities["limits"] = limit_value
+                return
+
+
+def parse_full_ll(query: str):
+    """Parse with queryparser's ADQLQueryTranslator, as parse_adql_entities() used to."""
+    translator = ADQLQueryTranslator(query)
+    return translator.parser, translator.tree
+
+
+def walk_two_pass(parser, tree) -> dict:
+    """Walk the tree twice, as parse_adql_entities() used to."""
+    walker = ParseTreeWalker()
+    # SelectQueryListener strips TOP from the tree and keeps it in limit_contexts
+    select_query_listener = SelectQueryListener()
+    walker.walk(select_query_listener, tree)
+    listener = TwoPassFormatListener(parser, select_query_listener.limit_contexts)
+    walker.walk(listener, tree)
+    return listener.get_entities()
+
+
+def walk_single_pass(parser, tree) -> dict:
+    """Walk the tree once, as parse_adql_entities() does after parse_adql_tree()."""
+    listener = LSDBFormatListener(parser)
+    ParseTreeWalker().walk(listener, tree)
+    return listener.get_entities()
+
+
+# How each variant parses and walks a query
+VARIANTS = {
+    "before": (parse_full_ll, walk_two_pass),
+    "after": (parse_adql_tree, walk_single_pass),
+}
+
+
+def time_query(query: str, *, repeat: int) -> dict[str, float]:
+    """
+    Return median latencies, in seconds, of the two variants for a single query.
+
+    "walk" times only the tree walk(s) over an already parsed tree, "total" also
+    includes lexing and parsing. The two variants are interleaved so that drift
+    in machine load affects both of them equally.
+    """
+    times = {"walk_before": [], "walk_after": [], "total_before": [], "total_after": []}
+    for _ in range(repeat):
+        for variant, (parse, walk) in VARIANTS.items():
+            start = time.perf_counter()
+            parser, tree = parse(query)
+            parsed = time.perf_counter()
+            walk(parser, tree)
+            end = time.perf_counter()
+            times[f"walk_{variant}"].append(end - parsed)
+            times[f"total_{variant}"].append(end - start)
+    return {name: statistics.median(values) for name, values in times.items()}
+
+
+def bench_parse(queries: list[str], *, repeat: int):
+    for query in queries:
+        before = walk_two_pass(*parse_full_ll(query))
+        after = walk_single_pass(*parse_adql_tree(query))
+        assert before == after == parse_adql_entities(query), f"Entities differ for {query!r}"
+
+    results = [time_query(query, repeat=repeat) for query in queries]
+
+    print(f"{'query':>5} {'walk before':>12} {'walk after':>11} {'total before':>13} {'total after':>12}  (ms)")
+    for i, result in enumerate(results):
+        print(
+            f"{i:>5} {result['walk_before'] * 1e3:>12.3f} {result['walk_after'] * 1e3:>11.3f} "
+            f"{result['total_before'] * 1e3:>13.3f} {result['total_after'] * 1e3:>12.3f}"
+        )
+    mean = {name: statistics.mean(result[name] for result in results) for name in results[0]}
+    print(
+        f"{'mean':>5} {mean['walk_before'] * 1e3:>12.3f} {mean['walk_after'] * 1e3:>11.3f} "
+        f"{mean['total_before'] * 1e3:>13.3f} {mean['total_after'] * 1e3:>12.3f}"
+    )
+    print(
+        f"Speed-up: {mean['walk_before'] / mean['walk_after']:.2f}x for the walk, "
+        f"{mean['total_before'] / mean['total_after']:.2f}x per query"
+    )
+
+
+def run_startup_probe(query: str, *, parser_state: str | None = None) -> dict[str, float]:
+    env = {key: value for key, value in os.environ.items() if key != PARSER_STATE_ENV}
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [str(SCRIPT_DIR), env.get("PYTHONPATH")]))
+    if parser_state is not None:
+        env[PARSER_STATE_ENV] = parser_state
+    output = subprocess.run(
+        [sys.executable, "-c", _STARTUP_PROBE, query], env=env, check=True, capture_output=True, text=True
+    ).stdout
+    return json.loads(output)
+
+
+def time_help(*, repeat: int) -> float:
+    """Median wall time, in seconds, of running adql_to_lsdb.py --help."""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(
+            [sys.executable, str(SCRIPT_DIR / "adql_to_lsdb.py"), "--help"], check=True, capture_output=True
+        )
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def bench_startup(queries: list[str], *, repeat: int):
+    """Measure start-up and first-query latencies, each in a fresh interpreter."""
+    print(f"adql_to_lsdb.py --help: {time_help(repeat=repeat) * 1e3:.1f} ms")
+
+    with tempfile.TemporaryDirectory() as directory:
+        state_path = os.path.join(directory, "parser.state")
+        corpus_path = os.path.join(directory, "corpus.txt")
+        with open(corpus_path, "w") as corpus:
+            corpus.writelines(" ".join(query.split()) + "\n" for query in queries)
+        subprocess.run(
+            [sys.executable, str(SCRIPT_DIR / "adql_to_lsdb.py"), "--save-parser-state", state_path, corpus_path],
+            check=True,
+            capture_output=True,
+        )
+
+        results = {"cold": [], "preloaded": []}
+        for _ in range(repeat):
+            for query in queries:
+                results["cold"].append(run_startup_probe(query))
+                results["preloaded"].append(run_startup_probe(query, parser_state=state_path))
+
+    print(f"{'parser state':>12} {'import':>8} {'first query':>12} {'second query':>13}  (median ms)")
+    for variant, probes in results.items():
+        median = {name: statistics.median(probe[name] for probe in probes) * 1e3 for name in probes[0]}
+        print(
+            f"{variant:>12} {median['import']:>8.1f} {median['first_query']:>12.1f} "
+            f"{median['second_query']:>13.1f}"
+        )
+
+
+def parse_args(argv: list[str] | None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark ADQL to LSDB translation")
+    parser.add_argument("-n", "--repeat", type=int, default=50, help="Number of timed runs per query")
+    parser.add_argument(
+        "--corpus-dir",
+        type=Path,
+        default=Path(__file__).parent,
+        help="Directory with additional sample*.adql queries (default: this script's directory)",
+    )
+    parser.add_argument(
+        "--startup",
+        action="store_true",
+        help="Measure import and first-query latency in fresh interpreters instead "
+        "(use a small --repeat, e.g. 3)",
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv: list[str] | None = None):
+    args = parse_args(argv)
+    queries = load_corpus(args.corpus_dir)
+    if args.startup:
+        bench_startup(queries, repeat=args.repeat)
+    else:
+        bench_parse(queries, repeat=args.repeat)
+
+
+if __name__ == "__main__":
+    main()
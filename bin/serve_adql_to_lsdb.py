@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+
+"""
+Long-running ADQL to LSDB translation service.
+
+Importing queryparser and warming up the ANTLR parser costs far more than
+translating a single query, so this keeps everything loaded and serves
+translations over HTTP, on a TCP port or a Unix socket:
+
+    POST /translate   body: ADQL text, or JSON {"query": ..., "id": ...}
+                      -> {"code": ...} (200) or {"error": {"type", "message"}} (400)
+    GET  /stats       -> parse cache counters and latency histograms
+    GET  /health      -> {"status": "ok"}
+
+Queries are looked up in a parameterized parse cache first, so repeated query
+shapes are translated without parsing. Misses are parsed by a pool of worker
+processes, each warmed up before the first request, so concurrent requests
+are parsed in parallel. Workers start faster when given a parser state saved
+with ``adql_to_lsdb.py --save-parser-state`` (``--parser-state``).
+"""
+
+import argparse
+import bisect
+import json
+import os
+import signal
+import socketserver
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from multiprocessing import Pool
+
+from adql_to_lsdb import PARSER_STATE_ENV, ADQLParseCache, LSDBQueryPlan, _warm_up_worker, parse_adql_entities
+
+# Upper bounds of the latency histogram buckets, in seconds: four per decade,
+# from 1 microsecond to 10 seconds, plus an overflow bucket.
+LATENCY_BUCKETS = tuple(10 ** (exponent / 4) for exponent in range(-24, 5))
+
+
+class LatencyHistogram:
+    """Thread-safe histogram of latencies over fixed, logarithmic buckets."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, seconds: float):
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            self.counts[index] += 1
+            self.total += seconds
+
+    def quantile(self, q: float, counts: list[int]) -> float | None:
+        """Upper bound of the bucket holding the q-quantile, in seconds."""
+        n = sum(counts)
+        if n == 0:
+            return None
+        rank = q * n
+        seen = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+    def snapshot(self) -> dict:
+        """Counts and approximate percentiles, in milliseconds."""
+        with self._lock:
+            counts = list(self.counts)
+            total = self.total
+        n = sum(counts)
+        return {
+            "count": n,
+            "mean_ms": total / n * 1e3 if n else None,
+            **{f"p{round(q * 100)}_ms": _to_ms(self.quantile(q, counts)) for q in (0.5, 0.9, 0.99)},
+            # Non-empty buckets as [upper bound in ms, count]
+            "buckets": [
+                [_to_ms(bound), count]
+                for bound, count in zip(self.buckets + (float("inf"),), counts)
+                if count
+            ],
+        }
+
+
+def _to_ms(seconds: float | None):
+    if seconds is None:
+        return None
+    return seconds * 1e3 if seconds != float("inf") else "inf"
+
+
+class TranslationService:
+    """
+    Translates ADQL queries with a shared parse cache and a pool of warm parser processes.
+
+    Latencies are recorded per outcome: "hit" when the parse cache had the
+    query's shape, "miss" when it had to be parsed, and "error".
+    """
+
+    def __init__(self, *, workers: int | None = None, cache_size: int = 4096):
+        # Every worker parses a query before the first request arrives
+        self.pool = Pool(processes=workers, initializer=_warm_up_worker)
+        self.cache = ADQLParseCache(cache_size, parse=self._parse)
+        self.latency = {outcome: LatencyHistogram() for outcome in ("hit", "miss", "error")}
+        self._local = threading.local()
+
+    def _parse(self, adql: str) -> dict:
+        self._local.parsed = True
+        return self.pool.apply(parse_adql_entities, (adql,))
+
+    def translate(self, adql: str) -> str:
+        """Translate a query to LSDB code, recording its latency."""
+        self._local.parsed = False
+        start = time.perf_counter()
+        try:
+            code = LSDBQueryPlan.from_entities(self.cache.get_entities(adql)).to_code()
+        except Exception:
+            self.latency["error"].record(time.perf_counter() - start)
+            raise
+        self.latency["miss" if self._local.parsed else "hit"].record(time.perf_counter() - start)
+        return code
+
+    def stats(self) -> dict:
+        return {
+            "cache": self.cache.stats(),
+            "latency": {outcome: histogram.snapshot() for outcome, histogram in self.latency.items()},
+        }
+
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()
+
+
+class TranslationRequestHandler(BaseHTTPRequestHandler):
+    """HTTP front end of a TranslationService, set as the server's ``service`` attribute."""
+
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        if self.path == "/health":
+            self._send_json(200, {"status": "ok"})
+        elif self.path == "/stats":
+            self._send_json(200, self.server.service.stats())
+        else:
+            self._send_json(404, {"error": {"type": "NotFound", "message": f"No such endpoint: {self.path}"}})
+
+    def do_POST(self):
+        if self.path != "/translate":
+            self._send_json(404, {"error": {"type": "NotFound", "message": f"No such endpoint: {self.path}"}})
+            return
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0))).decode("utf-8")
+        result = {}
+        try:
+            query = body
+            if body.lstrip().startswith("{"):
+                record = json.loads(body)
+                if "id" in record:
+                    result["id"] = record["id"]
+                if "query" not in record:
+                    raise ValueError('JSON request has no "query" key')
+                query = record["query"]
+            result["code"] = self.server.service.translate(query)
+        except Exception as e:
+            result["error"] = {"type": type(e).__name__, "message": str(e)}
+            self._send_json(400, result)
+            return
+        self._send_json(200, result)
+
+    def _send_json(self, status: int, payload: dict):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # Unix socket clients have no address
+        return self.client_address[0] if self.client_address else "unix"
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """ThreadingHTTPServer listening on a Unix socket."""
+
+    daemon_threads = True
+
+    def server_bind(self):
+        socketserver.UnixStreamServer.server_bind(self)
+        self.server_name = self.server_address
+        self.server_port = 0
+
+
+def make_server(service: TranslationService, *, host="127.0.0.1", port=8765, unix_socket=None, verbose=False):
+    """Create an HTTP server for service, on host:port or, if given, on the Unix socket path."""
+    if unix_socket is not None:
+        if os.path.exists(unix_socket):
+            os.unlink(unix_socket)
+        server = ThreadingUnixHTTPServer(unix_socket, TranslationRequestHandler)
+    else:
+        server = ThreadingHTTPServer((host, port), TranslationRequestHandler)
+    server.service = service
+    server.verbose = verbose
+    return server
+
+
+def parse_args(argv: list[str] | None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Serve ADQL to LSDB translations over HTTP")
+    parser.add_argument("--host", default="127.0.0.1", help="Address to listen on (default: 127.0.0.1)")
+    parser.add_argument("--port", type=int, default=8765, help="TCP port to listen on (default: 8765)")
+    parser.add_argument("--unix-socket", help="Listen on this Unix socket path instead of a TCP port")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="Number of parser worker processes (default: number of CPUs)",
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=4096,
+        help="Number of query shapes kept in the parse cache (default: 4096)",
+    )
+    parser.add_argument(
+        "--parser-state",
+        metavar="PATH",
+        help="Load the parser state saved with adql_to_lsdb.py --save-parser-state into every worker "
+        f"(default: ${PARSER_STATE_ENV}, if set)",
+    )
+    parser.add_argument("-v", "--verbose", action="store_true", help="Log every request to stderr")
+    return parser.parse_args(argv)
+
+
+def main(argv: list[str] | None = None):
+    args = parse_args(argv)
+    if args.parser_state is not None:
+        # Read by the workers' initializer
+        os.environ[PARSER_STATE_ENV] = args.parser_state
+    service = TranslationService(workers=args.workers, cache_size=args.cache_size)
+    server = make_server(
+        service, host=args.host, port=args.port, unix_socket=args.unix_socket, verbose=args.verbose
+    )
+    where = args.unix_socket or f"http://{args.host}:{server.server_port}"
+    print(f"Serving ADQL to LSDB translations on {where}", file=sys.stderr)
+    # Shut down cleanly when stopped by a process manager, too
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("\nShutting down.", file=sys.stderr)
+    finally:
+        server.server_close()
+        service.close()
+        if args.unix_socket is not None and os.path.exists(args.unix_socket):
+            os.unlink(args.unix_socket)
+
+
+if __name__ == "__main__":
+    main()
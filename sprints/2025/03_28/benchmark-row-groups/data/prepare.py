@@ -1,8 +1,15 @@
 #!/usr/bin/env python
 
 import argparse
+import re
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from pathlib import Path
+from typing import Callable, Iterable, Iterator
 
 import numpy as np
+import pyarrow as pa
 import pyarrow.parquet as pq
 from upath import UPath
 
@@ -29,55 +36,320 @@ def add_suffix(src: UPath, suffix: str) -> UPath:
     return src.parent / f"{src.stem}-{suffix}.parquet"
 
 
+# Rows read from the input at a time when sorting with a memory budget
+SORT_BATCH_SIZE = 1 << 14
+
+
+def _iter_batches(parquet_file: pq.ParquetFile, batch_size: int) -> Iterator[pa.RecordBatch]:
+    # One row group at a time: iterating over all of them reads ahead
+    for i_rg in range(parquet_file.num_row_groups):
+        yield from parquet_file.iter_batches(batch_size=batch_size, row_groups=[i_rg])
+
+
+def _spill_run(batches: list[pa.RecordBatch], schema: pa.Schema, column: str, path: Path) -> Path:
+    run = pa.Table.from_batches(batches, schema=schema).sort_by(column)
+    pq.write_table(run, path, row_group_size=max(1, run.num_rows // 16), compression="lz4")
+    return path
+
+
+def _merge_runs(paths: list[Path], column: str, block_rows: int) -> Iterator[pa.Table]:
+    """K-way merge of sorted run files, block_rows rows of each run in memory at a time."""
+    readers = [_iter_batches(pq.ParquetFile(path), block_rows) for path in paths]
+    blocks = [(pa.Table.from_batches([next(reader)]), reader) for reader in readers]
+    while blocks:
+        keys = [block[column].to_numpy() for block, _reader in blocks]
+        # The rows of a run not read yet sort after the last one of its block,
+        # so all rows up to the smallest last key are in their final order
+        # (np.sort puts NaN, i.e. nulls, last, like sort_by does).
+        cutoff = np.sort([key[-1] for key in keys])[0]
+        merged, next_blocks = [], []
+        for (block, reader), key in zip(blocks, keys):
+            n_rows = np.searchsorted(key, cutoff, side="right")
+            merged.append(block[:n_rows])
+            rest = block[n_rows:]
+            if rest.num_rows == 0:
+                batch = next(reader, None)
+                if batch is None:
+                    continue
+                rest = pa.Table.from_batches([batch])
+            next_blocks.append((rest, reader))
+        blocks = next_blocks
+        yield pa.concat_tables(merged).sort_by(column)
+
+
+def sorted_tables(
+        inp: UPath,
+        column: str,
+        *,
+        memory_budget: int | None = None,
+        tmp_dir: str | None = None,
+) -> Iterator[pa.Table]:
+    """
+    Yield the rows of a Parquet file sorted by column, as consecutive tables.
+
+    Without a memory budget, the whole file is read and sorted at once. With
+    memory_budget bytes, it is an external merge sort: runs of half the budget
+    are sorted and spilled to tmp_dir, then merged holding a block of every run.
+    """
+    with inp.open("rb") as f:
+        if memory_budget is None:
+            yield pq.read_table(f).sort_by(column)
+            return
+
+        parquet_file = pq.ParquetFile(f)
+        schema = parquet_file.schema_arrow
+        with tempfile.TemporaryDirectory(prefix="prepare-", dir=tmp_dir) as tmp:
+            paths = []
+            batches, n_bytes = [], 0
+            total_bytes = total_rows = 0
+            for batch in _iter_batches(parquet_file, SORT_BATCH_SIZE):
+                batches.append(batch)
+                n_bytes += batch.nbytes
+                total_bytes += batch.nbytes
+                total_rows += batch.num_rows
+                # The run and its sorted copy take the whole budget
+                if n_bytes >= memory_budget // 2:
+                    paths.append(_spill_run(batches, schema, column, Path(tmp) / f"run-{len(paths)}.parquet"))
+                    batches, n_bytes = [], 0
+            if not paths:
+                yield pa.Table.from_batches(batches, schema=schema).sort_by(column)
+                return
+            if batches:
+                paths.append(_spill_run(batches, schema, column, Path(tmp) / f"run-{len(paths)}.parquet"))
+            del batches
+
+            # A block of every run, the rows merged out of them and their sorted copy
+            bytes_per_row = total_bytes / total_rows
+            block_rows = max(1, int(memory_budget / (3 * len(paths) * bytes_per_row)))
+            print(f"Merging {len(paths)} sorted runs of {inp}, {block_rows} rows at a time")
+            yield from _merge_runs(paths, column, block_rows)
+
+
+class SortedRows:
+    """Rows of consecutive sorted tables, taken from the front."""
+
+    def __init__(self, tables: Iterable[pa.Table]):
+        self._tables = iter(tables)
+        self._buffer = []
+        self._num_rows = 0
+        self._exhausted = False
+
+    def _fill(self, done: Callable[[], bool]):
+        while not self._exhausted and not done():
+            table = next(self._tables, None)
+            if table is None:
+                self._exhausted = True
+            elif table.num_rows > 0:
+                self._buffer.append(table)
+                self._num_rows += table.num_rows
+
+    def _split(self, n_rows: int) -> pa.Table:
+        table = pa.concat_tables(self._buffer)
+        head, rest = table[:n_rows], table[n_rows:]
+        self._buffer = [rest] if rest.num_rows > 0 else []
+        self._num_rows = rest.num_rows
+        return head
+
+    def first(self, column: str):
+        """Value of column in the first row left, None if there are no rows left."""
+        self._fill(lambda: self._num_rows > 0)
+        return self._buffer[0][column][0].as_py() if self._buffer else None
+
+    def take(self, n_rows: int) -> pa.Table | None:
+        """The next n_rows rows (fewer at the end), None if there are no rows left."""
+        self._fill(lambda: self._num_rows >= n_rows)
+        if not self._buffer:
+            return None
+        return self._split(n_rows)
+
+    def take_below(self, column: str, value, schema: pa.Schema) -> pa.Table:
+        """The next rows with column below value, possibly none."""
+        self._fill(lambda: bool(self._buffer) and self._buffer[-1][column][-1].as_py() >= value)
+        if not self._buffer:
+            return schema.empty_table()
+        n_rows = sum(np.searchsorted(table[column].to_numpy(), value) for table in self._buffer)
+        return self._split(n_rows)
+
+
 def sort_and_split(
         inp: str | UPath,
         *,
         name: str | None,
         column: str,
         row_group_size: int,
+        data_page_size: int | None = None,
+        page_index: bool = False,
+        statistics: bool = True,
+        memory_budget: int | None = None,
+        tmp_dir: str | None = None,
         force: bool = False
 ) -> UPath:
     inp = UPath(inp)
     name = name or column
-    output = add_suffix(inp, f"{name}-{row_group_size}")
+    suffix = f"{name}-{row_group_size}"
+    if data_page_size is not None:
+        suffix += f"-page{data_page_size}"
+    if page_index:
+        suffix += "-pageindex"
+    if not statistics:
+        suffix += "-nostats"
+    output = add_suffix(inp, suffix)
     if not force and output.exists():
         return output
     print(f"Converting {inp} to {output}")
     with inp.open("rb") as f:
-        table = pq.read_table(f)
-
-    table = table.sort_by(column)
-
-    with output.open("wb") as f:
-        pq.write_table(table, f, row_group_size=row_group_size)
+        schema = pq.read_schema(f)
+
+    rows = SortedRows(sorted_tables(inp, column, memory_budget=memory_budget, tmp_dir=tmp_dir))
+    with output.open("wb") as f, pq.ParquetWriter(
+            f,
+            schema,
+            data_page_size=data_page_size,
+            write_page_index=page_index,
+            write_statistics=statistics,
+    ) as pw:
+        while (row_group := rows.take(row_group_size)) is not None:
+            pw.write_table(row_group, row_group_size=row_group_size)
 
     return output
 
 
-def deeper_healpix(file: str | UPath, *, order: int, diff_order: int, force: bool = False) -> UPath:
+def deeper_healpix(
+        file: str | UPath,
+        *,
+        order: int,
+        diff_order: int,
+        memory_budget: int | None = None,
+        tmp_dir: str | None = None,
+        force: bool = False,
+) -> UPath:
     inp = UPath(file)
     output = add_suffix(inp, f"healpix-{diff_order}")
     if not force and output.exists():
         return output
     print(f"Converting {inp} to {output}")
     with inp.open("rb") as f:
-        table = pq.read_table(f)
-    table = table.sort_by("_healpix_29")
+        schema = pq.read_schema(f)
+    rows = SortedRows(sorted_tables(inp, "_healpix_29", memory_budget=memory_budget, tmp_dir=tmp_dir))
 
     healpix29_table_range = 1 << (2 * (29 - order))
-    healpix29_table_start = table["_healpix_29"][0].as_py() // healpix29_table_range * healpix29_table_range
+    healpix29_table_start = rows.first("_healpix_29") // healpix29_table_range * healpix29_table_range
     healpix29_table_end = healpix29_table_start + healpix29_table_range
 
     healpix29_rowgroup_range = healpix29_table_range >> (2 * diff_order)
 
-    with output.open("wb") as f, pq.ParquetWriter(f, table.schema) as pw:
-        idx_start = 0
+    # Each row group is still held in memory whole, as pyarrow writes them at once
+    with output.open("wb") as f, pq.ParquetWriter(f, schema) as pw:
         for healpix29_rowgroup_start in range(healpix29_table_start, healpix29_table_end + healpix29_rowgroup_range, healpix29_rowgroup_range):
             healpix29_rowgroup_end = healpix29_rowgroup_start + healpix29_rowgroup_range
-            idx_end = np.searchsorted(table["_healpix_29"], healpix29_rowgroup_end)
-            pw.write_table(table[idx_start:idx_end], row_group_size=1 << 30)
-            idx_start = idx_end
+            pw.write_table(rows.take_below("_healpix_29", healpix29_rowgroup_end, schema), row_group_size=1 << 30)
+
+    return output
+
+
+# Codecs and levels of the compression sweep, the default (snappy) included
+CODECS = [("none", None), ("snappy", None), ("lz4", None), ("zstd", 1), ("zstd", 3), ("zstd", 9), ("zstd", 19)]
+# Row groups of the files recompressed for the sweep
+RECOMPRESS_ROW_GROUP_SIZE = 1 << 16
+
+
+def recompress(
+        inp: str | UPath,
+        *,
+        compression: str,
+        compression_level: int | None = None,
+        dictionary: bool = True,
+        byte_stream_split: bool = False,
+        force: bool = False,
+) -> UPath:
+    """
+    Rewrite a file with another codec and encodings, keeping its row groups.
+
+    With byte_stream_split, float columns are written with the BYTE_STREAM_SPLIT
+    encoding instead of dictionary encoding, which would take precedence.
+    The file is rewritten one row group at a time.
+    """
+    inp = UPath(inp)
+    suffix = compression if compression_level is None else f"{compression}{compression_level}"
+    if not dictionary:
+        suffix += "-nodict"
+    if byte_stream_split:
+        suffix += "-bss"
+    output = add_suffix(inp, suffix)
+    if not force and output.exists():
+        return output
+    print(f"Converting {inp} to {output}")
+    with inp.open("rb") as f_in, output.open("wb") as f_out:
+        parquet_file = pq.ParquetFile(f_in)
+        leaves = [parquet_file.schema.column(i) for i in range(len(parquet_file.schema))]
+        float_columns = [leaf.path for leaf in leaves if leaf.physical_type in ("FLOAT", "DOUBLE")]
+        if byte_stream_split and dictionary:
+            use_dictionary = [leaf.path for leaf in leaves if leaf.path not in float_columns]
+        else:
+            use_dictionary = dictionary
+        with pq.ParquetWriter(
+                f_out,
+                parquet_file.schema_arrow,
+                compression=compression,
+                compression_level=compression_level,
+                use_dictionary=use_dictionary,
+                use_byte_stream_split=float_columns if byte_stream_split else False,
+        ) as writer:
+            for i in range(parquet_file.num_row_groups):
+                row_group = parquet_file.read_row_group(i)
+                writer.write_table(row_group, row_group_size=row_group.num_rows)
+    return output
+
+
+# Sidecar index of a file's row groups, sorted by their smallest _healpix_29,
+# so that a cone's _healpix_29 range can be binary-searched
+ROW_GROUP_INDEX_DTYPE = np.dtype([
+    ("row_group", np.int32),
+    ("healpix_29_min", np.int64),
+    ("healpix_29_max", np.int64),
+    ("ra_min", np.float64),
+    ("ra_max", np.float64),
+    ("dec_min", np.float64),
+    ("dec_max", np.float64),
+])
+
+
+def row_group_index_path(file: str | UPath) -> UPath:
+    file = UPath(file)
+    return file.parent / f"{file.stem}.rgindex.npy"
+
+
+def write_row_group_index(file: str | UPath, force: bool = False) -> UPath:
+    file = UPath(file)
+    output = row_group_index_path(file)
+    if not force and output.exists():
+        return output
+    print(f"Indexing row groups of {file} to {output}")
+    with file.open("rb") as f:
+        metadata = pq.read_metadata(f)
+    names = metadata.schema.names
+    ra_column, dec_column = ("ra", "dec") if "ra" in names else ("objra", "objdec")
+
+    index = np.empty(metadata.num_row_groups, dtype=ROW_GROUP_INDEX_DTYPE)
+    index["row_group"] = np.arange(metadata.num_row_groups)
+    for field, column, unknown in (
+            ("healpix_29", "_healpix_29", (0, (1 << 62) - 1)),
+            ("ra", ra_column, (0.0, 360.0)),
+            ("dec", dec_column, (-90.0, 90.0)),
+    ):
+        i_column = names.index(column)
+        for i_rg in range(metadata.num_row_groups):
+            statistics = metadata.row_group(i_rg).column(i_column).statistics
+            # Without statistics, the row group may hold anything
+            if statistics is None or not statistics.has_min_max:
+                bounds = unknown
+            else:
+                bounds = statistics.min, statistics.max
+            index[f"{field}_min"][i_rg], index[f"{field}_max"][i_rg] = bounds
+    index.sort(order=["healpix_29_min", "row_group"])
 
+    with output.open("wb") as f:
+        np.save(f, index)
     return output
 
 
@@ -87,9 +359,44 @@ def parse_filename(file: str | UPath) -> tuple[str, int, int]:
     return prefix, int(order), int(pix)
 
 
+def run_jobs(jobs: list[Callable[[], UPath]], n_jobs: int) -> list[UPath]:
+    """Run independent preparation jobs in n_jobs processes, return their outputs in order."""
+    if n_jobs == 1:
+        return [job() for job in jobs]
+    with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+        futures = [executor.submit(job) for job in jobs]
+        return [future.result() for future in futures]
+
+
+def parse_size(value: str) -> int:
+    """Number of bytes of a size like 512MiB, 4GiB or 4G."""
+    match = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*([KMGT]?)(?:i?B)?\s*", value, flags=re.IGNORECASE)
+    if match is None:
+        raise argparse.ArgumentTypeError(f"Expected a size like 512MiB or 4GiB, got {value!r}")
+    number, unit = match.groups()
+    units = {"": 1, "K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+    return int(float(number) * units[unit.upper()])
+
+
 def parse_arguments(argv: list[str] | None = None) -> argparse.Namespace:
     parser = argparse.ArgumentParser(description="Prepare data for benchmarking")
     parser.add_argument("-f", "--force", action="store_true", help="Force download and prepare data")
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        help="Number of files prepared at once, each job but recompression holds a whole file in memory "
+        "unless --memory-budget is given",
+    )
+    parser.add_argument(
+        "-m",
+        "--memory-budget",
+        type=parse_size,
+        help="Sort with an external merge sort holding about this much data (e.g. 4GiB) per job, spilling sorted "
+        "runs to --tmp-dir, instead of sorting whole files in memory",
+    )
+    parser.add_argument("--tmp-dir", help="Directory of the sorted runs of --memory-budget (default: system temp)")
     args = parser.parse_args(argv)
     return args
 
@@ -99,10 +406,62 @@ def main(argv: list[str] | None = None):
 
     original_files = download_files(force=args.force)
 
+    # How sorting jobs hold their data, in memory or in sorted runs on disk
+    sort_options = {"memory_budget": args.memory_budget, "tmp_dir": args.tmp_dir}
+
+    jobs = []
+    # Positions in jobs of the _healpix_29-sorted files to recompress
+    recompress_jobs = []
+
     for binary_exp in range(10, 22, 2):
         row_group_size = 1 << binary_exp
         for orig_file in original_files:
-            _ = sort_and_split(orig_file, name=None, column="_healpix_29", row_group_size=row_group_size, force=args.force)
+            if row_group_size == RECOMPRESS_ROW_GROUP_SIZE:
+                recompress_jobs.append(len(jobs))
+            jobs.append(
+                partial(
+                    sort_and_split,
+                    orig_file,
+                    name=None,
+                    column="_healpix_29",
+                    row_group_size=row_group_size,
+                    **sort_options,
+                    force=args.force,
+                )
+            )
+
+    # Large row groups with page indexes, to compare page-level filtering with
+    # small row groups; without statistics, nothing can be pruned at all.
+    for binary_exp in range(16, 22, 2):
+        row_group_size = 1 << binary_exp
+        for data_page_size in (1 << 13, 1 << 16, 1 << 20):
+            for orig_file in original_files:
+                jobs.append(
+                    partial(
+                        sort_and_split,
+                        orig_file,
+                        name=None,
+                        column="_healpix_29",
+                        row_group_size=row_group_size,
+                        data_page_size=data_page_size,
+                        page_index=True,
+                        **sort_options,
+                        force=args.force,
+                    )
+                )
+        for orig_file in original_files:
+            jobs.append(
+                partial(
+                    sort_and_split,
+                    orig_file,
+                    name=None,
+                    column="_healpix_29",
+                    row_group_size=row_group_size,
+                    statistics=False,
+                    **sort_options,
+                    force=args.force,
+                )
+            )
 
     for binary_exp in range(10, 22, 2):
         row_group_size = 1 << binary_exp
@@ -115,7 +474,17 @@ def main(argv: list[str] | None = None):
             else:
                 raise ValueError(f"Unsupported prefix: {prefix}")
 
-            _ = sort_and_split(orig_file, name="filter", column=column, row_group_size=row_group_size, force=args.force)
+            jobs.append(
+                partial(
+                    sort_and_split,
+                    orig_file,
+                    name="filter",
+                    column=column,
+                    row_group_size=row_group_size,
+                    **sort_options,
+                    force=args.force,
+                )
+            )
 
     for binary_exp in range(10, 22, 2):
         row_group_size = 1 << binary_exp
@@ -128,13 +497,49 @@ def main(argv: list[str] | None = None):
             else:
                 raise ValueError(f"Unsupported prefix: {prefix}")
 
-            _ = sort_and_split(orig_file, name="id", column=column, row_group_size=row_group_size, force=args.force)
+            jobs.append(
+                partial(
+                    sort_and_split,
+                    orig_file,
+                    name="id",
+                    column=column,
+                    row_group_size=row_group_size,
+                    **sort_options,
+                    force=args.force,
+                )
+            )
 
     for diff_order in range(1, 7):
         for orig_file in original_files:
             _prefix, order, _pix = parse_filename(orig_file)
-            _ = deeper_healpix(orig_file, order=order, diff_order=diff_order)
-
+            jobs.append(partial(deeper_healpix, orig_file, order=order, diff_order=diff_order, **sort_options))
+
+    sorted_files = run_jobs(jobs, args.jobs)
+
+    # Codec and encoding sweep over the same row groups; snappy with
+    # dictionaries is what the sorted files have already.
+    jobs = []
+    for i_job in recompress_jobs:
+        for compression, compression_level in CODECS:
+            for dictionary, byte_stream_split in ((True, False), (False, False), (True, True)):
+                if compression == "snappy" and dictionary and not byte_stream_split:
+                    continue
+                jobs.append(
+                    partial(
+                        recompress,
+                        sorted_files[i_job],
+                        compression=compression,
+                        compression_level=compression_level,
+                        dictionary=dictionary,
+                        byte_stream_split=byte_stream_split,
+                        force=args.force,
+                    )
+                )
+    recompressed_files = run_jobs(jobs, args.jobs)
+
+    prepared_files = original_files + sorted_files + recompressed_files
+    jobs = [partial(write_row_group_index, file, force=args.force) for file in prepared_files]
+    _ = run_jobs(jobs, args.jobs)
 
 if __name__ == "__main__":
     main()
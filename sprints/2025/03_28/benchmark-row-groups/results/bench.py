@@ -1,42 +1,569 @@
 #!/usr/bin/env python
 
 import argparse
+import ctypes
+import gc
 import json
+import os
+import threading
 import time
 from abc import ABC, abstractmethod
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from copy import deepcopy
-from functools import lru_cache
+from functools import lru_cache, partial
 from typing import Callable
 
 import numpy as np
+import pyarrow as pa
 from pyarrow import NA
 import pyarrow.compute as pc
+import pyarrow.dataset as ds
 import pyarrow.parquet as pq
 from astropy.coordinates import Angle, Latitude, Longitude, SkyCoord
 from mocpy import MOC
 from upath import UPath
 
+import parquet_pages
 
-def read_table(file, *args, **kwargs):
+
+class ByteCounter:
+    """Thread-safe counter of bytes read: pyarrow may read from its own I/O threads."""
+
+    def __init__(self):
+        self.n_bytes = 0
+        self._lock = threading.Lock()
+
+    def add(self, n_bytes: int):
+        with self._lock:
+            self.n_bytes += n_bytes
+
+
+def read_buffer(f, size: int | None = None):
+    """f.read_buffer(), zero-copy for memory-mapped files, or f.read() for files without it."""
+    if hasattr(f, "read_buffer"):
+        return f.read_buffer(size)
+    return f.read(-1 if size is None else size)
+
+
+class MeteredFile:
+    """Read-only file object counting the bytes read through it."""
+
+    def __init__(self, f, counter: ByteCounter):
+        self._f = f
+        self._counter = counter
+
+    def read(self, size: int = -1) -> bytes:
+        data = self._f.read(size)
+        self._counter.add(len(data))
+        return data
+
+    def read_buffer(self, size: int | None = None):
+        # pyarrow prefers this to read() when present
+        data = read_buffer(self._f, size)
+        self._counter.add(len(data))
+        return data
+
+    def seek(self, offset: int, whence: int = 0) -> int:
+        return self._f.seek(offset, whence)
+
+    def tell(self) -> int:
+        return self._f.tell()
+
+    @property
+    def closed(self) -> bool:
+        return self._f.closed
+
+    def close(self):
+        self._f.close()
+
+
+class ReopenedFile:
+    """
+    File object reading from whichever handle is set at the moment.
+
+    A dataset fragment keeps its source file object for good, this lets it
+    read through a fresh handle every time.
+    """
+
+    def __init__(self):
+        self.handle = None
+
+    def read(self, size: int = -1) -> bytes:
+        return self.handle.read(size)
+
+    def read_buffer(self, size: int | None = None):
+        return read_buffer(self.handle, size)
+
+    def seek(self, offset: int, whence: int = 0) -> int:
+        return self.handle.seek(offset, whence)
+
+    def tell(self) -> int:
+        return self.handle.tell()
+
+    @property
+    def closed(self) -> bool:
+        return self.handle is None or self.handle.closed
+
+    def close(self):
+        pass
+
+
+class MemoryMappedPath:
+    """
+    Local path whose files are opened for reading with pa.memory_map(), so that
+    pyarrow decodes straight from the mapped pages; otherwise the UPath it wraps.
+    """
+
+    def __init__(self, path):
+        self._path = UPath(path)
+
+    def __getattr__(self, name):
+        return getattr(self._path, name)
+
+    def __truediv__(self, other) -> "MemoryMappedPath":
+        return MemoryMappedPath(self._path / other)
+
+    @property
+    def parent(self) -> "MemoryMappedPath":
+        return MemoryMappedPath(self._path.parent)
+
+    def glob(self, pattern: str):
+        return (MemoryMappedPath(path) for path in self._path.glob(pattern))
+
+    def open(self, mode: str = "r", *args, **kwargs):
+        if mode == "rb":
+            return pa.memory_map(self._path.path, "r")
+        return self._path.open(mode, *args, **kwargs)
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, MemoryMappedPath) and self._path == other._path
+
+    def __hash__(self) -> int:
+        return hash((MemoryMappedPath, self._path))
+
+    def __fspath__(self) -> str:
+        return os.fspath(self._path)
+
+    def __str__(self) -> str:
+        return str(self._path)
+
+    def __repr__(self) -> str:
+        return f"MemoryMappedPath({str(self._path)!r})"
+
+
+class FileMetadataCache:
+    """
+    Keeps the parsed Parquet footer of every file read through it, like a query
+    service with a metadata cache would.
+
+    Each file gets a dataset fragment with complete metadata: reading from it
+    prunes row groups with the cached statistics and reads only the column
+    chunks, without fetching or parsing the footer again. The file itself is
+    opened anew for every read, so no data is cached, and fragments are kept per
+    thread, as their source is swapped on every read.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def _fragments(self) -> dict:
+        if not hasattr(self._local, "fragments"):
+            self._local.fragments = {}
+        return self._local.fragments
+
+    def _read(self, file: UPath, f, func):
+        fragments = self._fragments()
+        if str(file) not in fragments:
+            source = ReopenedFile()
+            source.handle = f
+            fragment = ds.ParquetFileFormat().make_fragment(source)
+            fragment.ensure_complete_metadata()
+            fragments[str(file)] = source, fragment
+        source, fragment = fragments[str(file)]
+        source.handle = f
+        try:
+            return func(fragment)
+        finally:
+            source.handle = None
+
+    def load(self, file: UPath, *, pages: bool = False):
+        """
+        Read and parse the footer of file, unless it is cached already; with
+        pages=True, also the Thrift footer read_table_pages() uses.
+        """
+        with file.open("rb") as f:
+            self._read(file, f, lambda fragment: None)
+            if pages:
+                self.footer(file, f)
+
+    def metadata(self, file: UPath, f) -> pq.FileMetaData:
+        """Parquet metadata of file, read from f unless cached already."""
+        return self._read(file, f, lambda fragment: fragment.metadata)
+
+    def read_table(
+            self,
+            file: UPath,
+            f,
+            *,
+            columns: list[str] | None = None,
+            filters=None,
+            row_groups: list[int] | None = None,
+    ):
+        """Like read_table(), with f being an open handle of file."""
+        def read(fragment):
+            if row_groups is not None:
+                fragment = fragment.subset(row_group_ids=row_groups)
+            return fragment.to_table(columns=columns, filter=filters)
+
+        return self._read(file, f, read)
+
+    def footer(self, file: UPath, f) -> dict:
+        """Parsed Thrift footer of file, for parquet_pages, read from f unless cached already."""
+        if not hasattr(self._local, "footers"):
+            self._local.footers = {}
+        if str(file) not in self._local.footers:
+            self._local.footers[str(file)] = parquet_pages.read_footer(f)
+        return self._local.footers[str(file)]
+
+
+def read_table(
+        file,
+        *args,
+        row_groups: list[int] | None = None,
+        bytes_counter: ByteCounter | None = None,
+        metadata_cache: FileMetadataCache | None = None,
+        **kwargs,
+):
+    """
+    pq.read_table() of file, optionally only of the given row groups.
+
+    Filters still apply to the rows of those row groups.
+    """
     with file.open("rb") as f:
+        if bytes_counter is not None:
+            f = MeteredFile(f, bytes_counter)
         try:
+            if metadata_cache is not None:
+                return metadata_cache.read_table(file, f, *args, row_groups=row_groups, **kwargs)
+            if row_groups is not None:
+                columns, filters = kwargs.pop("columns", None), kwargs.pop("filters", None)
+                fragment = ds.ParquetFileFormat().make_fragment(f, row_groups=row_groups)
+                return fragment.to_table(*args, columns=columns, filter=filters, **kwargs)
             return pq.read_table(f, *args, **kwargs)
         except Exception as e:
             raise RuntimeError(f"Error reading table from {file}: {e}") from e
 
 
-def timeit(*, n_iter: int, index_sorted: int):
+def read_table_pages(
+        file,
+        *,
+        filter_column: str,
+        lower,
+        upper,
+        columns: list[str] | None = None,
+        filters=None,
+        bytes_counter: ByteCounter | None = None,
+        metadata_cache: FileMetadataCache | None = None,
+):
+    """
+    Read the rows of file with filter_column within [lower, upper], with
+    page-level filtering by the file's page index (see parquet_pages).
+
+    The pages read may hold other rows too, filters select the exact rows.
+    """
+    with file.open("rb") as f:
+        if bytes_counter is not None:
+            f = MeteredFile(f, bytes_counter)
+        try:
+            if metadata_cache is not None:
+                footer = metadata_cache.footer(file, f)
+            else:
+                footer = parquet_pages.read_footer(f)
+            table = parquet_pages.read_pages(
+                f, footer, filter_column=filter_column, lower=lower, upper=upper, columns=columns
+            )
+        except Exception as e:
+            raise RuntimeError(f"Error reading pages from {file}: {e}") from e
+    if filters is not None:
+        table = table.filter(filters)
+    if columns is not None:
+        table = table.select(columns)
+    return table
+
+
+def read_healpix_29_ranges(
+        file,
+        ranges: np.ndarray,
+        *,
+        columns: list[str] | None = None,
+        bytes_counter: ByteCounter | None = None,
+        metadata_cache: FileMetadataCache | None = None,
+):
+    """
+    Rows of file with a _healpix_29 within any of the sorted, disjoint
+    [start, end) ranges, reading the row groups which overlap them once.
+
+    Row groups are selected with their statistics, and rows with a binary
+    search of their _healpix_29 in the ranges.
+    """
+    starts, ends = ranges[:, 0], ranges[:, 1]
+    with file.open("rb") as f:
+        if bytes_counter is not None:
+            f = MeteredFile(f, bytes_counter)
+        try:
+            if metadata_cache is not None:
+                metadata = metadata_cache.metadata(file, f)
+            else:
+                fragment = ds.ParquetFileFormat().make_fragment(f)
+                fragment.ensure_complete_metadata()
+                metadata = fragment.metadata
+            i_column = metadata.schema.names.index("_healpix_29")
+            row_groups = []
+            for i_rg in range(metadata.num_row_groups):
+                statistics = metadata.row_group(i_rg).column(i_column).statistics
+                if statistics is None or not statistics.has_min_max:
+                    row_groups.append(i_rg)
+                    continue
+                # The last range starting at or before the row group's max must end after its min
+                i_range = np.searchsorted(starts, statistics.max, side="right") - 1
+                if i_range >= 0 and ends[i_range] > statistics.min:
+                    row_groups.append(i_rg)
+            if metadata_cache is not None:
+                table = metadata_cache.read_table(file, f, columns=columns, row_groups=row_groups)
+            else:
+                table = fragment.subset(row_group_ids=row_groups).to_table(columns=columns)
+        except Exception as e:
+            raise RuntimeError(f"Error reading table from {file}: {e}") from e
+    healpix_29 = table["_healpix_29"].to_numpy()
+    i_range = np.searchsorted(starts, healpix_29, side="right") - 1
+    return table.filter((i_range >= 0) & (healpix_29 < ends[np.maximum(i_range, 0)]))
+
+
+def read_multi_cone(
+        file,
+        ranges: np.ndarray,
+        cone_ra: np.ndarray,
+        cone_dec: np.ndarray,
+        radius_arcsec: float,
+        *,
+        columns: list[str] | None = None,
+        **kwargs,
+):
+    """Rows of file within any of the cones, read at once, with the index of their cone in a "cone" column."""
+    ra_column, dec_column = ra_dec_columns(file)
+    read_columns = None if columns is None else list(dict.fromkeys([*columns, "_healpix_29", ra_column, dec_column]))
+    table = read_healpix_29_ranges(file, ranges, columns=read_columns, **kwargs)
+    rows, cones = match_cones(
+        table[ra_column].to_numpy(), table[dec_column].to_numpy(), cone_ra, cone_dec, radius_arcsec
+    )
+    if columns is not None:
+        table = table.select(columns)
+    return table.take(rows).append_column("cone", pa.array(cones))
+
+
+def read_cones_one_by_one(
+        file,
+        cone_ranges: list[tuple[int, int]],
+        cone_ra: np.ndarray,
+        cone_dec: np.ndarray,
+        radius_arcsec: float,
+        *,
+        columns: list[str] | None = None,
+        **kwargs,
+):
+    """Same as read_multi_cone(), with a read per cone, filtered by its [min, max] _healpix_29 range."""
+    ra_column, dec_column = ra_dec_columns(file)
+    read_columns = None if columns is None else list(dict.fromkeys([*columns, ra_column, dec_column]))
+    tables = []
+    for i_cone, (min_healpix_29, max_healpix_29) in enumerate(cone_ranges):
+        expression = (pc.field("_healpix_29") >= min_healpix_29) & (pc.field("_healpix_29") <= max_healpix_29)
+        table = read_table(file, columns=read_columns, filters=expression, **kwargs)
+        rows, _cones = match_cones(
+            table[ra_column].to_numpy(), table[dec_column].to_numpy(), cone_ra[i_cone:i_cone + 1],
+            cone_dec[i_cone:i_cone + 1], radius_arcsec
+        )
+        if columns is not None:
+            table = table.select(columns)
+        tables.append(table.take(rows).append_column("cone", pa.array(np.full(len(rows), i_cone))))
+    return pa.concat_tables(tables)
+
+
+@lru_cache(maxsize=64)
+def on_disk_sizes(file: UPath, columns: tuple[str, ...] | None) -> dict[str, int]:
+    """
+    Size of file, and the compressed and uncompressed sizes of the column
+    chunks of the given top-level columns (all by default), from its footer.
+    """
+    with file.open("rb") as f:
+        metadata = pq.read_metadata(f)
+    compressed_size = uncompressed_size = 0
+    for i_rg in range(metadata.num_row_groups):
+        row_group = metadata.row_group(i_rg)
+        for i_column in range(row_group.num_columns):
+            column = row_group.column(i_column)
+            if columns is None or column.path_in_schema.split(".")[0] in columns:
+                compressed_size += column.total_compressed_size
+                uncompressed_size += column.total_uncompressed_size
+    return {
+        "file_size": file.stat().st_size,
+        "compressed_size": compressed_size,
+        "uncompressed_size": uncompressed_size,
+    }
+
+
+def row_group_index_path(file: UPath) -> UPath:
+    """Path of the row-group index written by data/prepare.py next to file."""
+    return file.parent / f"{file.stem}.rgindex.npy"
+
+
+class RowGroupIndex:
+    """
+    Sidecar index of a file's row groups: their _healpix_29 and ra/dec bounds,
+    sorted by the smallest _healpix_29, as written by data/prepare.py.
+    """
+
+    def __init__(self, index: np.ndarray):
+        self.index = index
+        # Row groups may overlap, e.g. in files sorted by another column: the
+        # largest _healpix_29 up to each row group is sorted all the same.
+        self.healpix_29_max_so_far = np.maximum.accumulate(index["healpix_29_max"])
+
+    @classmethod
+    def load(cls, file: UPath) -> "RowGroupIndex":
+        path = row_group_index_path(file)
+        if not path.exists():
+            raise FileNotFoundError(f"No row-group index {path} for {file}, run data/prepare.py to create it")
+        with path.open("rb") as f:
+            return cls(np.load(f))
+
+    def select_healpix_29(self, min_healpix_29: int, max_healpix_29: int) -> list[int]:
+        """Row groups which may hold a _healpix_29 in the range, found by binary search."""
+        start = np.searchsorted(self.healpix_29_max_so_far, min_healpix_29, side="left")
+        end = np.searchsorted(self.index["healpix_29_min"], max_healpix_29, side="right")
+        candidates = self.index[start:end]
+        return np.sort(candidates["row_group"][candidates["healpix_29_max"] >= min_healpix_29]).tolist()
+
+    def select_ra_dec(self, limits: dict[str, tuple[float, float]]) -> list[int]:
+        """Row groups which may hold a point within the ra/dec limits."""
+        mask = np.ones(len(self.index), dtype=bool)
+        for coord, (lower, upper) in limits.items():
+            mask &= (self.index[f"{coord}_min"] <= upper) & (self.index[f"{coord}_max"] >= lower)
+        return np.sort(self.index["row_group"][mask]).tolist()
+
+
+def read_indexed(file, select: Callable[[], list[int]], **kwargs):
+    """read_table() of the row groups select() returns, so that the index lookup is timed too."""
+    return read_table(file, row_groups=select(), **kwargs)
+
+
+def is_local(file: UPath) -> bool:
+    return file.protocol in ("", "file", "local")
+
+
+def drop_page_cache(file: UPath):
+    """Evict a local file from the OS page cache, so that the next read of it hits the disk."""
+    if not is_local(file):
+        # Nothing is cached on this side, apart from what the server does
+        return
+    fd = os.open(file.path, os.O_RDONLY)
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
+
+def _proc_status_bytes(field: str) -> int:
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith(f"{field}:"):
+                return int(line.split()[1]) * 1024
+    raise ValueError(f"No {field} in /proc/self/status")
+
+
+def can_measure_peak_rss() -> bool:
+    """Whether the peak RSS of the process can be reset, which only Linux allows."""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+class PeakRSS:
+    """
+    Largest growth of the resident set size of the process during a run, in
+    bytes: its peak (VmHWM), reset before the run, less its RSS at that time.
+    """
+
+    def __init__(self):
+        self.n_bytes = 0
+
+    @staticmethod
+    def start() -> int:
+        # Memory kept by the allocators from earlier runs would be reused unseen
+        gc.collect()
+        pa.default_memory_pool().release_unused()
+        # glibc only, e.g. musl has no malloc_trim()
+        malloc_trim = getattr(ctypes.CDLL(None), "malloc_trim", None)
+        if malloc_trim is not None:
+            malloc_trim(0)
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return _proc_status_bytes("VmRSS")
+
+    @staticmethod
+    def stop(start: int) -> int:
+        return _proc_status_bytes("VmHWM") - start
+
+    def add(self, n_bytes: int):
+        self.n_bytes = max(self.n_bytes, n_bytes)
+
+
+def timeit(
+        *,
+        n_iter: int,
+        index_sorted: int,
+        cold: bool = False,
+        bytes_read: ByteCounter | None = None,
+        peak_rss: PeakRSS | None = None,
+        metadata_cache: FileMetadataCache | None = None,
+):
+    """
+    Time func(file, ...) n_iter times and return the index_sorted-th shortest time.
+
+    With cold=True, the file is evicted from the page cache before every run.
+    If bytes_read is given, func must take a bytes_counter argument, like
+    read_table, and the bytes read by the returned run are added to it.
+    If peak_rss is given, the RSS growth of the returned run is added to it.
+    If metadata_cache is given, it is passed to func, which must take it like
+    read_table does.
+    """
     assert index_sorted < n_iter
     def decorator(func):
-        def timeit_wrapper(*args, **kwargs):
-            times = []
+        def timeit_wrapper(file, *args, **kwargs):
+            runs = []
             for _ in range(n_iter):
+                if cold:
+                    drop_page_cache(file)
+                counter = ByteCounter()
+                if bytes_read is not None:
+                    kwargs["bytes_counter"] = counter
+                if metadata_cache is not None:
+                    kwargs["metadata_cache"] = metadata_cache
+                _result = None
+                rss_start = PeakRSS.start() if peak_rss is not None else None
                 start = time.monotonic()
-                _result = func(*args, **kwargs)
+                _result = func(file, *args, **kwargs)
                 end = time.monotonic()
-                times.append(end - start)
-            sorted_times = sorted(times)
-            return sorted_times[index_sorted]
+                rss_growth = PeakRSS.stop(rss_start) if peak_rss is not None else 0
+                runs.append((end - start, counter.n_bytes, rss_growth))
+            elapsed, n_bytes, rss_growth = sorted(runs)[index_sorted]
+            if bytes_read is not None:
+                bytes_read.add(n_bytes)
+            if peak_rss is not None:
+                peak_rss.add(rss_growth)
+            return elapsed
         return timeit_wrapper
     return decorator
 
@@ -75,9 +602,59 @@ def apply_random_offset(ra: float, dec: float, offset_arcsec: float, random_stat
     return float(result.ra.deg), float(result.dec.deg)
 
 
+def offset_by(ra: np.ndarray, dec: np.ndarray, position_angle: np.ndarray, separation: np.ndarray):
+    """
+    Vectorized SkyCoord.directional_offset_by(): coordinates at separation
+    from (ra, dec) towards position_angle (east of north), all in degrees.
+    """
+    lon, lat = np.deg2rad(ra), np.deg2rad(dec)
+    angle, distance = np.deg2rad(position_angle), np.deg2rad(separation)
+    new_lat = np.arcsin(np.sin(lat) * np.cos(distance) + np.cos(lat) * np.sin(distance) * np.cos(angle))
+    new_lon = lon + np.arctan2(
+        np.sin(angle) * np.sin(distance) * np.cos(lat), np.cos(distance) - np.sin(lat) * np.sin(new_lat)
+    )
+    return np.rad2deg(new_lon) % 360.0, np.rad2deg(new_lat)
+
+
+def angular_distance(ra1: np.ndarray, dec1: np.ndarray, ra2: np.ndarray, dec2: np.ndarray) -> np.ndarray:
+    """Great-circle distance in degrees, with the haversine formula."""
+    lon1, lat1, lon2, lat2 = map(np.deg2rad, (ra1, dec1, ra2, dec2))
+    a = np.sin(0.5 * (lat2 - lat1)) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin(0.5 * (lon2 - lon1)) ** 2
+    return np.rad2deg(2.0 * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0))))
+
+
+def match_cones(
+        ra: np.ndarray, dec: np.ndarray, cone_ra: np.ndarray, cone_dec: np.ndarray, radius_arcsec: float
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    (row, cone) index pairs of the points within radius_arcsec of the cone centers.
+
+    Candidate cones of every point are found by binary search in the cones
+    sorted by declination, then all candidate pairs are tested at once.
+    """
+    radius = radius_arcsec / 3600.0
+    order = np.argsort(cone_dec)
+    sorted_dec = cone_dec[order]
+    lower = np.searchsorted(sorted_dec, dec - radius, side="left")
+    upper = np.searchsorted(sorted_dec, dec + radius, side="right")
+    counts = upper - lower
+    rows = np.repeat(np.arange(len(ra)), counts)
+    # Position of every pair within the candidates of its row
+    offsets = np.arange(len(rows)) - np.repeat(np.cumsum(counts) - counts, counts)
+    cones = order[np.repeat(lower, counts) + offsets]
+    matched = angular_distance(ra[rows], dec[rows], cone_ra[cones], cone_dec[cones]) <= radius
+    return rows[matched], cones[matched]
+
+
 class Measurer(ABC):
     weight: float
     name: str
+    # Whether measure() reads pages with read_table_pages()
+    page_index: bool = False
+
+    def applies_to(self, suffix: str) -> bool:
+        """Whether to measure files with the given suffix."""
+        return True
 
     @abstractmethod
     def measure(self, file: UPath, timeit_decorator, *, columns: list[str] | None) -> float:
@@ -93,10 +670,32 @@ class FullRead(Measurer):
 
 
 class Cone(Measurer):
-    def __init__(self, *, name: str, radius_arcsec: float, n_samples: int):
+    """
+    Reads cones around random objects. With index=True, row groups are selected
+    with the file's RowGroupIndex instead of Parquet's row-group statistics.
+    With page_index=True, pages are selected with the file's page index of
+    _healpix_29, so that only parts of large row groups are read.
+    """
+
+    def __init__(
+            self, *, name: str, radius_arcsec: float, n_samples: int, index: bool = False, page_index: bool = False
+    ):
+        if index and page_index:
+            raise ValueError("Cones use either the row-group index or the page index")
+        if index:
+            name = f"{name} with row-group index"
+        elif page_index:
+            name = f"{name} with page index"
         self.name = name
         self.radius_arcsec = radius_arcsec
         self.n_samples = n_samples
+        self.index = index
+        self.page_index = page_index
+
+    def applies_to(self, suffix: str) -> bool:
+        # Without a page index, every page of the selected row groups is read,
+        # only slower than read_table() as the footer is parsed in Python
+        return not self.page_index or "-pageindex" in suffix
 
     @lru_cache
     def get_healpix_29_range(self, ra: float, dec: float, radius_arcsec: float) -> tuple[int, int]:
@@ -115,6 +714,7 @@ class Cone(Measurer):
     def measure(self, file: UPath, timeit_decorator, *, columns: list[str] | None) -> float:
         ra_column, dec_column = ra_dec_columns(file)
         table = read_table(file, columns=[ra_column, dec_column])
+        row_group_index = RowGroupIndex.load(file) if self.index else None
         rng = np.random.default_rng(0)
         idx = rng.choice(table.num_rows, self.n_samples)
         result = 0
@@ -122,15 +722,34 @@ class Cone(Measurer):
             ra, dec = self.get_ra_dec(table[ra_column][i].as_py(), table[dec_column][i].as_py(), rng)
             min_healpix_29, max_healpix_29 = self.get_healpix_29_range(ra, dec, self.radius_arcsec)
             expression = (pc.field("_healpix_29") >= min_healpix_29) & (pc.field("_healpix_29") <= max_healpix_29)
-            result += timeit_decorator(read_table)(file, columns=columns, filters=expression)
+            if self.page_index:
+                result += timeit_decorator(read_table_pages)(
+                    file,
+                    filter_column="_healpix_29",
+                    lower=min_healpix_29,
+                    upper=max_healpix_29,
+                    columns=columns,
+                    filters=expression,
+                )
+            elif row_group_index is None:
+                result += timeit_decorator(read_table)(file, columns=columns, filters=expression)
+            else:
+                select = partial(row_group_index.select_healpix_29, min_healpix_29, max_healpix_29)
+                result += timeit_decorator(read_indexed)(file, select, columns=columns, filters=expression)
         return result
 
 
 class SmallCone(Cone):
     weight = 1.0
 
-    def __init__(self, *, n_samples: int = 10):
-        super().__init__(name="Small cone", radius_arcsec=3.0, n_samples=n_samples)
+    def __init__(self, *, n_samples: int = 10, index: bool = False, page_index: bool = False):
+        super().__init__(
+            name="Small cone",
+            radius_arcsec=3.0,
+            n_samples=n_samples,
+            index=index,
+            page_index=page_index,
+        )
 
     def get_ra_dec(self, obj_ra: float, obj_dec: float, random_state) -> tuple[float, float]:
         del random_state
@@ -140,8 +759,14 @@ class SmallCone(Cone):
 class LargeCone(Cone):
     weight = 1.0
 
-    def __init__(self, *, n_samples: int = 3):
-        super().__init__(name="Large cone", radius_arcsec=3600.0, n_samples=n_samples)
+    def __init__(self, *, n_samples: int = 3, index: bool = False, page_index: bool = False):
+        super().__init__(
+            name="Large cone",
+            radius_arcsec=3600.0,
+            n_samples=n_samples,
+            index=index,
+            page_index=page_index,
+        )
         self.offset_factor = 0.9
         self.offset_arcsec = self.radius_arcsec * self.offset_factor
 
@@ -150,10 +775,16 @@ class LargeCone(Cone):
 
 
 class Box(Measurer):
-    def __init__(self, *, name: str, size_arcsec: float, n_samples: int):
-        self.name = name
+    """
+    Reads ra/dec boxes around random objects. With index=True, row groups are
+    selected with the file's RowGroupIndex instead of Parquet's row-group statistics.
+    """
+
+    def __init__(self, *, name: str, size_arcsec: float, n_samples: int, index: bool = False):
+        self.name = f"{name} with row-group index" if index else name
         self.size_arcsec = size_arcsec
         self.n_samples = n_samples
+        self.index = index
 
     @abstractmethod
     def get_ra_dec_limits(self, obj_ra: float, obj_dec: float, random_state) -> dict[str, tuple[float, float]]:
@@ -162,6 +793,7 @@ class Box(Measurer):
     def measure(self, file: UPath, timeit_decorator, *, columns: list[str] | None) -> float:
         ra_column, dec_column = ra_dec_columns(file)
         table = read_table(file, columns=[ra_column, dec_column])
+        row_group_index = RowGroupIndex.load(file) if self.index else None
         rng = np.random.default_rng(0)
         idx = rng.choice(table.num_rows, self.n_samples)
         result = 0
@@ -173,15 +805,19 @@ class Box(Measurer):
                 & (pc.field(dec_column) >= limits["dec"][0])
                 & (pc.field(dec_column) <= limits["dec"][1])
             )
-            result += timeit_decorator(read_table)(file, columns=columns, filters=expression)
+            if row_group_index is None:
+                result += timeit_decorator(read_table)(file, columns=columns, filters=expression)
+            else:
+                select = partial(row_group_index.select_ra_dec, limits)
+                result += timeit_decorator(read_indexed)(file, select, columns=columns, filters=expression)
         return result
 
 
 class SmallBox(Box):
     weight = 1.0
 
-    def __init__(self, *, n_samples: int = 10):
-        super().__init__(name="Small box", size_arcsec=6.0, n_samples=n_samples)
+    def __init__(self, *, n_samples: int = 10, index: bool = False):
+        super().__init__(name="Small box", size_arcsec=6.0, n_samples=n_samples, index=index)
 
     def get_ra_dec_limits(self, obj_ra: float, obj_dec: float, random_state) -> dict[str, tuple[float, float]]:
         del random_state
@@ -197,8 +833,8 @@ class SmallBox(Box):
 class LargeBox(Box):
     weight = 1.0
 
-    def __init__(self, *, n_samples: int = 3):
-        super().__init__(name="Large box", size_arcsec=7200.0, n_samples=n_samples)
+    def __init__(self, *, n_samples: int = 3, index: bool = False):
+        super().__init__(name="Large box", size_arcsec=7200.0, n_samples=n_samples, index=index)
         self.offset_factor = 0.25  # smaller than 0.5
         self.offset_arcsec = self.size_arcsec * self.offset_factor
 
@@ -213,6 +849,72 @@ class LargeBox(Box):
         }
 
 
+class MultiCone(Measurer):
+    """
+    Reads a batch of small cones around random objects at once, like a forced
+    photometry list: the union of their _healpix_29 ranges, from a single MOC,
+    selects the row groups, which are read once, and rows are assigned to
+    cones with a vectorized distance test. With one_by_one=True, the same
+    cones are read one at a time, as n_cones small cones would be.
+    """
+    weight = 1.0
+
+    def __init__(
+            self, *, n_cones: int = 1000, radius_arcsec: float = 3.0, n_samples: int = 1, one_by_one: bool = False
+    ):
+        self.name = "Multi cone one by one" if one_by_one else "Multi cone"
+        self.n_cones = n_cones
+        self.radius_arcsec = radius_arcsec
+        self.n_samples = n_samples
+        self.one_by_one = one_by_one
+        self.offset_arcsec = radius_arcsec
+
+    def get_ra_dec(self, obj_ra: np.ndarray, obj_dec: np.ndarray, rng) -> tuple[np.ndarray, np.ndarray]:
+        position_angle = rng.uniform(0, 360, len(obj_ra))
+        separation = rng.uniform(0, self.offset_arcsec, len(obj_ra)) / 3600.0
+        return offset_by(obj_ra, obj_dec, position_angle, separation)
+
+    def get_mocs(self, ra: np.ndarray, dec: np.ndarray, union_strategy: str | None):
+        # Cells about the cone size, refined by MOC.from_cones' delta_depth
+        radius_rad = np.deg2rad(self.radius_arcsec / 3600.0)
+        depth = int(np.clip(np.floor(np.log2(np.sqrt(np.pi / 3.0) / radius_rad)), 0, 27))
+        return MOC.from_cones(
+            lon=Longitude(ra, "deg"),
+            lat=Latitude(dec, "deg"),
+            radius=Angle(self.radius_arcsec, "arcsec"),
+            max_depth=depth,
+            union_strategy=union_strategy,
+        )
+
+    def get_healpix_29_ranges(self, ra: np.ndarray, dec: np.ndarray) -> np.ndarray:
+        """Sorted, disjoint [start, end) _healpix_29 ranges of the union of the cones."""
+        return self.get_mocs(ra, dec, union_strategy="small_cones").to_depth29_ranges
+
+    def get_cone_ranges(self, ra: np.ndarray, dec: np.ndarray) -> list[tuple[int, int]]:
+        """[min, max] _healpix_29 of every cone, of the same coverage as get_healpix_29_ranges()."""
+        return [(moc.min_index, moc.max_index) for moc in self.get_mocs(ra, dec, union_strategy=None)]
+
+    def measure(self, file: UPath, timeit_decorator, *, columns: list[str] | None) -> float:
+        ra_column, dec_column = ra_dec_columns(file)
+        table = read_table(file, columns=[ra_column, dec_column])
+        obj_ra, obj_dec = table[ra_column].to_numpy(), table[dec_column].to_numpy()
+        rng = np.random.default_rng(0)
+        result = 0
+        for _ in range(self.n_samples):
+            idx = rng.choice(table.num_rows, self.n_cones)
+            ra, dec = self.get_ra_dec(obj_ra[idx], obj_dec[idx], rng)
+            # Cone coverages are computed before timing, as Cone does
+            if self.one_by_one:
+                cone_ranges = self.get_cone_ranges(ra, dec)
+                result += timeit_decorator(read_cones_one_by_one)(
+                    file, cone_ranges, ra, dec, self.radius_arcsec, columns=columns
+                )
+            else:
+                ranges = self.get_healpix_29_ranges(ra, dec)
+                result += timeit_decorator(read_multi_cone)(file, ranges, ra, dec, self.radius_arcsec, columns=columns)
+        return result
+
+
 class SelectSingleId(Measurer):
     weight = 1.0
     name = "Select single ID"
@@ -286,14 +988,31 @@ class FilterColumnManyRows(FilterColumn):
         super().__init__("Filter column with many result rows", (0.4, 0.6))
 
 
+def cell_name(suffix: str, m: Measurer, storage: str, catalog: str, col_type: str) -> str:
+    return f'"{suffix}" / "{m.name}" / {storage} storage / {catalog} / "{col_type}" columns'
+
+
 class Runner:
     path_roots = {
         "local": UPath("../data"),
+        "local-mmap": MemoryMappedPath("../data"),
         "remote": UPath("s3://bucket", key="admin", secret="password", endpoint_url="http://localhost:9000"),
     }
 
-    timeit_iters = {"local": 2, "remote": 1}
-    timeit_index = {"local": 0, "remote": 0}
+    # Number of cells measured at once with --parallel: remote cells overlap
+    # their network latency, local ones run one at a time, all local storages
+    # together, so that they do not compete for the disk and page cache.
+    concurrency = {"local": 1, "local-mmap": 1, "remote": 4}
+
+    # Variants of every measurement: the OS page cache is "warm" (the fastest of
+    # timeit_iters runs) or "cold" (the file is evicted before each run), and
+    # the Parquet footer is "reread" by every read or "cached" in a
+    # FileMetadataCache, loaded before timing.
+    cache_modes = ["warm", "cold"]
+    footer_modes = ["reread", "cached"]
+
+    timeit_iters = {"local": 2, "local-mmap": 2, "remote": 1}
+    timeit_index = {"local": 0, "local-mmap": 0, "remote": 0}
 
     prefixes = {"gaia": "gaia_dr3-2-0", "ztf": "ztf_dr22-6-21554"}
 
@@ -322,6 +1041,9 @@ class Runner:
             force: bool = False,
             storages: list[str] | None = None,
             catalogs: list[str] | None = None,
+            concurrency: dict[str, int] | None = None,
+            cache_modes: list[str] | None = None,
+            footer_modes: list[str] | None = None,
     ):
         self.measurers = m
         assert len(set(meas.name for meas in self.measurers)) == len(self.measurers), 'Non-unique measurer names'
@@ -329,6 +1051,22 @@ class Runner:
         self.force = force
         self.storages = storages or list(self.path_roots)
         self.catalogs = catalogs or list(self.prefixes)
+        # None runs all cells serially, in order
+        self.concurrency = None if concurrency is None else self.concurrency | concurrency
+        self.cache_modes = cache_modes or ["warm"]
+        self.footer_modes = footer_modes or ["reread"]
+        self.metadata_cache = FileMetadataCache()
+        # The peak RSS, the garbage collector and malloc_trim() are process-wide,
+        # so other cells' reads would land in the peak of a parallel one
+        self.measure_peak_rss = self.concurrency is None and can_measure_peak_rss()
+        if "cold" in self.cache_modes and not hasattr(os, "posix_fadvise"):
+            raise ValueError("Cold page cache measurements require posix_fadvise, which is not available here")
+        if self.concurrency is not None:
+            if "cold" in self.cache_modes:
+                raise ValueError("Cold page cache measurements can't run in parallel: an eviction slows other reads")
+            for storage in self.storages:
+                if self.is_local_storage(storage) and self.concurrency[storage] != 1:
+                    raise ValueError(f"Cells of local storage {storage!r} share the disk, they can't run at once")
 
         if not self.output.exists() or force:
             previous_results = {}
@@ -361,42 +1099,139 @@ class Runner:
         with self.output.open("w") as f:
             f.write(json_string)
 
-    def run(self):
-        results = deepcopy(self.previous_results)
-
-        suffixes = self.get_suffixes()
-
-        for suffix in suffixes:
-            print(f'Running for "{suffix}"')
-            suffix_results = results.setdefault(suffix, {})
-
+    @staticmethod
+    def result_key(name: str, cache_mode: str, footer_mode: str) -> str:
+        """
+        Key of a "time", "bytes_read" or "peak_rss" in results.json: the name
+        itself for the default variant, prefixed with "cold_" (but for
+        "bytes_read", the same either way) and "footer_cached_".
+        """
+        if name in ("time", "peak_rss") and cache_mode == "cold":
+            name = f"cold_{name}"
+        if footer_mode == "cached":
+            name = f"footer_cached_{name}"
+        return name
+
+    def cells(self, results):
+        """
+        Yield (suffix, measurer, storage, catalog, col_type, columns, variants) of every cell, in run order,
+        with the (cache mode, footer mode) variants not in results yet.
+        """
+        for suffix in self.get_suffixes():
             for m in self.measurers:
-                print(f'  Running "{m.name}"')
-                m_results = suffix_results.setdefault(m.name, {})
-
+                if not m.applies_to(suffix):
+                    continue
                 for storage in self.storages:
-                    root = self.path_roots[storage]
-                    print(f'    Running for "{storage} storage"')
-                    storage_results = m_results.setdefault(storage, {})
-                    n_iter = self.timeit_iters[storage]
-                    timeit_index = self.timeit_index[storage]
-                    timeit_decorator = timeit(n_iter=n_iter, index_sorted=timeit_index)
-
                     for catalog in self.catalogs:
-                        prefix = self.prefixes[catalog]
-                        file = root / f"{prefix}{suffix}.parquet"
-                        print(f'      Running for "{file.name}"')
-                        catalog_results = storage_results.setdefault(catalog, {})
-
+                        done = results.get(suffix, {}).get(m.name, {}).get(storage, {}).get(catalog, {})
                         for col_type, columns in self.columns[catalog].items():
-                            if col_type in catalog_results:
-                                print(f'        Skipping "{col_type}" columns')
+                            variants = [
+                                (cache_mode, footer_mode)
+                                for footer_mode in self.footer_modes
+                                for cache_mode in self.cache_modes
+                                if self.result_key("time", cache_mode, footer_mode) not in done.get(col_type, {})
+                            ]
+                            if not variants:
+                                print(f"Skipping {cell_name(suffix, m, storage, catalog, col_type)}")
                                 continue
-                            print(f'        Running for "{col_type}" columns')
-                            result = m.measure(file, timeit_decorator, columns=columns)
-                            catalog_results[col_type] = {"time": result, "weight": m.weight}
+                            yield suffix, m, storage, catalog, col_type, columns, variants
 
-                            self.bump(results)
+    def measure(
+            self,
+            suffix: str,
+            m: Measurer,
+            storage: str,
+            catalog: str,
+            columns: list[str] | None,
+            variants: list[tuple[str, str]],
+    ) -> dict[str, float | int]:
+        """
+        Times and peak RSS growths of a cell per variant, the bytes read by one
+        measurement, and the on-disk sizes of the file and of the columns read.
+        """
+        file = self.path_roots[storage] / f"{self.prefixes[catalog]}{suffix}.parquet"
+        result = on_disk_sizes(file, None if columns is None else tuple(columns)).copy()
+        # Cold first, so that the warm runs find what the last cold run read in the page cache
+        for cache_mode, footer_mode in sorted(variants, key=lambda variant: variant[0] != "cold"):
+            metadata_cache = None
+            if footer_mode == "cached":
+                metadata_cache = self.metadata_cache
+                metadata_cache.load(file, pages=m.page_index)
+            bytes_read = ByteCounter()
+            peak_rss = PeakRSS() if self.measure_peak_rss else None
+            timeit_decorator = timeit(
+                n_iter=self.timeit_iters[storage],
+                index_sorted=self.timeit_index[storage],
+                cold=cache_mode == "cold",
+                bytes_read=bytes_read,
+                peak_rss=peak_rss,
+                metadata_cache=metadata_cache,
+            )
+            time_key = self.result_key("time", cache_mode, footer_mode)
+            result[time_key] = m.measure(file, timeit_decorator, columns=columns)
+            result[self.result_key("bytes_read", cache_mode, footer_mode)] = bytes_read.n_bytes
+            if peak_rss is not None:
+                result[self.result_key("peak_rss", cache_mode, footer_mode)] = peak_rss.n_bytes
+        return result
+
+    def is_local_storage(self, storage: str) -> bool:
+        return is_local(self.path_roots[storage])
+
+    def run(self):
+        results = deepcopy(self.previous_results)
+
+        if self.concurrency is None:
+            executors = dict.fromkeys(self.storages, ThreadPoolExecutor(max_workers=1))
+        else:
+            # Local storages read the same files, so their cells take turns on a single worker
+            local_executor = ThreadPoolExecutor(max_workers=1)
+            executors = {
+                storage: local_executor if self.is_local_storage(storage)
+                else ThreadPoolExecutor(max_workers=self.concurrency[storage])
+                for storage in self.storages
+            }
+
+        # Results are only touched by this thread, which writes each one as soon as it is in
+        pending = {}
+        try:
+            for cell in self.cells(results):
+                suffix, m, storage, catalog, col_type, columns, variants = cell
+                future = executors[storage].submit(self.measure, suffix, m, storage, catalog, columns, variants)
+                pending[future] = cell
+
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    suffix, m, storage, catalog, col_type, _columns, variants = pending.pop(future)
+                    result = future.result()
+                    summary = ", ".join(
+                        f"{cache_mode} cache, footer {footer_mode}: "
+                        f"{result[self.result_key('time', cache_mode, footer_mode)]:.3f}s "
+                        f"{result[self.result_key('bytes_read', cache_mode, footer_mode)] / 2**20:.1f} MiB"
+                        for cache_mode, footer_mode in variants
+                    )
+                    print(f"Done {cell_name(suffix, m, storage, catalog, col_type)}: {summary}")
+                    catalog_results = (
+                        results.setdefault(suffix, {})
+                        .setdefault(m.name, {})
+                        .setdefault(storage, {})
+                        .setdefault(catalog, {})
+                    )
+                    catalog_results.setdefault(col_type, {}).update(result, weight=m.weight)
+
+                    self.bump(results)
+        finally:
+            for future in pending:
+                future.cancel()
+            for executor in set(executors.values()):
+                executor.shutdown()
+
+
+def parse_concurrency(value: str) -> tuple[str, int]:
+    storage, _, n = value.partition("=")
+    if storage not in Runner.path_roots or not n.isdigit() or int(n) < 1:
+        raise argparse.ArgumentTypeError(f"Expected STORAGE=N with STORAGE in {list(Runner.path_roots)}, got {value!r}")
+    return storage, int(n)
 
 
 def parse_args(argv: list[str] | None) -> argparse.Namespace:
@@ -404,6 +1239,34 @@ def parse_args(argv: list[str] | None) -> argparse.Namespace:
     parser.add_argument("-f", "--force", action="store_true", help="Force benchmarks")
     parser.add_argument("-s", "--storages", choices=list(Runner.path_roots), nargs="+", help="Storages to benchmark")
     parser.add_argument("-c", "--catalogs", choices=list(Runner.prefixes), nargs="+", help="Catalogs to benchmark")
+    parser.add_argument(
+        "--cache",
+        choices=["warm", "cold", "both"],
+        default="warm",
+        help="Measure with the files in the OS page cache (warm, the minimum of several runs), evicted from it "
+        "before every run (cold, local storage only: remote files are never cached locally), or both",
+    )
+    parser.add_argument(
+        "--footer",
+        choices=["reread", "cached", "both"],
+        default="reread",
+        help="Fetch and parse the Parquet footer on every read (reread), keep it parsed in memory (cached), "
+        "or measure both",
+    )
+    parser.add_argument(
+        "-p",
+        "--parallel",
+        action="store_true",
+        help=f"Measure cells of different storages concurrently, several per storage (default: {Runner.concurrency})",
+    )
+    parser.add_argument(
+        "-j",
+        "--concurrency",
+        type=parse_concurrency,
+        nargs="+",
+        metavar="STORAGE=N",
+        help="Number of cells measured at once per storage, implies --parallel",
+    )
     return parser.parse_args(argv)
 
 
@@ -415,12 +1278,29 @@ def main(argv: list[str] | None = None):
         LargeCone(),
         SmallBox(),
         LargeBox(),
+        SmallCone(index=True),
+        LargeCone(index=True),
+        SmallBox(index=True),
+        LargeBox(index=True),
+        SmallCone(page_index=True),
+        LargeCone(page_index=True),
+        MultiCone(),
+        MultiCone(one_by_one=True),
         SelectSingleId(),
         SelectFractionOfIds(),
         FilterColumnFewRows(),
         FilterColumnManyRows(),
     ]
-    runner = Runner(m, force=args.force, storages=args.storages, catalogs=args.catalogs)
+    concurrency = dict(args.concurrency or []) if args.parallel or args.concurrency else None
+    runner = Runner(
+        m,
+        force=args.force,
+        storages=args.storages,
+        catalogs=args.catalogs,
+        concurrency=concurrency,
+        cache_modes=Runner.cache_modes if args.cache == "both" else [args.cache],
+        footer_modes=Runner.footer_modes if args.footer == "both" else [args.footer],
+    )
     runner.run()
 
 
@@ -0,0 +1,384 @@
+"""
+Page-level filtering of Parquet files with a page index.
+
+pyarrow writes page indexes (column index: per-page min/max; offset index:
+per-page location and first row) but its reader only prunes whole row groups.
+This reads the footer and page indexes itself, fetches only the data pages
+which may hold matching rows, and decodes them with pyarrow, by wrapping the
+pages of each column in a small single-column Parquet file.
+
+Thrift structures are kept as parsed, {field id: (compact type, value)}, so
+that they can be modified and written back; field ids are from parquet.thrift.
+"""
+
+import struct
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# Thrift compact protocol types
+STOP, TRUE, FALSE, BYTE, I16, I32, I64, DOUBLE, BINARY, LIST, SET, MAP, STRUCT = range(13)
+
+
+class ThriftReader:
+    """Decoder of the Thrift compact protocol, as used by Parquet metadata."""
+
+    def __init__(self, data: bytes, pos: int = 0):
+        self.data = data
+        self.pos = pos
+
+    def byte(self) -> int:
+        value = self.data[self.pos]
+        self.pos += 1
+        return value
+
+    def varint(self) -> int:
+        result = shift = 0
+        while True:
+            b = self.byte()
+            result |= (b & 0x7F) << shift
+            if not b & 0x80:
+                return result
+            shift += 7
+
+    def zigzag(self) -> int:
+        n = self.varint()
+        return (n >> 1) ^ -(n & 1)
+
+    def value(self, ttype: int):
+        if ttype in (TRUE, FALSE):
+            # Only in lists: in structs, the type itself is the value
+            return self.byte() == TRUE
+        if ttype == BYTE:
+            return struct.unpack("b", bytes([self.byte()]))[0]
+        if ttype in (I16, I32, I64):
+            return self.zigzag()
+        if ttype == DOUBLE:
+            value = struct.unpack_from("<d", self.data, self.pos)[0]
+            self.pos += 8
+            return value
+        if ttype == BINARY:
+            size = self.varint()
+            value = bytes(self.data[self.pos:self.pos + size])
+            self.pos += size
+            return value
+        if ttype in (LIST, SET):
+            header = self.byte()
+            size = header >> 4
+            if size == 15:
+                size = self.varint()
+            element_type = header & 0x0F
+            return element_type, [self.value(element_type) for _ in range(size)]
+        if ttype == STRUCT:
+            return self.struct()
+        raise ValueError(f"Unsupported Thrift compact type {ttype}")
+
+    def struct(self) -> dict:
+        fields = {}
+        field_id = 0
+        while True:
+            header = self.byte()
+            ttype = header & 0x0F
+            if ttype == STOP:
+                return fields
+            delta = header >> 4
+            field_id = field_id + delta if delta else self.zigzag()
+            if ttype in (TRUE, FALSE):
+                fields[field_id] = (ttype, ttype == TRUE)
+            else:
+                fields[field_id] = (ttype, self.value(ttype))
+
+
+class ThriftWriter:
+    """Encoder of the Thrift compact protocol, the inverse of ThriftReader."""
+
+    def __init__(self):
+        self.out = bytearray()
+
+    def varint(self, n: int):
+        while n > 0x7F:
+            self.out.append((n & 0x7F) | 0x80)
+            n >>= 7
+        self.out.append(n)
+
+    def zigzag(self, n: int):
+        self.varint((n << 1) ^ (n >> 63))
+
+    def value(self, ttype: int, value):
+        if ttype in (TRUE, FALSE):
+            self.out.append(TRUE if value else FALSE)
+        elif ttype == BYTE:
+            self.out += struct.pack("b", value)
+        elif ttype in (I16, I32, I64):
+            self.zigzag(value)
+        elif ttype == DOUBLE:
+            self.out += struct.pack("<d", value)
+        elif ttype == BINARY:
+            self.varint(len(value))
+            self.out += value
+        elif ttype in (LIST, SET):
+            element_type, elements = value
+            if len(elements) < 15:
+                self.out.append(len(elements) << 4 | element_type)
+            else:
+                self.out.append(0xF0 | element_type)
+                self.varint(len(elements))
+            for element in elements:
+                self.value(element_type, element)
+        elif ttype == STRUCT:
+            self.struct(value)
+        else:
+            raise ValueError(f"Unsupported Thrift compact type {ttype}")
+
+    def struct(self, fields: dict):
+        last_id = 0
+        for field_id in sorted(fields):
+            ttype, value = fields[field_id]
+            if ttype in (TRUE, FALSE):
+                ttype = TRUE if value else FALSE
+            if 0 < field_id - last_id <= 15:
+                self.out.append((field_id - last_id) << 4 | ttype)
+            else:
+                self.out.append(ttype)
+                self.zigzag(field_id)
+            if ttype not in (TRUE, FALSE):
+                self.value(ttype, value)
+            last_id = field_id
+        self.out.append(STOP)
+
+
+def encode(fields: dict) -> bytes:
+    writer = ThriftWriter()
+    writer.struct(fields)
+    return bytes(writer.out)
+
+
+def get(fields: dict, field_id: int, default=None):
+    return fields[field_id][1] if field_id in fields else default
+
+
+def read_range(f, offset: int, size: int) -> bytes:
+    f.seek(offset)
+    return f.read(size)
+
+
+def read_footer(f) -> dict:
+    """Parsed FileMetaData of an open Parquet file."""
+    f.seek(0, 2)
+    file_size = f.tell()
+    tail = read_range(f, file_size - 8, 8)
+    if tail[4:] != b"PAR1":
+        raise ValueError("Not a Parquet file")
+    footer_size = struct.unpack("<i", tail[:4])[0]
+    return ThriftReader(read_range(f, file_size - 8 - footer_size, footer_size)).struct()
+
+
+def top_level_columns(schema: list[dict]) -> dict[str, tuple[list[dict], list[int]]]:
+    """Schema elements and leaf column indexes of every top-level field, by name."""
+    fields = {}
+    pos, leaf = 1, 0
+    for _ in range(get(schema[0], 5)):
+        start = pos
+        # Walk the subtree of this field, depth first
+        n_pending = 1
+        leaves = []
+        while n_pending:
+            n_children = get(schema[pos], 5, 0)
+            if n_children == 0:
+                leaves.append(leaf)
+                leaf += 1
+            n_pending += n_children - 1
+            pos += 1
+        fields[get(schema[start], 4).decode()] = schema[start:pos], leaves
+    return fields
+
+
+def page_locations(f, chunk: dict) -> list[tuple[int, int, int]] | None:
+    """(offset, size with header, first row) of every data page of a column chunk, from its offset index."""
+    if 4 not in chunk:
+        return None
+    offset_index = ThriftReader(read_range(f, get(chunk, 4), get(chunk, 5))).struct()
+    return [(get(location, 1), get(location, 2), get(location, 3)) for location in get(offset_index, 1)[1]]
+
+
+def select_pages(f, chunk: dict, physical_type: int, num_rows: int, lower, upper) -> list[tuple[int, int]]:
+    """
+    Row ranges of the pages of a column chunk which may hold values within [lower, upper].
+
+    Without a column index, all rows are selected, the row group having been
+    pruned with its statistics already.
+    """
+    locations = page_locations(f, chunk)
+    if locations is None or 6 not in chunk:
+        return [(0, num_rows)]
+    column_index = ThriftReader(read_range(f, get(chunk, 6), get(chunk, 7))).struct()
+    null_pages = get(column_index, 1)[1]
+    mins = [decode_plain(value, physical_type) for value in get(column_index, 2)[1]]
+    maxs = [decode_plain(value, physical_type) for value in get(column_index, 3)[1]]
+    ends = [first_row for _offset, _size, first_row in locations[1:]] + [num_rows]
+    ranges = []
+    for (_offset, _size, first_row), end, is_null, page_min, page_max in zip(locations, ends, null_pages, mins, maxs):
+        if is_null or page_max < lower or page_min > upper:
+            continue
+        if ranges and ranges[-1][1] == first_row:
+            ranges[-1] = ranges[-1][0], end
+        else:
+            ranges.append((first_row, end))
+    return ranges
+
+
+# Parquet physical types with a fixed-size plain encoding
+PLAIN_FORMATS = {1: "<i", 2: "<q", 4: "<f", 5: "<d"}
+
+
+def decode_plain(value: bytes, physical_type: int):
+    if physical_type in PLAIN_FORMATS:
+        return struct.unpack(PLAIN_FORMATS[physical_type], value)[0]
+    return value
+
+
+def statistics_range(meta: dict):
+    """(min, max) of a column chunk from its statistics, or None."""
+    statistics = get(meta, 12)
+    if statistics is None:
+        return None
+    # min_value / max_value, or the deprecated min / max
+    low, high = get(statistics, 6, get(statistics, 2)), get(statistics, 5, get(statistics, 1))
+    if low is None or high is None:
+        return None
+    physical_type = get(meta, 1)
+    return decode_plain(low, physical_type), decode_plain(high, physical_type)
+
+
+def read_column_pages(f, file_meta: dict, fields: list[dict], chunk: dict, num_rows: int, row_ranges, rows):
+    """
+    Decode the pages of a top-level column which hold the rows in row_ranges,
+    and take the given rows of them.
+
+    The dictionary page (if any) and the selected data pages are wrapped in a
+    Parquet file with a single row group and column, read with pyarrow, and the
+    rows outside row_ranges dropped.
+    """
+    meta = get(chunk, 3)
+    chunk_start = get(meta, 11, get(meta, 9))
+    locations = page_locations(f, chunk)
+    if locations is None:
+        # Without an offset index, the chunk is read whole
+        locations = [(chunk_start, get(meta, 7), 0)]
+        prefix = b""
+    else:
+        prefix = read_range(f, chunk_start, locations[0][0] - chunk_start)
+
+    ends = [first_row for _offset, _size, first_row in locations[1:]] + [num_rows]
+    selected = [
+        (offset, size, first_row, end)
+        for (offset, size, first_row), end in zip(locations, ends)
+        if any(start < end and first_row < stop for start, stop in row_ranges)
+    ]
+
+    pages = bytearray(prefix)
+    firsts, bases = [], []
+    n_rows = 0
+    for offset, size, first_row, end in selected:
+        pages += read_range(f, offset, size)
+        firsts.append(first_row)
+        bases.append(n_rows)
+        n_rows += end - first_row
+
+    table = decode_pages(file_meta, fields, meta, bytes(pages), n_rows)
+
+    page = np.searchsorted(firsts, rows, side="right") - 1
+    positions = np.asarray(bases)[page] + rows - np.asarray(firsts)[page]
+    return table.column(0).take(pa.array(positions))
+
+
+def decode_pages(file_meta: dict, fields: list[dict], meta: dict, pages: bytes, num_rows: int) -> pa.Table:
+    """Read pages of a single column with pyarrow, by wrapping them in a Parquet file."""
+    # Count the values and uncompressed size of the pages from their headers
+    num_values = uncompressed_size = 0
+    reader = ThriftReader(pages)
+    first_data_page = None
+    while reader.pos < len(pages):
+        start = reader.pos
+        header = reader.struct()
+        page_type = get(header, 1)
+        if page_type in (0, 3) and first_data_page is None:
+            first_data_page = start
+        for field_id in (5, 8):  # data_page_header, data_page_header_v2
+            if field_id in header:
+                num_values += get(get(header, field_id), 1)
+        uncompressed_size += reader.pos - start + get(header, 2)
+        reader.pos += get(header, 3)
+
+    magic = b"PAR1"
+    new_meta = {field_id: meta[field_id] for field_id in (1, 2, 3, 4) if field_id in meta}
+    new_meta[5] = (I64, num_values)
+    new_meta[6] = (I64, uncompressed_size)
+    new_meta[7] = (I64, len(pages))
+    new_meta[9] = (I64, len(magic) + (first_data_page if first_data_page is not None else 0))
+    if first_data_page:
+        new_meta[11] = (I64, len(magic))
+    row_group = {
+        1: (LIST, (STRUCT, [{2: (I64, len(magic)), 3: (STRUCT, new_meta)}])),
+        2: (I64, uncompressed_size),
+        3: (I64, num_rows),
+    }
+    root = dict(get(file_meta, 2)[1][0])
+    root[5] = (I32, 1)
+    new_file_meta = {
+        1: file_meta[1],
+        2: (LIST, (STRUCT, [root, *fields])),
+        3: (I64, num_rows),
+        # No pages, no row group: an empty table of the column type
+        4: (LIST, (STRUCT, [row_group] if pages else [])),
+    }
+    if 6 in file_meta:
+        new_file_meta[6] = file_meta[6]
+    footer = encode(new_file_meta)
+    buffer = magic + pages + footer + struct.pack("<i", len(footer)) + magic
+    return pq.read_table(pa.BufferReader(buffer))
+
+
+def read_pages(f, file_meta: dict, *, filter_column: str, lower, upper, columns: list[str] | None = None) -> pa.Table:
+    """
+    Read the rows of the pages whose filter_column values may lie within [lower, upper].
+
+    Row groups are pruned with their statistics, then pages with the column
+    index of filter_column. The result is a superset of the matching rows, to
+    be filtered exactly by the caller.
+    """
+    schema = get(file_meta, 2)[1]
+    fields = top_level_columns(schema)
+    columns = list(fields) if columns is None else list(dict.fromkeys([*columns, filter_column]))
+    (filter_leaf,) = fields[filter_column][1]
+
+    batches = {column: [] for column in columns}
+    for row_group in get(file_meta, 4)[1]:
+        num_rows = get(row_group, 3)
+        chunks = get(row_group, 1)[1]
+        filter_meta = get(chunks[filter_leaf], 3)
+        bounds = statistics_range(filter_meta)
+        if bounds is not None and (bounds[1] < lower or bounds[0] > upper):
+            continue
+        row_ranges = select_pages(f, chunks[filter_leaf], get(filter_meta, 1), num_rows, lower, upper)
+        if not row_ranges:
+            continue
+        rows = np.concatenate([np.arange(start, stop) for start, stop in row_ranges])
+        for column in columns:
+            elements, leaves = fields[column]
+            if len(leaves) != 1:
+                raise NotImplementedError(f"Column {column} has more than one leaf column")
+            batches[column].append(
+                read_column_pages(f, file_meta, elements, chunks[leaves[0]], num_rows, row_ranges, rows)
+            )
+    if not batches[filter_column]:
+        # Nothing selected: decode no pages, for an empty table with the right types
+        first_chunks = get(get(file_meta, 4)[1][0], 1)[1]
+        for column in columns:
+            elements, leaves = fields[column]
+            batches[column].append(decode_pages(file_meta, elements, get(first_chunks[leaves[0]], 3), b"", 0).column(0))
+    return pa.table({
+        column: pa.chunked_array([chunk for array in arrays for chunk in array.chunks], type=arrays[0].type)
+        for column, arrays in batches.items()
+    })
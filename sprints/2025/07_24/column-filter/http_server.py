@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+"""Local stand-in for the Nginx server: serves a directory over HTTP with range requests
+
+`python -m http.server` ignores the Range header, so fsspec would download whole files with it.
+"""
+
+import argparse
+import os
+import re
+import sys
+import threading
+from contextlib import contextmanager
+from functools import partial
+from http import HTTPStatus
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from time import sleep
+
+RANGE_PATTERN = re.compile(r'bytes=(\d*)-(\d*)')
+
+
+class RangeRequestHandler(SimpleHTTPRequestHandler):
+    """Serves a single byte range per request, like Nginx does for the Parquet reads"""
+
+    # Keep-alive connections, as Nginx and MinIO have
+    protocol_version = 'HTTP/1.1'
+
+    def __init__(self, *args, latency=0.0, **kwargs):
+        self.latency = latency
+        self.range_length = None
+        super().__init__(*args, **kwargs)
+
+    def send_head(self):
+        # Emulate the round-trip time of a remote server
+        sleep(self.latency)
+        self.range_length = None
+
+        range_header = self.headers.get('Range')
+        path = self.translate_path(self.path)
+        if range_header is None or not os.path.isfile(path):
+            return super().send_head()
+
+        match = RANGE_PATTERN.fullmatch(range_header.strip())
+        if match is None:
+            self.send_error(HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE, 'Only a single byte range is supported')
+            return None
+        size = os.path.getsize(path)
+        first, last = match.groups()
+        if first:
+            start = int(first)
+            end = min(int(last), size - 1) if last else size - 1
+        elif last:
+            start = max(size - int(last), 0)
+            end = size - 1
+        else:
+            start, end = 0, size - 1
+        if start > end:
+            self.send_response(HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE)
+            self.send_header('Content-Range', f'bytes */{size}')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return None
+
+        f = open(path, 'rb')
+        f.seek(start)
+        self.send_response(HTTPStatus.PARTIAL_CONTENT)
+        self.send_header('Content-Type', self.guess_type(path))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.end_headers()
+        self.range_length = end - start + 1
+        return f
+
+    def end_headers(self):
+        if self.range_length is None:
+            self.send_header('Accept-Ranges', 'bytes')
+        super().end_headers()
+
+    def copyfile(self, source, outputfile):
+        length = self.range_length
+        if length is None:
+            return super().copyfile(source, outputfile)
+        while length > 0:
+            chunk = source.read(min(length, 1 << 20))
+            if not chunk:
+                break
+            outputfile.write(chunk)
+            length -= len(chunk)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class RangeHTTPServer(ThreadingHTTPServer):
+    def handle_error(self, request, client_address):
+        # Clients drop connections mid-response, e.g. fsspec's exists() for HTTP
+        if isinstance(sys.exc_info()[1], ConnectionError):
+            return
+        super().handle_error(request, client_address)
+
+
+def make_server(directory, *, host='localhost', port=0, latency_ms=0):
+    handler = partial(RangeRequestHandler, directory=directory, latency=latency_ms / 1000)
+    return RangeHTTPServer((host, port), handler)
+
+
+@contextmanager
+def serve(directory, *, host='localhost', port=0, latency_ms=0):
+    """Serve `directory` from a background thread, yielding the root URL"""
+    server = make_server(directory, host=host, port=port, latency_ms=latency_ms)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f'http://{host}:{server.server_address[1]}/'
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--directory', default='data')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', default=8000, type=int)
+    parser.add_argument('--latency-ms', default=0, type=float, help='Delay before answering every request')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    with make_server(args.directory, host=args.host, port=args.port, latency_ms=args.latency_ms) as server:
+        print(f'Serving {args.directory} at http://{args.host}:{server.server_address[1]}/')
+        server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
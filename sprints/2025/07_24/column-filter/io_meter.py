@@ -0,0 +1,168 @@
+"""In-process I/O metering of fsspec filesystems
+
+`metered(path)` instruments the fsspec filesystem of a `UPath`, so every read done through it
+(by pyarrow, nested-pandas or fsspec itself) is counted as it happens, with no server-side counters.
+fsspec caches filesystem instances by their storage options, so paths with the same storage options
+share the instrumented instance while the context is active.
+
+A request is a single call which reaches the storage:
+- "info": metadata calls, `info()`, `exists()`, `isfile()`, `isdir()` and `size()`,
+- "fetch": a range fetched by a buffered file, e.g. an HTTP or S3 range request,
+- "cat": a range fetched with `cat_file()`, which `cat_ranges()` calls per range,
+- "read": a `read()` of a file with no fsspec buffering, e.g. a local file.
+Nested calls are counted once, e.g. `isfile()` calling `info()`.
+"""
+
+import asyncio
+import threading
+from contextlib import contextmanager
+from dataclasses import dataclass
+from functools import wraps
+from statistics import median
+from time import monotonic
+
+from fsspec.spec import AbstractBufferedFile
+from upath import UPath
+
+INFO_METHODS = ('info', 'exists', 'isfile', 'isdir', 'size')
+
+
+@dataclass(frozen=True)
+class Request:
+    kind: str
+    bytes: int
+    latency: float
+
+
+class IOMeter:
+    """Requests done through a metered filesystem"""
+
+    def __init__(self):
+        self.requests: list[Request] = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def record(self, kind: str, nbytes: int, latency: float):
+        with self._lock:
+            self.requests.append(Request(kind=kind, bytes=nbytes, latency=latency))
+
+    def reset(self):
+        with self._lock:
+            self.requests.clear()
+
+    def wrap(self, kind, func, *, size=len):
+        """Record every call of `func` as a request, unless it is nested in another recorded call"""
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if getattr(self._local, 'depth', 0) > 0:
+                return func(*args, **kwargs)
+            self._local.depth = 1
+            try:
+                t1 = monotonic()
+                result = func(*args, **kwargs)
+                latency = monotonic() - t1
+            finally:
+                self._local.depth = 0
+            self.record(kind, size(result), latency)
+            return result
+
+        return wrapper
+
+    def wrap_async(self, kind, func, *, size=len):
+        """Record every call of coroutine function `func` as a request"""
+
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            t1 = monotonic()
+            result = await func(*args, **kwargs)
+            self.record(kind, size(result), monotonic() - t1)
+            return result
+
+        return wrapper
+
+    def summary(self) -> dict:
+        with self._lock:
+            requests = list(self.requests)
+        latencies = [request.latency for request in requests]
+        kinds = sorted({request.kind for request in requests})
+        return {
+            'requests': len(requests),
+            'bytes': sum(request.bytes for request in requests),
+            'requests_by_kind': {kind: sum(request.kind == kind for request in requests) for kind in kinds},
+            'latency_median': median(latencies) if latencies else float('nan'),
+            'latency_max': max(latencies, default=float('nan')),
+            'latencies': latencies,
+        }
+
+
+class MeteredFile:
+    """File proxy recording every read as a request, for files with no fsspec buffering"""
+
+    def __init__(self, file, meter: IOMeter):
+        self._file = file
+        self.read = meter.wrap('read', file.read)
+        if hasattr(file, 'readinto'):
+            self.readinto = meter.wrap('read', file.readinto, size=lambda n: n or 0)
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+    def __iter__(self):
+        return iter(self._file)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self._file.close()
+
+
+def _meter_file(file, meter: IOMeter):
+    if isinstance(file, AbstractBufferedFile):
+        # The cache calls its fetcher for every range it does not hold
+        file.cache.fetcher = meter.wrap('fetch', file.cache.fetcher)
+        return file
+    return MeteredFile(file, meter)
+
+
+def _zero(_result):
+    return 0
+
+
+@contextmanager
+def metered(path: UPath):
+    """Meter all I/O done through the filesystem of `path` within the context
+
+    Yields
+    ------
+    IOMeter
+        The meter recording the requests.
+    """
+    fs = path.fs
+    meter = IOMeter()
+
+    patches = {name: meter.wrap('info', getattr(fs, name), size=_zero) for name in INFO_METHODS}
+    patches['cat_file'] = meter.wrap('cat', fs.cat_file)
+    # Async filesystems run their sync methods in an event loop thread, where cat_ranges() calls _cat_file()
+    if asyncio.iscoroutinefunction(getattr(fs, '_cat_file', None)):
+        patches['_cat_file'] = meter.wrap_async('cat', fs._cat_file)
+    open_file = fs._open
+
+    @wraps(open_file)
+    def metered_open(*args, **kwargs):
+        return _meter_file(open_file(*args, **kwargs), meter)
+
+    patches['_open'] = metered_open
+
+    missing = object()
+    originals = {name: vars(fs).get(name, missing) for name in patches}
+    vars(fs).update(patches)
+    try:
+        yield meter
+    finally:
+        for name, original in originals.items():
+            if original is missing:
+                del vars(fs)[name]
+            else:
+                vars(fs)[name] = original
@@ -2,82 +2,60 @@
 
 import argparse
 import json
-import psutil
-import os
-import subprocess
-import sys
-from functools import partial
-from time import sleep, monotonic
+from contextlib import ExitStack
+from itertools import product
+from time import monotonic
 
 import nested_pandas
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.fs as pa_fs
 from upath import UPath
 
-
-def usage_minio(*, minio_name, **_kwargs):
-    output = subprocess.check_output([
-        'mc',
-        'admin',
-        'prometheus',
-        'metrics',
-        minio_name,
-        'cluster',
-        '--json'
-    ])
-    parsed = json.loads(output)
-    for part in parsed:
-        if part['name'] == 'minio_s3_traffic_sent_bytes':
-            return float(part['metrics'][0]['value'])
-    raise ValueError('No minio_s3_traffic_sent_bytes found')
-
-
-def usage_local(**_kwargs):
-    if sys.platform == 'darwin':
-        return float('nan')
-    proc = psutil.Process(os.getpid())
-    return proc.io_counters().read_bytes
-
-
-def usage_nginx(**_kwargs):
-    output = subprocess.check_output(
-        [
-            'docker',
-            'compose',
-            'logs',
-            'web',
-            '--no-log-prefix',
-        ],
-        cwd='nginx',
-    )
-    total_bytes = 0
-    for line in output.decode().splitlines():
-        try:
-            total_bytes += int(line.split()[9])
-        except (ValueError, IndexError):
-            pass
-    return total_bytes
+from http_server import serve
+from io_meter import metered
 
 
-def get_usage_fn(location, **kwargs):
-    if location == 'minio':
-        return partial(usage_minio, **kwargs)
-    if location == 'local':
-        return usage_local
-    if location == 'nginx':
-        return usage_nginx
-    raise ValueError(f'Unknown location: {location}')
+def parse_bool(value):
+    if value.lower() in {'true', 'yes', 'on', '1'}:
+        return True
+    if value.lower() in {'false', 'no', 'off', '0'}:
+        return False
+    raise argparse.ArgumentTypeError(f'Not a boolean: {value}')
 
 
 def parse_args(argv):
-    parser = argparse.ArgumentParser()
-    parser.add_argument('--minio-name', default='lsdb')
+    parser = argparse.ArgumentParser(
+        description='Read a Parquet file with every combination of the given settings, '
+                    'recording requests, bytes and request latencies of each read and its wall time',
+    )
     parser.add_argument('--filename', default='gaia_dr3-2-0-healpix-2.parquet')
-    parser.add_argument('--block-size-kb', default=None, type=int)
-    parser.add_argument('--location', choices=['local', 'minio', 'nginx'], default='minio')
-    parser.add_argument('--columns', nargs='+', default=None)
+    parser.add_argument('--location', choices=['local', 'http', 'minio', 'nginx'], default='http',
+                        help='"http" serves ./data with a local HTTP server, '
+                             'so it needs neither docker nor MinIO')
+    parser.add_argument('--http-latency-ms', default=0, type=float,
+                        help='Delay of every response of the --location=http server, to emulate a remote one')
+    parser.add_argument('--reader', nargs='+', choices=['pyarrow', 'nested-pandas'], default=['pyarrow'],
+                        help='"pyarrow" reads with pyarrow.dataset over the fsspec filesystem, '
+                             'with the --pre-buffer, --hole-size-limit-kb and --range-size-limit-kb settings, '
+                             '"nested-pandas" calls nested_pandas.read_parquet(), which ignores them')
+    parser.add_argument('--block-size-kb', nargs='+', default=[None], type=int,
+                        help='fsspec block size, the fsspec default if not given')
+    parser.add_argument('--pre-buffer', nargs='+', default=[False, True], type=parse_bool,
+                        help='Whether pyarrow fetches all column chunks of a row group at once, '
+                             'coalescing their byte ranges')
+    parser.add_argument('--hole-size-limit-kb', nargs='+', default=[8], type=int,
+                        help='With pre-buffering, merge two byte ranges if the gap between them is smaller')
+    parser.add_argument('--range-size-limit-kb', nargs='+', default=[32 * 1024], type=int,
+                        help='With pre-buffering, do not merge byte ranges into one larger than this')
+    parser.add_argument('--columns', nargs='+', action='append', default=None,
+                        help='Columns to read, repeat to sweep over several column sets, all columns if not given')
+    parser.add_argument('--repeat', default=1, type=int, help='Number of reads of every combination')
+    parser.add_argument('--output', default=None, help='JSON file to write the results to')
     return parser.parse_args(argv)
 
 
-def get_root_path(location, *, block_size_kb=None):
+def get_root_path(location, *, block_size_kb=None, http_url=None):
     if location == 'minio':
         upath_kwargs = {
             'key': 'admin',
@@ -89,37 +67,94 @@ def get_root_path(location, *, block_size_kb=None):
         return UPath('s3://bucket', **upath_kwargs)
     if location == 'local':
         return UPath('data/')
-    if location == 'nginx':
+    if location in {'http', 'nginx'}:
         upath_kwargs = {}
         if block_size_kb is not None:
             upath_kwargs['block_size'] = block_size_kb * 1024
-        return UPath('http://localhost:8000/', **upath_kwargs)
+        return UPath(http_url or 'http://localhost:8000/', **upath_kwargs)
     raise ValueError(f'Unknown location: {location}')
 
 
+def read_pyarrow(path, *, columns, pre_buffer, hole_size_limit_kb, range_size_limit_kb):
+    scan_options = ds.ParquetFragmentScanOptions(pre_buffer=pre_buffer)
+    if pre_buffer:
+        scan_options.cache_options = pa.CacheOptions(
+            hole_size_limit=hole_size_limit_kb * 1024,
+            range_size_limit=range_size_limit_kb * 1024,
+        )
+    file_format = ds.ParquetFileFormat(default_fragment_scan_options=scan_options)
+    # pyarrow would replace fsspec's local filesystem with its own, which is not metered
+    filesystem = pa_fs.PyFileSystem(pa_fs.FSSpecHandler(path.fs))
+    dataset = ds.dataset(path.path, filesystem=filesystem, format=file_format)
+    return dataset.to_table(columns=columns)
+
+
+def read_nested_pandas(path, *, columns, **_kwargs):
+    return nested_pandas.read_parquet(path, columns=columns)
+
+
+READERS = {
+    'pyarrow': read_pyarrow,
+    'nested-pandas': read_nested_pandas,
+}
+
+
+def iter_configs(args):
+    for reader, block_size_kb, columns in product(args.reader, args.block_size_kb, args.columns or [None]):
+        config = {'reader': reader, 'block_size_kb': block_size_kb, 'columns': columns}
+        if reader != 'pyarrow':
+            yield config | {'pre_buffer': None, 'hole_size_limit_kb': None, 'range_size_limit_kb': None}
+            continue
+        for pre_buffer in dict.fromkeys(args.pre_buffer):
+            if not pre_buffer:
+                # Range coalescing limits are not used without pre-buffering
+                yield config | {'pre_buffer': False, 'hole_size_limit_kb': None, 'range_size_limit_kb': None}
+                continue
+            for hole_size_limit_kb, range_size_limit_kb in product(args.hole_size_limit_kb, args.range_size_limit_kb):
+                yield config | {
+                    'pre_buffer': True,
+                    'hole_size_limit_kb': hole_size_limit_kb,
+                    'range_size_limit_kb': range_size_limit_kb,
+                }
+
+
+def measure(path, *, reader, **kwargs):
+    with metered(path) as meter:
+        t1 = monotonic()
+        _table = READERS[reader](path, **kwargs)
+        wall_time = monotonic() - t1
+    return meter.summary() | {'wall_time': wall_time}
+
+
 def main(argv=None):
     args = parse_args(argv)
-    if args.block_size_kb is not None and args.location == 'local':
+    if args.block_size_kb != [None] and args.location == 'local':
         raise ValueError('--block-size-kb is not supported for --location=local')
 
-    usage_fn = get_usage_fn(args.location, minio_name=args.minio_name)
-    root = get_root_path(args.location, block_size_kb=args.block_size_kb)
-
-    path = root / 'gaia_dr3-2-0-healpix-2.parquet'
-
-    old_usage = usage_fn()
-    t1 = monotonic()
-    table = nested_pandas.read_parquet(path, columns=args.columns)
-    wall_time = monotonic() - t1
-
-    new_usage = usage_fn()
-    while new_usage == old_usage:
-        sleep(0.1)
-        new_usage = usage_fn()
-    used = new_usage - old_usage
-
-    print(f'Read: {used / (1024 * 1024):.3f} MiB')
-    print(f'Wall time: {wall_time:.3f} s')
+    results = []
+    with ExitStack() as stack:
+        http_url = None
+        if args.location == 'http':
+            http_url = stack.enter_context(serve('data', latency_ms=args.http_latency_ms))
+
+        for config in iter_configs(args):
+            root = get_root_path(args.location, block_size_kb=config['block_size_kb'], http_url=http_url)
+            path = root / args.filename
+            read_kwargs = {key: value for key, value in config.items() if key != 'block_size_kb'}
+            for _ in range(args.repeat):
+                result = config | measure(path, **read_kwargs)
+                results.append(result)
+                print(
+                    ', '.join(f'{key}={value}' for key, value in config.items()) + ': '
+                    f'{result["requests"]} requests, '
+                    f'read {result["bytes"] / (1024 * 1024):.3f} MiB, '
+                    f'median request latency {result["latency_median"] * 1000:.1f} ms, '
+                    f'wall time {result["wall_time"]:.3f} s'
+                )
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
 
 
 if __name__ == '__main__':